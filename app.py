@@ -1,13 +1,27 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
 import psycopg2
+import psycopg2.errorcodes
 import psycopg2.extras
-from datetime import datetime, timezone
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
 import os
 from flask_cors import CORS
 import re
 import secrets
+import sys
 import json
+import atexit
+import bisect
 import hashlib
+import itertools
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
 
 app = Flask(__name__)
 # Configure CORS to allow requests from Chrome extension and handle Private Network Access
@@ -40,14 +54,1032 @@ DATABASE_URL = (
 )
 
 
-def get_conn():
+# --- LOGGING (queue-based: formatting and I/O happen on a background thread) ---
+# Default level, plus per-area overrides, e.g. "log_video=WARNING,queues=DEBUG"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# "text" or "json" (one JSON object per line)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Request payloads are logged at DEBUG, truncated to this many characters...
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", 512))
+# ...and only 1 in N of them (1 logs every payload)
+LOG_PAYLOAD_SAMPLE = int(os.getenv("LOG_PAYLOAD_SAMPLE", 1))
+# Records waiting for the log thread; further records are dropped (and counted)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg (+ exc)."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a bounded queue drained by a QueueListener thread, so
+    request threads never format messages or write to stdout. The listener
+    is (re)started lazily in each process, since threads do not survive fork.
+    """
+
+    def __init__(self, target, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # A queue inherited across fork may have been locked mid-put
+                self.queue = queue.Queue(self.maxsize)
+                self._listener = logging.handlers.QueueListener(
+                    self.queue, self.target, respect_handler_level=True
+                )
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Message formatting (args interpolation) is left to the listener;
+        # only tracebacks are rendered here, while their frames are current
+        if record.exc_info:
+            record.exc_text = self.target.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Flush queued records (used at exit)."""
+        if self._listener is not None and self._pid == os.getpid():
+            try:
+                self._listener.stop()
+            except Exception:
+                pass
+            self._pid = None
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "dropped": self.dropped}
+
+
+def configure_logging():
+    stream = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        stream.setFormatter(JsonLogFormatter())
+    else:
+        stream.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s")
+        )
+    handler = AsyncLogHandler(stream, LOG_QUEUE_SIZE)
+    root = logging.getLogger("app")
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [handler]
+    root.propagate = False
+    for item in LOG_LEVELS.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            logging.getLogger(f"app.{name.strip()}").setLevel(level.strip().upper())
+    atexit.register(handler.stop)
+    return handler
+
+
+log_handler = configure_logging()
+
+
+def get_logger(name):
+    """Logger for one area/endpoint; levels are set via LOG_LEVEL/LOG_LEVELS."""
+    return logging.getLogger(f"app.{name}")
+
+
+class _TruncatedPayload:
+    """
+    Renders a payload as JSON capped at LOG_PAYLOAD_MAX_CHARS (passwords
+    masked), only when the record is actually emitted.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        data = self.data
+        if isinstance(data, dict) and "password" in data:
+            data = dict(data, password="***")
+        try:
+            text = json.dumps(data, default=str)
+        except Exception:
+            text = repr(self.data)
+        if len(text) > LOG_PAYLOAD_MAX_CHARS:
+            text = f"{text[:LOG_PAYLOAD_MAX_CHARS]}... ({len(text)} chars)"
+        return text
+
+
+_payload_counter = itertools.count()
+
+
+def log_payload(log, message, data):
+    """Log a request payload at DEBUG, sampled (LOG_PAYLOAD_SAMPLE) and truncated."""
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    if LOG_PAYLOAD_SAMPLE > 1 and next(_payload_counter) % LOG_PAYLOAD_SAMPLE:
+        return
+    log.debug("%s %s", message, _TruncatedPayload(data))
+
+
+pool_log = get_logger("db_pool")
+tx_log = get_logger("transactions")
+verify_log = get_logger("log_video.verify")
+register_log = get_logger("register")
+reference_log = get_logger("reference_data")
+auto_session_log = get_logger("auto_session")
+video_log = get_logger("log_video")
+video_batch_log = get_logger("log_video.batch")
+write_behind_log = get_logger("log_video.write_behind")
+queues_log = get_logger("queues")
+cards_log = get_logger("cards")
+cards_bulk_log = get_logger("cards.bulk")
+activity_log = get_logger("activity")
+startup_log = get_logger("startup")
+
+
+# --- CONNECTION POOL ---
+# Sized per worker process: every gunicorn/uwsgi worker gets its own pool.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+# Connections older than this (seconds) are closed and replaced
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", 1800))
+# Connections idle longer than this (seconds) are pinged before being handed out
+DB_POOL_HEALTHCHECK_AFTER = float(os.getenv("DB_POOL_HEALTHCHECK_AFTER", 30))
+
+
+class PoolTimeoutError(RuntimeError):
+    """Raised when no pooled connection becomes available in time."""
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of autocommit psycopg2 connections.
+    - Connections are health checked on checkout when they have been idle a while
+    - Connections are recycled once they exceed max_lifetime
+    - Callers block (up to timeout) when max_size connections are in use
+    """
+
+    def __init__(
+        self,
+        dsn,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_lifetime=DB_POOL_MAX_LIFETIME,
+        healthcheck_after=DB_POOL_HEALTHCHECK_AFTER,
+    ):
+        self.dsn = dsn
+        self.min_size = max(0, min(min_size, max_size))
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.healthcheck_after = healthcheck_after
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = []  # LIFO stack of (conn, created_at, last_used)
+        self._created_at = {}  # id(conn) -> monotonic creation time
+        self._size = 0  # open connections, idle + in use + being opened
+        self._waiting = 0
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "connections_created": 0,
+            "connections_closed": 0,
+            "recycled_lifetime": 0,
+            "failed_healthchecks": 0,
+            "timeouts": 0,
+            "wait_time_total_ms": 0.0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=InstrumentedCursor)
+        conn.autocommit = (
+            True  # Enable autocommit to prevent transaction rollback issues
+        )
+        with self._cond:
+            self._created_at[id(conn)] = time.monotonic()
+            self._stats["connections_created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        """Close a connection and free its slot. Caller must NOT hold the lock."""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._size -= 1
+            self._stats["connections_closed"] += 1
+            self._cond.notify()
+
+    def _expired(self, conn, now):
+        created = self._created_at.get(id(conn))
+        return created is not None and now - created > self.max_lifetime
+
+    def _healthy(self, conn, last_used, now):
+        if conn.closed:
+            return False
+        if now - last_used < self.healthcheck_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            return True
+        except Exception:
+            return False
+
+    def fill(self):
+        """Open connections until min_size are available."""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic(), time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            candidate = None
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeoutError("Connection pool is closed")
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeoutError(
+                            f"No database connection available after {self.timeout}s "
+                            f"(pool max_size={self.max_size})"
+                        )
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                if self._idle:
+                    candidate = self._idle.pop()
+                else:
+                    self._size += 1  # reserve a slot, connect outside the lock
+
+            if candidate is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            else:
+                conn, _, last_used = candidate
+                now = time.monotonic()
+                if self._expired(conn, now):
+                    with self._cond:
+                        self._stats["recycled_lifetime"] += 1
+                    self._discard(conn)
+                    continue
+                if not self._healthy(conn, last_used, now):
+                    with self._cond:
+                        self._stats["failed_healthchecks"] += 1
+                    self._discard(conn)
+                    continue
+
+            with self._cond:
+                self._stats["checkouts"] += 1
+                self._stats["wait_time_total_ms"] += (
+                    time.monotonic() - started
+                ) * 1000.0
+            return conn
+
+    def putconn(self, conn):
+        if conn.closed or self._closed:
+            self._discard(conn)
+            return
+        try:
+            # Never hand out a connection with an open transaction or modified mode
+            if (
+                conn.get_transaction_status()
+                != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            ):
+                conn.rollback()
+            if not conn.autocommit:
+                conn.autocommit = True
+        except Exception:
+            self._discard(conn)
+            return
+
+        now = time.monotonic()
+        if self._expired(conn, now):
+            with self._cond:
+                self._stats["recycled_lifetime"] += 1
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, self._created_at.get(id(conn), now), now))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                {
+                    "pid": self.pid,
+                    "min_size": self.min_size,
+                    "max_size": self.max_size,
+                    "size": self._size,
+                    "idle": len(self._idle),
+                    "in_use": self._size - len(self._idle),
+                    "waiting": self._waiting,
+                }
+            )
+        stats["wait_time_total_ms"] = round(stats["wait_time_total_ms"], 3)
+        return stats
+
+
+class PooledConnection:
+    """
+    Proxy for a connection checked out of the pool.
+    close() returns the connection to the pool instead of closing the socket,
+    so handlers can keep using the familiar get_conn()/conn.close() pattern.
+    """
+
+    def __init__(self, pool, conn):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_conn", conn)
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get("_conn")
+        if conn is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return getattr(conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    @property
+    def closed(self):
+        conn = self.__dict__.get("_conn")
+        return 1 if conn is None else conn.closed
+
+    def close(self):
+        conn = self.__dict__.get("_conn")
+        if conn is None:
+            return
+        object.__setattr__(self, "_conn", None)
+        self._pool.putconn(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return this process's pool, creating a fresh one after fork."""
+    global _pool
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL environment variable is required")
-    conn = psycopg2.connect(DATABASE_URL)
-    conn.autocommit = True  # Enable autocommit to prevent transaction rollback issues
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            # Connections inherited from a parent process are never reused
+            _pool = ConnectionPool(DATABASE_URL)
+            try:
+                _pool.fill()
+            except Exception as e:
+                pool_log.warning("Failed to pre-open connections: %s", e)
+        return _pool
+
+
+def get_conn():
+    """
+    Check out a pooled connection. Call conn.close() to return it; anything
+    still checked out when the request ends is returned automatically.
+    """
+    pool = get_pool()
+    conn = PooledConnection(pool, pool.getconn())
+    if has_request_context():
+        g.setdefault("_db_conns", []).append(conn)
     return conn
 
 
+@contextmanager
+def db_connection():
+    """Context manager that always returns the connection to the pool."""
+    conn = get_conn()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+@app.teardown_request
+def release_db_connections(exc):
+    for conn in g.pop("_db_conns", []):
+        try:
+            conn.close()
+        except Exception as e:
+            pool_log.warning("Failed to release connection: %s", e)
+
+
+# --- REQUEST METRICS (per-route latency/status/in-flight and DB round trips, /metrics) ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+# Upper bounds (seconds) of the request latency histogram buckets
+METRICS_LATENCY_BUCKETS = tuple(
+    float(b)
+    for b in os.getenv(
+        "METRICS_LATENCY_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10"
+    ).split(",")
+)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that counts statements and their time against the current request
+    and hands slow ones to the slow query log.
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        error = None
+        try:
+            return super().execute(query, vars)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _record_query(elapsed)
+            if slow_query_log.enabled:
+                slow_query_log.observe(self, query, vars, elapsed, error)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        error = None
+        try:
+            return super().executemany(query, vars_list)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _record_query(elapsed)
+            if slow_query_log.enabled:
+                slow_query_log.observe(self, query, None, elapsed, error, many=True)
+
+
+def _record_query(elapsed):
+    if has_request_context() and "_metrics_start" in g:
+        g._db_queries += 1
+        g._db_time += elapsed
+    else:
+        request_metrics.record_background_query(elapsed)
+
+
+class RequestMetrics:
+    """
+    In-process counters for each (route, method): a latency histogram, a
+    count per status code, requests in flight and DB statements/time. Each
+    worker process keeps its own; /metrics reports the one that answers.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._latency = {}  # (route, method) -> [bucket counts..., sum, count]
+        self._status = {}  # (route, method, status) -> count
+        self._in_flight = {}  # (route, method) -> n
+        self._db = {}  # (route, method) -> [queries, seconds]
+        self._background_db = [0, 0.0]
+
+    def start(self, key):
+        with self._lock:
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+    def finish(self, key, status, elapsed, db_queries, db_time):
+        index = bisect.bisect_left(self.buckets, elapsed)
+        with self._lock:
+            self._in_flight[key] -= 1
+            latency = self._latency.get(key)
+            if latency is None:
+                latency = self._latency[key] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                latency[index] += 1
+            latency[-2] += elapsed
+            latency[-1] += 1
+            status_key = key + (status,)
+            self._status[status_key] = self._status.get(status_key, 0) + 1
+            db = self._db.setdefault(key, [0, 0.0])
+            db[0] += db_queries
+            db[1] += db_time
+
+    def record_background_query(self, elapsed):
+        with self._lock:
+            self._background_db[0] += 1
+            self._background_db[1] += elapsed
+
+    def render(self, pool_stats):
+        """Prometheus text exposition format (0.0.4)."""
+        with self._lock:
+            latency = {k: list(v) for k, v in self._latency.items()}
+            status = dict(self._status)
+            in_flight = dict(self._in_flight)
+            db = {k: list(v) for k, v in self._db.items()}
+            background_db = list(self._background_db)
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_prometheus_labels(labels)} {value}")
+
+        metric(
+            "http_requests_total",
+            "counter",
+            "Requests by route, method and status code.",
+            [
+                ({"route": r, "method": m, "status": s}, n)
+                for (r, m, s), n in sorted(status.items())
+            ],
+        )
+        histogram = []
+        for (route, method), values in sorted(latency.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, values):
+                cumulative += n
+                histogram.append(
+                    (
+                        "_bucket",
+                        {"route": route, "method": method, "le": repr(bound)},
+                        cumulative,
+                    )
+                )
+            labels = {"route": route, "method": method}
+            histogram.append(("_bucket", dict(labels, le="+Inf"), values[-1]))
+            histogram.append(("_sum", labels, round(values[-2], 6)))
+            histogram.append(("_count", labels, values[-1]))
+        lines.append(
+            "# HELP http_request_duration_seconds Request latency by route and method."
+        )
+        lines.append("# TYPE http_request_duration_seconds histogram")
+        for suffix, labels, value in histogram:
+            lines.append(
+                f"http_request_duration_seconds{suffix}{_prometheus_labels(labels)} {value}"
+            )
+        metric(
+            "http_requests_in_flight",
+            "gauge",
+            "Requests currently being handled.",
+            [({"route": r, "method": m}, n) for (r, m), n in sorted(in_flight.items())],
+        )
+        metric(
+            "db_queries_total",
+            "counter",
+            "Statements executed while handling requests, by route.",
+            [({"route": r, "method": m}, v[0]) for (r, m), v in sorted(db.items())]
+            + [({"route": "<background>", "method": ""}, background_db[0])],
+        )
+        metric(
+            "db_query_duration_seconds_total",
+            "counter",
+            "Time spent executing statements, by route.",
+            [
+                ({"route": r, "method": m}, round(v[1], 6))
+                for (r, m), v in sorted(db.items())
+            ]
+            + [({"route": "<background>", "method": ""}, round(background_db[1], 6))],
+        )
+        for key, kind, help_text in (
+            ("size", "gauge", "Open connections in this process's pool."),
+            ("idle", "gauge", "Idle pooled connections."),
+            ("in_use", "gauge", "Checked-out pooled connections."),
+            ("waiting", "gauge", "Threads waiting for a pooled connection."),
+            ("max_size", "gauge", "Configured pool size limit."),
+            ("checkouts", "counter", "Connections handed out."),
+            ("timeouts", "counter", "Checkouts that timed out."),
+            ("connections_created", "counter", "Connections opened."),
+            ("connections_closed", "counter", "Connections closed."),
+        ):
+            name = f"db_pool_{key}" + ("_total" if kind == "counter" else "")
+            metric(name, kind, help_text, [({}, pool_stats.get(key, 0))])
+        metric(
+            "db_pool_wait_seconds_total",
+            "counter",
+            "Time spent waiting for pooled connections.",
+            [({}, round(pool_stats.get("wait_time_total_ms", 0) / 1000.0, 6))],
+        )
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+request_metrics = RequestMetrics(METRICS_LATENCY_BUCKETS)
+
+
+def _metrics_key():
+    rule = request.url_rule
+    return (rule.rule if rule is not None else "<unmatched>", request.method)
+
+
+@app.before_request
+def start_request_metrics():
+    if not METRICS_ENABLED:
+        return
+    g._metrics_start = time.perf_counter()
+    g._metrics_key = _metrics_key()
+    g._db_queries = 0
+    g._db_time = 0.0
+    request_metrics.start(g._metrics_key)
+
+
+@app.after_request
+def record_response_status(response):
+    g._metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    start = g.pop("_metrics_start", None)
+    if start is None:
+        return
+    request_metrics.finish(
+        g._metrics_key,
+        str(g.get("_metrics_status", 500)),
+        time.perf_counter() - start,
+        g._db_queries,
+        g._db_time,
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus scrape endpoint (this worker process's counters)."""
+    body = request_metrics.render(get_pool().stats())
+    return app.response_class(body, mimetype="text/plain; version=0.0.4")
+
+
+# --- SLOW QUERY LOG (statements over a threshold, with sampled EXPLAIN plans) ---
+# Statements slower than this (ms) are written to the slow query log; 0 disables
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 0))
+SLOW_QUERY_LOG_FILE = os.getenv("SLOW_QUERY_LOG_FILE", "slow_queries.log")
+SLOW_QUERY_LOG_MAX_BYTES = int(os.getenv("SLOW_QUERY_LOG_MAX_BYTES", 10 * 1024 * 1024))
+SLOW_QUERY_LOG_BACKUPS = int(os.getenv("SLOW_QUERY_LOG_BACKUPS", 5))
+# Fraction (0-1) of slow statements re-run under EXPLAIN (ANALYZE, BUFFERS)
+SLOW_QUERY_EXPLAIN_SAMPLE = float(os.getenv("SLOW_QUERY_EXPLAIN_SAMPLE", 0))
+# EXPLAIN ANALYZE executes the statement; writes are only explained (inside a
+# rolled-back savepoint/transaction) when explicitly enabled
+SLOW_QUERY_EXPLAIN_WRITES = os.getenv("SLOW_QUERY_EXPLAIN_WRITES", "0").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+_SQL_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER_RE = re.compile(r"(?<![\w$%])-?\d+(?:\.\d+)?\b")
+_SQL_WHITESPACE_RE = re.compile(r"\s+")
+_SQL_WRITE_RE = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|CREATE|ALTER|DROP|GRANT|LOCK)\b", re.I
+)
+
+
+def _normalize_sql(query):
+    """Collapse whitespace and replace inline literals; %s placeholders are kept."""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    elif not isinstance(query, str):
+        query = str(query)
+    query = _SQL_STRING_RE.sub("'?'", query)
+    query = _SQL_NUMBER_RE.sub("?", query)
+    return _SQL_WHITESPACE_RE.sub(" ", query).strip()
+
+
+def _params_shape(params):
+    """Types and sizes of the bound parameters, never their values."""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {k: _params_shape(v) for k, v in params.items()}
+    if isinstance(params, (list, tuple)):
+        if len(params) > 20:
+            return f"{type(params).__name__}[{len(params)}]"
+        return [_params_shape(v) for v in params]
+    if isinstance(params, (str, bytes)):
+        return f"{type(params).__name__}({len(params)})"
+    return type(params).__name__
+
+
+def _is_read_only(normalized):
+    head = normalized.lstrip("( ").split(" ", 1)[0].upper()
+    return (
+        head in ("SELECT", "WITH", "VALUES", "TABLE")
+        and not _SQL_WRITE_RE.search(normalized)
+        and "FOR UPDATE" not in normalized.upper()
+        and "FOR NO KEY UPDATE" not in normalized.upper()
+        and "FOR SHARE" not in normalized.upper()
+    )
+
+
+class SlowQueryLog:
+    """
+    Writes one JSON line per slow statement (normalized SQL, parameter shape,
+    route, duration and, for a sample, the EXPLAIN ANALYZE plan) to a rotating
+    file through its own background log queue.
+    """
+
+    def __init__(self, threshold_ms, explain_sample, explain_writes):
+        self.threshold = threshold_ms / 1000.0
+        self.explain_sample = explain_sample
+        self.explain_writes = explain_writes
+        self._handler = None
+        self._logger = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "slow_queries": 0,
+            "explained": 0,
+            "explain_skipped": 0,
+            "explain_errors": 0,
+        }
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def _get_logger(self):
+        if self._logger is None:
+            with self._lock:
+                if self._logger is None:
+                    target = logging.handlers.RotatingFileHandler(
+                        SLOW_QUERY_LOG_FILE,
+                        maxBytes=SLOW_QUERY_LOG_MAX_BYTES,
+                        backupCount=SLOW_QUERY_LOG_BACKUPS,
+                        delay=True,
+                    )
+                    target.setFormatter(logging.Formatter("%(message)s"))
+                    self._handler = AsyncLogHandler(target, LOG_QUEUE_SIZE)
+                    atexit.register(self._handler.stop)
+                    logger = logging.getLogger("app.slow_query")
+                    logger.setLevel(logging.INFO)
+                    logger.handlers[:] = [self._handler]
+                    logger.propagate = False
+                    self._logger = logger
+        return self._logger
+
+    def observe(self, cursor, query, params, elapsed, error=None, many=False):
+        if elapsed < self.threshold:
+            return
+        normalized = _normalize_sql(query)
+        entry = {
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "duration_ms": round(elapsed * 1000, 3),
+            "route": _current_route(),
+            "sql": normalized,
+            "params": _params_shape(params),
+        }
+        if many:
+            entry["executemany"] = True
+        if error is not None:
+            entry["error"] = type(error).__name__
+        elif (
+            not many
+            and self.explain_sample > 0
+            and random.random() < self.explain_sample
+        ):
+            entry["plan"] = self._explain(cursor, normalized)
+        with self._lock:
+            self._stats["slow_queries"] += 1
+        self._get_logger().info("%s", _JsonLine(entry))
+
+    def _explain(self, cursor, normalized):
+        read_only = _is_read_only(normalized)
+        sent = cursor.query
+        if cursor.name or not sent or (not read_only and not self.explain_writes):
+            with self._lock:
+                self._stats["explain_skipped"] += 1
+            return None
+        conn = cursor.connection
+        in_transaction = not conn.autocommit or (
+            conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        )
+        # A plain cursor: its statements are not instrumented (no recursion)
+        # and it leaves the original cursor's result set untouched
+        cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        try:
+            if in_transaction:
+                cur.execute("SAVEPOINT slow_query_explain")
+            elif not read_only:
+                cur.execute("BEGIN")
+            try:
+                cur.execute(b"EXPLAIN (ANALYZE, BUFFERS) " + sent)
+                plan = "\n".join(row[0] for row in cur.fetchall())
+            finally:
+                if in_transaction:
+                    cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                    cur.execute("RELEASE SAVEPOINT slow_query_explain")
+                elif not read_only:
+                    cur.execute("ROLLBACK")
+            with self._lock:
+                self._stats["explained"] += 1
+            return plan
+        except Exception as e:
+            with self._lock:
+                self._stats["explain_errors"] += 1
+            return f"EXPLAIN failed: {e}"
+        finally:
+            cur.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["enabled"] = self.enabled
+        stats["threshold_ms"] = self.threshold * 1000
+        if self._handler is not None:
+            stats["log"] = self._handler.stats()
+        return stats
+
+
+class _JsonLine:
+    """Serialized on the log listener thread, not the request thread."""
+
+    __slots__ = ("entry",)
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def __str__(self):
+        return json.dumps(self.entry, default=str)
+
+
+def _current_route():
+    if not has_request_context():
+        return None
+    key = g.get("_metrics_key")
+    if key is None:
+        rule = request.url_rule
+        key = (rule.rule if rule is not None else "<unmatched>", request.method)
+    return f"{key[1]} {key[0]}"
+
+
+slow_query_log = SlowQueryLog(
+    SLOW_QUERY_MS, SLOW_QUERY_EXPLAIN_SAMPLE, SLOW_QUERY_EXPLAIN_WRITES
+)
+
+
+# --- TRANSACTION RETRY (deadlocks and serialization failures) ---
+TX_RETRY_ATTEMPTS = int(os.getenv("TX_RETRY_ATTEMPTS", 5))
+TX_RETRY_BASE_MS = float(os.getenv("TX_RETRY_BASE_MS", 20))
+TX_RETRY_MAX_MS = float(os.getenv("TX_RETRY_MAX_MS", 1000))
+RETRYABLE_PGCODES = {
+    psycopg2.errorcodes.DEADLOCK_DETECTED: "deadlocks",
+    psycopg2.errorcodes.SERIALIZATION_FAILURE: "serialization_failures",
+}
+
+
+class TransactionRetries:
+    """Per-operation counters for transactions retried by run_transaction."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def count(self, label, key):
+        with self._lock:
+            stats = self._stats.setdefault(
+                label,
+                {
+                    "transactions": 0,
+                    "retries": 0,
+                    "deadlocks": 0,
+                    "serialization_failures": 0,
+                    "exhausted": 0,
+                },
+            )
+            stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return {label: dict(stats) for label, stats in self._stats.items()}
+
+
+transaction_retries = TransactionRetries()
+
+
+def transaction_retry_delay(label, pgcode, attempt):
+    """
+    Account for a failed attempt of a retried transaction. Returns the
+    jittered backoff in seconds before the next attempt, or None when the
+    error is not retryable or the attempts are exhausted (raise it).
+    """
+    reason = RETRYABLE_PGCODES.get(pgcode)
+    if reason is None:
+        return None
+    transaction_retries.count(label, reason)
+    if attempt >= TX_RETRY_ATTEMPTS:
+        transaction_retries.count(label, "exhausted")
+        return None
+    transaction_retries.count(label, "retries")
+    # Full jitter keeps colliding transactions from retrying in lockstep
+    backoff_ms = min(TX_RETRY_MAX_MS, TX_RETRY_BASE_MS * 2 ** (attempt - 1))
+    tx_log.info("%s: %s on attempt %s, retrying", label, pgcode, attempt)
+    return random.uniform(0, backoff_ms) / 1000.0
+
+
+def run_transaction(conn, work, label):
+    """
+    Run work(cur) in a transaction on conn and commit, retrying the whole
+    transaction on deadlock or serialization failure with jittered
+    exponential backoff. Returns work's result; other errors are raised
+    after rollback. work must be safe to re-run from the start.
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        attempt = 0
+        while True:
+            attempt += 1
+            transaction_retries.count(label, "transactions")
+            cur = conn.cursor()
+            try:
+                result = work(cur)
+                conn.commit()
+                return result
+            except psycopg2.Error as e:
+                conn.rollback()
+                delay = transaction_retry_delay(label, e.pgcode, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            finally:
+                cur.close()
+    finally:
+        conn.autocommit = autocommit
+
+
+_DIGIT_RE = re.compile(r"[0-9]")
+_UPPER_RE = re.compile(r"[A-Z]")
+_USERNAME_SPECIAL_RE = re.compile(r"[.\-_]")
+_USERNAME_CHARS_RE = re.compile(r"^[A-Za-z0-9.\-_]+$")
+_PASSWORD_SPECIAL_RE = re.compile(r"[^A-Za-z0-9]")
+
+
 def validate_username(username):
     """
     Validate username:
@@ -60,11 +1092,11 @@ def validate_username(username):
         return False, "Username is required"
     if not (8 <= len(username) <= 15):
         return False, "Username must be 8-15 characters long"
-    if not re.search(r"[0-9]", username):
+    if not _DIGIT_RE.search(username):
         return False, "Username must contain at least one number"
-    if not re.search(r"[.\-_]", username):
+    if not _USERNAME_SPECIAL_RE.search(username):
         return False, "Username must contain at least one special character (., -, _)"
-    if not re.match(r"^[A-Za-z0-9.\-_]+$", username):
+    if not _USERNAME_CHARS_RE.match(username):
         return (
             False,
             "Username can only contain letters, numbers, period, hyphen, and underscore",
@@ -84,11 +1116,11 @@ def validate_password(password):
         return False, "Password is required"
     if len(password) < 8:
         return False, "Password must be at least 8 characters long"
-    if not re.search(r"[A-Z]", password):
+    if not _UPPER_RE.search(password):
         return False, "Password must contain at least one uppercase letter"
-    if not re.search(r"[0-9]", password):
+    if not _DIGIT_RE.search(password):
         return False, "Password must contain at least one number"
-    if not re.search(r"[^A-Za-z0-9]", password):
+    if not _PASSWORD_SPECIAL_RE.search(password):
         return False, "Password must contain at least one special character"
     return True, "Valid password"
 
@@ -98,11 +1130,137 @@ def generate_session_id():
     return secrets.token_urlsafe(32)
 
 
+# --- WRITE VERIFICATION (sampled read-back of /log_video writes) ---
+# Verify 1 in N committed video writes on a background thread (0 disables)
+LOG_VIDEO_VERIFY_SAMPLE = int(os.getenv("LOG_VIDEO_VERIFY_SAMPLE", 0))
+LOG_VIDEO_VERIFY_QUEUE_SIZE = int(os.getenv("LOG_VIDEO_VERIFY_QUEUE_SIZE", 1000))
+
+
+class WriteVerifier:
+    """
+    Re-reads a sample of committed video rows out of band and counts rows that
+    are missing or hold less progress than was written. watched/loop_time are
+    merged with GREATEST, so the stored values must be >= the written ones.
+    """
+
+    def __init__(self, sample_every, queue_size):
+        self.sample_every = sample_every
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._seen = 0
+        self._stats = {
+            "sampled": 0,
+            "verified": 0,
+            "mismatches": 0,
+            "missing": 0,
+            "errors": 0,
+            "dropped": 0,
+        }
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def submit(self, video_db_id, session_started_at, watched, loop_time):
+        """
+        Queue a verification for 1 in sample_every calls; never blocks.
+        session_started_at is the row's partition key, so the read-back
+        touches one videos partition.
+        """
+        if self.sample_every <= 0:
+            return False
+        with self._lock:
+            self._seen += 1
+            if self._seen % self.sample_every:
+                return False
+            self._stats["sampled"] += 1
+            # Threads do not survive fork, so (re)start lazily in each worker
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="write-verifier", daemon=True
+                )
+                self._thread.start()
+        try:
+            self._queue.put_nowait(
+                (video_db_id, session_started_at, watched, loop_time)
+            )
+            return True
+        except queue.Full:
+            self._count("dropped")
+            return False
+
+    def _run(self):
+        while True:
+            video_db_id, session_started_at, watched, loop_time = self._queue.get()
+            try:
+                with db_connection() as conn:
+                    cur = conn.cursor()
+                    cur.execute(
+                        "SELECT watched, loop_time FROM videos WHERE id = %s AND session_started_at = %s",
+                        (video_db_id, session_started_at),
+                    )
+                    row = cur.fetchone()
+                    cur.close()
+                if not row:
+                    self._count("missing")
+                    verify_log.error("Video %s NOT FOUND after commit", video_db_id)
+                elif (row[0] or 0) < watched or (row[1] or 0) < loop_time:
+                    self._count("mismatches")
+                    verify_log.error(
+                        "MISMATCH: Video %s wrote watched=%s, loop_time=%s but DB has watched=%s, loop_time=%s",
+                        video_db_id,
+                        watched,
+                        loop_time,
+                        row[0],
+                        row[1],
+                    )
+                else:
+                    self._count("verified")
+            except Exception as e:
+                self._count("errors")
+                verify_log.warning(
+                    "Verification failed for video %s: %s", video_db_id, e
+                )
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["sample_every"] = self.sample_every
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+
+write_verifier = WriteVerifier(LOG_VIDEO_VERIFY_SAMPLE, LOG_VIDEO_VERIFY_QUEUE_SIZE)
+
+
 @app.route("/", methods=["GET"])
 def home():
     return "BackEnd Running  :)"
 
 
+# --- STATS (pool and runtime counters for monitoring) ---
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    try:
+        return jsonify(
+            {
+                "success": True,
+                "pool": get_pool().stats(),
+                "write_verification": write_verifier.stats(),
+                "video_write_behind": video_write_buffer.stats(),
+                "reference_cache": reference_cache.stats(),
+                "transaction_retries": transaction_retries.stats(),
+                "session_cache": session_cache.stats(),
+                "auto_session": recent_sessions.stats(),
+                "logging": log_handler.stats(),
+                "slow_queries": slow_query_log.stats(),
+            }
+        )
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
 # Handle OPTIONS preflight requests for CORS
 @app.route("/<path:path>", methods=["OPTIONS"])
 def handle_options(path):
@@ -123,7 +1281,7 @@ def register():
     password = data.get("password")
     phone = data.get("phone")
     user_type_id = data.get("userTypeId")
-    print("[REGISTER] Incoming data:", data)
+    log_payload(register_log, "Incoming data:", data)
 
     # Validate input
     if not name or not email or not password or not user_type_id:
@@ -150,7 +1308,7 @@ def register():
         if cur.fetchone():
             cur.close()
             conn.close()
-            print("[REGISTER] Duplicate email:", email)
+            register_log.info("Duplicate email: %s", email)
             return jsonify({"success": False, "error": "Email already exists"}), 409
 
         # Check userTypeId exists
@@ -159,7 +1317,7 @@ def register():
         if not user_type_row:
             cur.close()
             conn.close()
-            print("[REGISTER] Invalid userTypeId:", user_type_id)
+            register_log.info("Invalid userTypeId: %s", user_type_id)
             return jsonify({"success": False, "error": "Invalid userTypeId"}), 400
 
         try:
@@ -172,18 +1330,15 @@ def register():
             )
             user_id = cur.fetchone()[0]
             conn.commit()
-            print(f"[REGISTER] User created: id={user_id}, email={email}")
+            register_log.info("User created: id=%s, email=%s", user_id, email)
         except Exception as insert_err:
-            print(f"[REGISTER] Insert error: {insert_err}")
+            register_log.warning("Insert error: %s", insert_err)
             raise
         cur.close()
         conn.close()
         return jsonify({"success": True, "user_id": user_id})
     except Exception as e:
-        import traceback
-
-        print("[REGISTER] Exception:", str(e))
-        traceback.print_exc()
+        register_log.exception("Registration failed: %s", e)
         return (
             jsonify(
                 {"success": False, "error": "Failed to create user", "detail": str(e)}
@@ -192,240 +1347,558 @@ def register():
         )
 
 
-# --- GET USER TYPES (for registration dropdown) ---
-@app.route("/usertypes", methods=["GET"])
-def get_usertypes():
-    try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT id, name FROM usertypes WHERE active = true")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        user_types = [{"id": row[0], "name": row[1]} for row in rows]
-        return jsonify({"userTypes": user_types})
-    except Exception as e:
+# --- REFERENCE DATA CACHE (usertypes, whitelisted URLs, allowed queues) ---
+# Seconds a cached reference response is served before it is reloaded
+REFERENCE_CACHE_TTL = float(os.getenv("REFERENCE_CACHE_TTL", 300))
+
+
+class ReferenceDataCache:
+    """
+    Process-level cache of small, rarely changing JSON responses.
+    Each entry keeps the serialized body plus an ETag and Last-Modified so
+    clients can revalidate with If-None-Match / If-Modified-Since and get a 304.
+    Last-Modified only moves when a reload actually changes the body.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # _lock only guards the dicts and counters and is never held while
+        # loading; each name has its own load lock so one slow reload doesn't
+        # stall the other names (or the hits)
+        self._lock = threading.Lock()
+        self._load_locks = {}  # name -> Lock
+        self._entries = {}  # name -> dict(body, etag, last_modified, expires)
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "not_modified": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _load_lock(self, name):
+        with self._lock:
+            lock = self._load_locks.get(name)
+            if lock is None:
+                lock = self._load_locks[name] = threading.Lock()
+            return lock
+
+    def get(self, name, loader):
+        entry = self._entries.get(name)
+        if entry is not None and time.monotonic() < entry["expires"]:
+            self._count("hits")
+            return entry
+        load_lock = self._load_lock(name)
+        if not load_lock.acquire(blocking=entry is None):
+            # Another request is reloading this name: serve the expired body
+            self._count("stale")
+            return entry
+        try:
+            entry = self._entries.get(name)
+            if entry is not None and time.monotonic() < entry["expires"]:
+                self._count("hits")
+                return entry
+            self._count("misses")
+            body = json.dumps(loader(), sort_keys=True, separators=(",", ":"))
+            etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+            if entry is not None and entry["etag"] == etag:
+                last_modified = entry["last_modified"]
+            else:
+                last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+            entry = {
+                "body": body,
+                "etag": etag,
+                "last_modified": last_modified,
+                "expires": time.monotonic() + self.ttl,
+            }
+            with self._lock:
+                self._entries[name] = entry
+            return entry
+        finally:
+            load_lock.release()
+
+    def respond(self, name, loader):
+        """Build a (possibly 304) response for the cached entry `name`."""
+        entry = self.get(name, loader)
+        response = app.response_class(entry["body"], mimetype="application/json")
+        response.set_etag(entry["etag"])
+        response.last_modified = entry["last_modified"]
+        # Clients may keep the body but must revalidate (cheap 304) before reuse
+        response.cache_control.no_cache = True
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            self._count("not_modified")
+        return response
+
+    def invalidate(self, name=None):
+        """Expire entries so the next request reloads them (validators survive if unchanged)."""
+        with self._lock:
+            for key, entry in self._entries.items():
+                if name is None or key == name:
+                    entry["expires"] = 0.0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = sorted(self._entries)
+        stats["ttl"] = self.ttl
+        return stats
+
+
+reference_cache = ReferenceDataCache(REFERENCE_CACHE_TTL)
+
+
+@app.route("/reference_data/invalidate", methods=["POST"])
+def invalidate_reference_data():
+    """Drop cached reference data (usertypes, whitelisted URLs, allowed queues)."""
+    name = (request.get_json(silent=True) or {}).get("name")
+    reference_cache.invalidate(name)
+    if name in (None, "allowed_queues"):
+        invalidate_allowed_queues()
+    return jsonify({"success": True, "invalidated": name or "all"})
+
+
+# --- GET USER TYPES (for registration dropdown) ---
+def _load_usertypes():
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT id, name FROM usertypes WHERE active = true")
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    user_types = [{"id": row[0], "name": row[1]} for row in rows]
+    return {"userTypes": user_types}
+
+
+@app.route("/usertypes", methods=["GET"])
+def get_usertypes():
+    try:
+        return reference_cache.respond("usertypes", _load_usertypes)
+    except Exception as e:
         return jsonify({"userTypes": [], "error": str(e)}), 500
 
 
 # --- GET WHITELISTED URLs (for extension runtime filtering) ---
+def _load_whitelisted_urls():
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT id, url FROM whitelisted_urls ORDER BY id")
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    urls = [{"id": row[0], "url": row[1]} for row in rows]
+    return {"success": True, "urls": urls}
+
+
 @app.route("/whitelisted_urls", methods=["GET"])
 def get_whitelisted_urls():
     """Fetch all whitelisted URLs from database for extension to use"""
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT id, url FROM whitelisted_urls ORDER BY id")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        urls = [{"id": row[0], "url": row[1]} for row in rows]
-        return jsonify({"success": True, "urls": urls})
+        return reference_cache.respond("whitelisted_urls", _load_whitelisted_urls)
     except Exception as e:
-        print(f"[WHITELISTED_URLS] Error: {e}")
+        reference_log.exception("Failed to load whitelisted URLs: %s", e)
         return jsonify({"success": False, "urls": [], "error": str(e)}), 500
 
 
 # --- GET ALLOWED QUEUES (for extension queue validation) ---
+def _load_allowed_queues():
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id, queue_id, queue_name, business_type FROM allowed_queues ORDER BY queue_name"
+    )
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    queues = [
+        {
+            "id": row[0],
+            "queue_id": row[1],
+            "queue_name": row[2],
+            "business_type": row[3],
+        }
+        for row in rows
+    ]
+    return {"success": True, "queues": queues}
+
+
 @app.route("/allowed_queues", methods=["GET"])
 def get_allowed_queues():
     """Fetch all allowed queue names from database for extension to use.
     The extension uses this to validate and normalize scraped queue names.
     """
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, queue_id, queue_name, business_type FROM allowed_queues ORDER BY queue_name"
-        )
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        queues = [
-            {
-                "id": row[0],
-                "queue_id": row[1],
-                "queue_name": row[2],
-                "business_type": row[3],
-            }
-            for row in rows
-        ]
-        return jsonify({"success": True, "queues": queues})
+        return reference_cache.respond("allowed_queues", _load_allowed_queues)
     except Exception as e:
-        print(f"[ALLOWED_QUEUES] Error: {e}")
+        reference_log.exception("Failed to load allowed queues: %s", e)
         return jsonify({"success": False, "queues": [], "error": str(e)}), 500
 
 
-# --- LOGIN (create new session for the user, log to UserActivities) ---
-# --- AUTO SESSION (create session based on IP matching, no login required) ---
-@app.route("/auto_session", methods=["POST"])
-def auto_session():
-    print("[AUTO_SESSION] Request received")
+# --- KNOWN SESSION CACHE (skip repeated session existence checks) ---
+# Session ids are immutable random tokens, so "this id exists" can be cached
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", 900))
 
-    try:
-        conn = get_conn()
-        cur = conn.cursor()
 
-        # Get client IP address
-        ip_address = request.headers.get("X-Forwarded-For", request.remote_addr)
-        if ip_address and "," in ip_address:
-            ip_address = ip_address.split(",")[0].strip()
+class SessionCache:
+    """
+    Bounded LRU of session ids known to exist, mapped to their starttime.
+    Entries expire after `ttl` seconds so sessions deleted out of band
+    (e.g. cascading from users) stop being reported as existing.
+    """
 
-        print(f"[AUTO_SESSION] Client IP: {ip_address}")
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # session_id -> (starttime, expires)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, session_id):
+        """Return (True, starttime) for a cached session, else (False, None)."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(session_id)
+                    self._stats["hits"] += 1
+                    return True, entry[0]
+                del self._entries[session_id]
+                self._stats["expired"] += 1
+            self._stats["misses"] += 1
+        return False, None
+
+    def add(self, session_id, starttime):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[session_id] = (starttime, time.monotonic() + self.ttl)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def discard(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else None
+        stats["max_size"] = self.max_size
+        stats["ttl"] = self.ttl
+        return stats
+
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+def _session_starttime(cur, session_id):
+    """
+    Return the session's starttime if it exists, else None (starttime is
+    NOT NULL). Answered from session_cache when possible.
+    """
+    hit, starttime = session_cache.get(session_id)
+    if hit:
+        return starttime
+    cur.execute("SELECT starttime FROM sessions WHERE id = %s", (session_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    session_cache.add(session_id, row[0])
+    return row[0]
 
-        cur.execute(
-            """
-            SELECT id, user_id, ip_address, starttime, created_at 
-            FROM sessions 
-            WHERE ip_address = %s 
-              AND starttime > NOW() - INTERVAL '5 seconds'
-            ORDER BY starttime DESC 
-            LIMIT 1
-            """,
-            (ip_address,),
-        )
-        existing_session = cur.fetchone()
-
-        if existing_session:
-            # Race condition detected - return the existing recent session
-            existing_session_id = existing_session[0]
-            existing_user_id = existing_session[1]
-
-            # Fetch user name if user_id exists
-            user_name = None
-            if existing_user_id:
-                cur.execute("SELECT name FROM users WHERE id = %s", (existing_user_id,))
-                user_result = cur.fetchone()
-                if user_result:
-                    user_name = user_result[0]
-
-            print(
-                f"[AUTO_SESSION] ⚠️ RACE CONDITION PREVENTED: Returning existing session created {(datetime.now(timezone.utc) - existing_session[3]).total_seconds():.2f}s ago"
-            )
-            print(
-                f"[AUTO_SESSION] Reusing session_id={existing_session_id}, user_id={existing_user_id}, user_name={user_name}, ip={ip_address}"
-            )
 
-            cur.close()
-            conn.close()
+# --- AUTO SESSION SINGLE-FLIGHT (coalesce bursts of calls from one client) ---
+# A session started from the same IP this recently is reused instead of creating another
+AUTO_SESSION_REUSE_SECONDS = float(os.getenv("AUTO_SESSION_REUSE_SECONDS", 5))
 
-            return jsonify(
-                {
-                    "success": True,
-                    "session_id": existing_session_id,
-                    "user_id": existing_user_id,
-                    "user_name": user_name,  # NEW: Return user name
-                    "ip_address": ip_address,
-                    "reused": True,  # Flag to indicate this was a race condition prevention
-                }
-            )
 
-        # No recent session found - safe to create new one
-        print(f"[AUTO_SESSION] No recent session found, creating new session")
+class SingleFlight:
+    """
+    Per-key call coalescing: while a call for a key is in flight, later
+    callers with the same key wait for it and share its result (or error)
+    instead of doing the work again.
+    """
 
-        # Try to find user_id from user_device_mappings using IP
-        cur.execute(
-            "SELECT user_id FROM user_device_mappings WHERE ip_address = %s LIMIT 1",
-            (ip_address,),
-        )
-        result = cur.fetchone()
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> {"done": Event, "result": ..., "error": ...}
+
+    def do(self, key, fn):
+        """Return (fn's result, shared) where shared is True for waiters."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"], True
+        try:
+            call["result"] = fn()
+            return call["result"], False
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class RecentSessions:
+    """Sessions started in the last AUTO_SESSION_REUSE_SECONDS, by client IP."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # ip -> (session dict, expires)
+        self._stats = {
+            "created": 0,
+            "reused_recent": 0,
+            "reused_db": 0,
+            "coalesced": 0,
+        }
 
-        user_id = None
-        user_name = None
-        if result:
-            user_id = result[0]
-            print(
-                f"[AUTO_SESSION] Found matching user_id: {user_id} for IP: {ip_address}"
-            )
+    def count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def get(self, ip_address):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(ip_address)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self._entries[ip_address]
+                return None
+            return entry[0]
+
+    def put(self, ip_address, session):
+        """Remember a session until AUTO_SESSION_REUSE_SECONDS after its start."""
+        age = (datetime.now(timezone.utc) - session["starttime"]).total_seconds()
+        remaining = self.ttl - max(0.0, age)
+        if remaining <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._entries) >= 1024:
+                self._entries = {
+                    ip: entry for ip, entry in self._entries.items() if entry[1] > now
+                }
+            self._entries[ip_address] = (session, now + remaining)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["recent_sessions"] = len(self._entries)
+        stats["in_flight"] = auto_session_flights.in_flight()
+        return stats
+
+
+auto_session_flights = SingleFlight()
+recent_sessions = RecentSessions(AUTO_SESSION_REUSE_SECONDS)
+
+
+# Reuses a session started from the IP within reuse_seconds, otherwise
+# resolves the user and creates the session (one round trip)
+AUTO_SESSION_SQL = """
+    WITH recent AS (
+        SELECT id, user_id, starttime
+        FROM sessions
+        WHERE ip_address = %(ip)s
+          AND starttime > NOW() - make_interval(secs => %(reuse_seconds)s)
+        ORDER BY starttime DESC
+        LIMIT 1
+    ),
+    device AS (
+        SELECT user_id FROM user_device_mappings WHERE ip_address = %(ip)s LIMIT 1
+    ),
+    win AS (
+        SELECT NULLIF(latest.windows_username, '') AS win_username
+        FROM (
+            SELECT windows_username, last_updated
+            FROM stealth_sessions
+            WHERE ip_address = %(ip)s
+            ORDER BY last_updated DESC
+            LIMIT 1
+        ) latest
+        WHERE latest.last_updated > NOW() - INTERVAL '5 minutes'
+    ),
+    resolved AS (
+        SELECT
+            COALESCE(
+                (SELECT user_id FROM device),
+                (
+                    SELECT w.user_id FROM windows_username_mappings w
+                    WHERE w.windows_username = (SELECT win_username FROM win)
+                    LIMIT 1
+                )
+            ) AS user_id,
+            (SELECT u.name FROM users u WHERE u.id = (SELECT user_id FROM device)) AS user_name,
+            (SELECT win_username FROM win) AS win_username
+    ),
+    inserted AS (
+        INSERT INTO sessions (id, user_id, starttime, ip_address, win_username)
+        SELECT %(session_id)s, r.user_id, %(starttime)s, %(ip)s, r.win_username
+        FROM resolved r
+        WHERE NOT EXISTS (SELECT 1 FROM recent)
+        RETURNING id, user_id, starttime
+    ),
+    activity AS (
+        INSERT INTO useractivities (userid, activitytype, timestamp, created_at, updated_at)
+        SELECT user_id, 'auto_session_start', starttime, starttime, starttime
+        FROM inserted
+        WHERE user_id IS NOT NULL
+    )
+    SELECT false, i.id, i.user_id, r.user_name, r.win_username, i.starttime
+    FROM inserted i, resolved r
+    UNION ALL
+    SELECT true, rc.id, rc.user_id, u.name, NULL, rc.starttime
+    FROM recent rc LEFT JOIN users u ON u.id = rc.user_id
+"""
+
+
+def _auto_session_params(ip_address):
+    return {
+        "ip": ip_address,
+        "session_id": generate_session_id(),
+        "starttime": datetime.now(timezone.utc),
+        "reuse_seconds": AUTO_SESSION_REUSE_SECONDS,
+    }
 
-            # Fetch user name from users table
-            cur.execute("SELECT name FROM users WHERE id = %s", (user_id,))
-            user_result = cur.fetchone()
-            if user_result:
-                user_name = user_result[0]
-                print(f"[AUTO_SESSION] User name: {user_name}")
-        else:
-            print(
-                f"[AUTO_SESSION] No matching user found for IP: {ip_address}, creating session with NULL user_id"
-            )
 
-        # Generate session
-        session_id = generate_session_id()
-        starttime = datetime.now(timezone.utc)
+def _remember_auto_session(ip_address, row):
+    """Turn an AUTO_SESSION_SQL row into a session dict and cache it."""
+    reused, session_id, user_id, user_name, win_username, starttime = row
+    session = {
+        "reused": reused,
+        "session_id": session_id,
+        "user_id": user_id,
+        "user_name": user_name,
+        "win_username": win_username,
+        "starttime": starttime,
+    }
+    session_cache.add(session["session_id"], session["starttime"])
+    recent_sessions.put(ip_address, session)
+    return session
 
-        # Try to get recent windows_username from stealth_sessions
-        def get_recent_windows_username(ip_address, minutes=5):
-            cur2 = conn.cursor()
-            cur2.execute(
-                """
-                SELECT windows_username, last_updated
-                FROM stealth_sessions
-                WHERE ip_address = %s
-                ORDER BY last_updated DESC
-                LIMIT 1
-                """,
-                (ip_address,),
-            )
-            row = cur2.fetchone()
-            cur2.close()
-            if row:
-                win_username, last_updated = row
-                now = datetime.now(timezone.utc)
-                if last_updated and (now - last_updated).total_seconds() < minutes * 60:
-                    return win_username
-            return None
 
-        win_username = get_recent_windows_username(ip_address)
-        if not win_username:
-            win_username = None
+def _start_session_for_ip(ip_address):
+    """
+    Reuse a session created from this IP in the last AUTO_SESSION_REUSE_SECONDS
+    (possibly by another worker process), otherwise resolve the user (device
+    mapping by IP, else the windows username of the latest stealth session
+    seen within 5 minutes) and create the session, all in one round trip.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(AUTO_SESSION_SQL, _auto_session_params(ip_address))
+        row = cur.fetchone()
+        cur.close()
+    return _remember_auto_session(ip_address, row)
+
 
-        # If win_username is present and user_id is None, try to map user_id from windows_username_mappings
-        if win_username and not user_id:
-            cur.execute(
-                "SELECT user_id FROM windows_username_mappings WHERE windows_username = %s LIMIT 1",
-                (win_username,),
-            )
-            mapping_row = cur.fetchone()
-            if mapping_row:
-                user_id = mapping_row[0]
+def _client_ip(forwarded_for, remote_addr):
+    """First X-Forwarded-For hop, else the peer address."""
+    ip_address = forwarded_for or remote_addr
+    if ip_address and "," in ip_address:
+        ip_address = ip_address.split(",")[0].strip()
+    return ip_address
 
-        # Insert session (user_id can be NULL)
-        cur.execute(
-            "INSERT INTO sessions (id, user_id, starttime, ip_address, win_username) VALUES (%s, %s, %s, %s, %s)",
-            (session_id, user_id, starttime, ip_address, win_username),
+
+def _count_auto_session(session, shared):
+    """Record how a single-flight result was obtained; True if it was reused."""
+    if shared:
+        recent_sessions.count("coalesced")
+    elif session["reused"]:
+        recent_sessions.count("reused_db")
+    else:
+        recent_sessions.count("created")
+    return shared or session["reused"]
+
+
+def _auto_session_response(session, reused, ip_address):
+    session_id = session["session_id"]
+    user_id = session["user_id"]
+    user_name = session["user_name"]
+    if reused:
+        # Race condition detected - return the existing recent session
+        auto_session_log.info(
+            "Reusing session_id=%s created %.2fs ago, user_id=%s, user_name=%s, ip=%s",
+            session_id,
+            (datetime.now(timezone.utc) - session["starttime"]).total_seconds(),
+            user_id,
+            user_name,
+            ip_address,
         )
+        return {
+            "success": True,
+            "session_id": session_id,
+            "user_id": user_id,
+            "user_name": user_name,  # NEW: Return user name
+            "ip_address": ip_address,
+            "reused": True,  # Flag to indicate this was a race condition prevention
+        }
 
-        # Log activity if user_id is found
-        if user_id:
-            cur.execute(
-                "INSERT INTO useractivities (userid, activitytype, timestamp, created_at, updated_at) VALUES (%s, %s, %s, %s, %s)",
-                (user_id, "auto_session_start", starttime, starttime, starttime),
-            )
+    win_username = session["win_username"]
+    auto_session_log.info(
+        "New session created: session_id=%s, user_id=%s, user_name=%s, ip=%s, win_username=%s",
+        session_id,
+        user_id,
+        user_name,
+        ip_address,
+        win_username,
+    )
+    return {
+        "success": True,
+        "session_id": session_id,
+        "user_id": user_id,
+        "user_name": user_name,  # NEW: Return user name
+        "ip_address": ip_address,
+        "win_username": win_username,
+        "reused": False,  # Flag to indicate this was a new session
+    }
 
-        conn.commit()
-        cur.close()
-        conn.close()
 
-        print(
-            f"[AUTO_SESSION] ✓ NEW SESSION CREATED: session_id={session_id}, user_id={user_id}, user_name={user_name}, ip={ip_address}, win_username={win_username}"
-        )
-        return jsonify(
-            {
-                "success": True,
-                "session_id": session_id,
-                "user_id": user_id,
-                "user_name": user_name,  # NEW: Return user name
-                "ip_address": ip_address,
-                "win_username": win_username,
-                "reused": False,  # Flag to indicate this was a new session
-            }
+# --- LOGIN (create new session for the user, log to UserActivities) ---
+# --- AUTO SESSION (create session based on IP matching, no login required) ---
+@app.route("/auto_session", methods=["POST"])
+def auto_session():
+    try:
+        # Get client IP address
+        ip_address = _client_ip(
+            request.headers.get("X-Forwarded-For"), request.remote_addr
         )
 
-    except Exception as e:
-        import traceback
+        auto_session_log.debug("Client IP: %s", ip_address)
 
-        print("[AUTO_SESSION] Exception:", str(e))
-        traceback.print_exc()
+        # Bursts from one machine: answer from the recent-session map, or wait
+        # for the call already creating a session for this IP and share it
+        session = recent_sessions.get(ip_address)
+        if session is not None:
+            recent_sessions.count("reused_recent")
+            reused = True
+        else:
+            session, shared = auto_session_flights.do(
+                ip_address, lambda: _start_session_for_ip(ip_address)
+            )
+            reused = _count_auto_session(session, shared)
+        return jsonify(_auto_session_response(session, reused, ip_address))
+
+    except Exception as e:
+        auto_session_log.exception("Auto session failed: %s", e)
         return (
             jsonify(
                 {"success": False, "error": "Auto session failed", "detail": str(e)}
@@ -471,6 +1944,7 @@ def end_session():
             "UPDATE sessions SET endtime = %s, duration = %s WHERE id = %s",
             (endtime, duration, session_id),
         )
+        session_cache.discard(session_id)
 
         # Log activity only if user_id exists
         if user_id:
@@ -500,20 +1974,12 @@ def end_session():
         )
 
 
-# --- LOG VIDEO (merge keys + speeds instead of overwrite, add loopTime) ---
-@app.route("/log_video", methods=["POST"])
-def log_video():
-    print("=" * 80)
-    print("[LOG_VIDEO] REQUEST RECEIVED!")
-    print("=" * 80)
-    data = request.json
-    print(f"[LOG_VIDEO] Incoming data: {data}")
-    session_id = data.get("session_id")
-
-    if not session_id:
-        print("[LOG_VIDEO] ERROR: Missing session_id")
-        return jsonify({"success": False, "error": "Missing session_id"}), 400
-
+# --- LOG VIDEO HELPERS (shared by /log_video and /log_video/batch) ---
+def _parse_video_event(data):
+    """
+    Normalize a /log_video payload into the values written to the database.
+    Raises ValueError/TypeError if duration, watched or loopTime are not numeric.
+    """
     keys = data.get("keys")
     if keys is None:
         keys = []
@@ -527,62 +1993,219 @@ def log_video():
 
     # Get sound muted state as simple boolean (yes/no)
     sound_muted = data.get("soundMuted", False)  # Default to False (not muted)
-    # Convert to "yes" if muted, "no" if not muted
-    sound_muted_status = "yes" if sound_muted else "no"
 
-    video_id = data.get("videoId")
-    duration = float(data.get("duration", 0))
-    watched = int(data.get("watched", 0))
-    loop_time = int(data.get("loopTime", 0))  # <-- NEW
-    status = data.get("status", "Not Watched")
+    return {
+        "session_id": data.get("session_id"),
+        "video_id": data.get("videoId"),
+        "duration": float(data.get("duration", 0)),
+        "watched": int(data.get("watched", 0)),
+        "loop_time": int(data.get("loopTime", 0)),
+        "status": data.get("status", "Not Watched"),
+        # Convert to "yes" if muted, "no" if not muted
+        "sound_muted": "yes" if sound_muted else "no",
+        "keys": keys,
+        "speeds": speeds,
+    }
+
+
+def _parse_speed(value):
+    """Convert speed values like "1x", "1.5x" or 2 to float; unparseable values become 1.0."""
+    try:
+        if isinstance(value, str):
+            return float(value.replace("x", "").replace("X", ""))
+        return float(value)
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def _key_param(key):
+    """Keys are stored as VARCHAR; bind non-NULL keys as text so arrays stay homogeneous."""
+    return None if key is None else str(key)
+
+
+# Statements shared by the Flask routes and the ASGI entry point (asgi_app.py).
+# videos is partitioned, so RETURNING cannot read xmax: a row is new when its
+# created_at is this transaction's NOW() (each key is upserted once per
+# transaction).
+VIDEO_UPSERT_SQL = """
+    INSERT INTO videos (session_id, session_started_at, video_id, duration, watched, loop_time, status, sound_muted)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (session_id, video_id, session_started_at)
+    DO UPDATE SET
+        duration = EXCLUDED.duration,
+        watched = GREATEST(videos.watched, EXCLUDED.watched),
+        loop_time = GREATEST(videos.loop_time, EXCLUDED.loop_time),
+        status = EXCLUDED.status,
+        sound_muted = EXCLUDED.sound_muted
+    RETURNING id, (created_at = NOW()) AS is_new_video
+"""
+VIDEO_KEYS_INSERT_SQL = "INSERT INTO video_keys (video_id, session_started_at, key_value) SELECT * FROM unnest(%s::int[], %s::timestamptz[], %s::varchar[]) ON CONFLICT (video_id, key_value, session_started_at) DO NOTHING"
+VIDEO_SPEEDS_INSERT_SQL = "INSERT INTO video_speeds (video_id, session_started_at, speed_value) SELECT * FROM unnest(%s::int[], %s::timestamptz[], %s::numeric[]) ON CONFLICT (video_id, speed_value, session_started_at) DO NOTHING"
+# Assign keys to the session's other videos that have a NULL key (or no key
+# row at all): the NULL-key rows are deleted and the (video x key) cross
+# product inserted in the same CTE. Every predicate carries
+# session_started_at so only the session's monthly partition is touched.
+RETROACTIVE_KEYS_SQL = """
+    WITH targets AS (
+        SELECT v.id, v.session_started_at
+        FROM videos v
+        WHERE v.session_id = %(session_id)s
+          AND v.session_started_at = %(started)s
+          AND v.id <> %(vid)s
+          AND (
+              EXISTS (
+                  SELECT 1 FROM video_keys vk
+                  WHERE vk.video_id = v.id AND vk.session_started_at = %(started)s
+                    AND vk.key_value IS NULL
+              )
+              OR NOT EXISTS (
+                  SELECT 1 FROM video_keys vk
+                  WHERE vk.video_id = v.id AND vk.session_started_at = %(started)s
+              )
+          )
+    ),
+    cleared AS (
+        DELETE FROM video_keys vk
+        USING targets t
+        WHERE vk.video_id = t.id AND vk.session_started_at = %(started)s
+          AND vk.key_value IS NULL
+    )
+    INSERT INTO video_keys (video_id, session_started_at, key_value)
+    SELECT t.id, t.session_started_at, k.key_value
+    FROM targets t CROSS JOIN unnest(%(keys)s::varchar[]) AS k(key_value)
+    ON CONFLICT (video_id, key_value, session_started_at) DO NOTHING
+"""
+
+
+def _video_upsert_params(event):
+    return (
+        event["session_id"],
+        event["session_started_at"],
+        event["video_id"],
+        event["duration"],
+        event["watched"],
+        event["loop_time"],
+        event["status"],
+        event["sound_muted"],
+    )
+
+
+def _video_keys_params(video_ids, started, key_values):
+    return (list(video_ids), list(started), [_key_param(k) for k in key_values])
+
+
+def _video_speeds_params(video_ids, started, speed_values):
+    return (list(video_ids), list(started), list(speed_values))
+
+
+def _retroactive_keys_params(session_id, started, vid, keys):
+    return {
+        "session_id": session_id,
+        "started": started,
+        "vid": vid,
+        "keys": [_key_param(k) for k in keys],
+    }
+
+
+def _video_response_entry(event, speeds):
+    return {
+        "videoId": event["video_id"],
+        "duration": event["duration"],
+        "watched": event["watched"],
+        "loopTime": event["loop_time"],
+        "status": event["status"],
+        "keys": event["keys"],
+        "speeds": speeds,
+        "soundMuted": event["sound_muted"],
+    }
+
+
+def _insert_video_keys(cur, video_ids, started, key_values):
+    """
+    Insert (video_id, key_value) pairs with a single multi-row statement;
+    started holds each video's session_started_at (its partition key).
+    """
+    cur.execute(
+        VIDEO_KEYS_INSERT_SQL, _video_keys_params(video_ids, started, key_values)
+    )
+
+
+def _insert_video_speeds(cur, video_ids, started, speed_values):
+    """Insert (video_id, speed_value) pairs with a single multi-row statement."""
+    cur.execute(
+        VIDEO_SPEEDS_INSERT_SQL, _video_speeds_params(video_ids, started, speed_values)
+    )
+
+
+def _assign_keys_retroactively(cur, session_id, started, vid, keys):
+    """
+    Assign keys to all other videos in this session that have a NULL key (or no
+    key row at all), in one statement (RETROACTIVE_KEYS_SQL).
+    """
+    cur.execute(
+        RETROACTIVE_KEYS_SQL, _retroactive_keys_params(session_id, started, vid, keys)
+    )
+
+
+# --- LOG VIDEO (merge keys + speeds instead of overwrite, add loopTime) ---
+@app.route("/log_video", methods=["POST"])
+def log_video():
+    data = request.json
+    log_payload(video_log, "Incoming data:", data)
+    session_id = data.get("session_id")
+
+    if not session_id:
+        video_log.info("Missing session_id")
+        return jsonify({"success": False, "error": "Missing session_id"}), 400
+
+    event = _parse_video_event(data)
+    keys = event["keys"]
+    speeds = event["speeds"]
+    video_id = event["video_id"]
+    watched = event["watched"]
+    loop_time = event["loop_time"]
+    status = event["status"]
+    # Parse "1.5x"-style speeds once; unparseable values fall back to 1.0
+    speed_values = sorted({_parse_speed(sp) for sp in speeds or [1.0]})
 
     try:
         conn = get_conn()
         cur = conn.cursor()  # Use regular cursor instead of DictCursor
 
-        # confirm session exists
-        cur.execute("SELECT id FROM sessions WHERE id = %s", (session_id,))
-        if not cur.fetchone():
+        # confirm session exists; its start time is the videos partition key
+        started = _session_starttime(cur, session_id)
+        if started is None:
             cur.close()
             conn.close()
             return jsonify({"success": False, "error": "Session not found"}), 404
+        event["session_started_at"] = started
+
+        # Write-behind mode: merge into the pending buffer and return immediately
+        if video_write_buffer.submit(event):
+            cur.close()
+            conn.close()
+            video_entry = _video_response_entry(event, speeds or [1.0])
+            return jsonify({"success": True, "video": video_entry, "buffered": True})
 
         # Log incoming data for debugging
-        print(
-            f"[LOG_VIDEO] video_id: {video_id[:50]}..., watched: {watched}, loop_time: {loop_time}, status: {status}, speeds: {speeds}"
+        video_log.debug(
+            "video_id: %.50s, watched: %s, loop_time: %s, status: %s, speeds: %s",
+            video_id,
+            watched,
+            loop_time,
+            status,
+            speeds,
         )
 
         # Use UPSERT to avoid race conditions
         # Track if this is a new video insert or an update
         # Only update watched/loop_time if new values are greater (accumulate)
-        cur.execute(
-            """
-            INSERT INTO videos (session_id, video_id, duration, watched, loop_time, status, sound_muted)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (session_id, video_id) 
-            DO UPDATE SET 
-                duration = EXCLUDED.duration,
-                watched = GREATEST(videos.watched, EXCLUDED.watched),
-                loop_time = GREATEST(videos.loop_time, EXCLUDED.loop_time),
-                status = EXCLUDED.status,
-                sound_muted = EXCLUDED.sound_muted
-            RETURNING id, (xmax = 0) AS is_new_video
-            """,
-            (
-                session_id,
-                video_id,
-                duration,
-                watched,
-                loop_time,
-                status,
-                sound_muted_status,
-            ),
-        )
+        cur.execute(VIDEO_UPSERT_SQL, _video_upsert_params(event))
         result = cur.fetchone()
         vid = result[0]
         is_new_video = result[1]
 
-        print(f"[LOG_VIDEO] Inserted/Updated video_id={vid}, is_new={is_new_video}")
+        video_log.debug("Inserted/Updated video_id=%s, is_new=%s", vid, is_new_video)
 
         # If this is a new video, increment total_videos_watched
         if is_new_video:
@@ -591,123 +2214,50 @@ def log_video():
                 (session_id,),
             )
 
-        # Insert keys (if empty list, insert NULL)
-        if not keys or len(keys) == 0:
-            try:
-                cur.execute(
-                    "INSERT INTO video_keys (video_id, key_value) VALUES (%s, %s) ON CONFLICT (video_id, key_value) DO NOTHING",
-                    (vid, None),
-                )
-            except Exception:
-                pass
-        else:
-            for k in keys:
-                try:
-                    cur.execute(
-                        "INSERT INTO video_keys (video_id, key_value) VALUES (%s, %s) ON CONFLICT (video_id, key_value) DO NOTHING",
-                        (vid, k),
-                    )
-                except Exception:
-                    # ignore individual key insert errors
-                    pass
+        # Insert keys in one statement (if empty list, insert NULL)
+        try:
+            _insert_video_keys(
+                cur,
+                [vid] * max(len(keys), 1),
+                [started] * max(len(keys), 1),
+                keys or [None],
+            )
+        except Exception as e:
+            video_log.warning("Key insert failed: %s", e)
+        if keys:
             # --- RETROACTIVE KEY ASSIGNMENT ---
             # Assign this key to all previous videos in this session that have NULL key
             try:
-                cur.execute(
-                    "SELECT v.id FROM videos v "
-                    "LEFT JOIN video_keys vk ON v.id = vk.video_id "
-                    "WHERE v.session_id = %s AND v.id <> %s AND vk.key_value IS NULL",
-                    (session_id, vid),
-                )
-                prev_rows = cur.fetchall()
-                for prev_row in prev_rows:
-                    prev_vid = prev_row[0]
-                    for k in keys:
-                        # Remove NULL key if present
-                        cur.execute(
-                            "DELETE FROM video_keys WHERE video_id = %s AND key_value IS NULL",
-                            (prev_vid,),
-                        )
-                        # Insert the new key
-                        cur.execute(
-                            "INSERT INTO video_keys (video_id, key_value) VALUES (%s, %s) ON CONFLICT (video_id, key_value) DO NOTHING",
-                            (prev_vid, k),
-                        )
+                _assign_keys_retroactively(cur, session_id, started, vid, keys)
             except Exception as e:
-                print(f"[LOG_VIDEO]  Retroactive key assignment failed: {e}")
+                video_log.warning("Retroactive key assignment failed: %s", e)
 
-        # Insert speeds (always insert at least one default speed)
+        # Insert speeds in one statement (always at least the default speed)
         if not speeds or len(speeds) == 0:
             speeds = [1.0]  # Default speed
-
-        for s in speeds:
-            try:
-                # Convert speed string like "1x", "1.5x" to float
-                if isinstance(s, str):
-                    speed_val = float(s.replace("x", "").replace("X", ""))
-                else:
-                    speed_val = float(s)
-
-                cur.execute(
-                    "INSERT INTO video_speeds (video_id, speed_value) VALUES (%s, %s) ON CONFLICT (video_id, speed_value) DO NOTHING",
-                    (vid, speed_val),
-                )
-            except Exception as e:
-                # Insert default 1.0 if conversion fails
-                try:
-                    cur.execute(
-                        "INSERT INTO video_speeds (video_id, speed_value) VALUES (%s, %s) ON CONFLICT (video_id, speed_value) DO NOTHING",
-                        (vid, 1.0),
-                    )
-                except Exception:
-                    pass
+        try:
+            _insert_video_speeds(
+                cur,
+                [vid] * len(speed_values),
+                [started] * len(speed_values),
+                speed_values,
+            )
+        except Exception as e:
+            video_log.warning("Speed insert failed: %s", e)
 
         conn.commit()
-        print(f"[LOG_VIDEO]  COMMIT SUCCESSFUL for video_id={vid}")
 
         cur.close()
         conn.close()
 
-        # VERIFICATION: Use NEW connection to check if video persists
-        try:
-            import time
+        # Optional sampled read-back, done on a background worker
+        write_verifier.submit(vid, started, watched, loop_time)
 
-            time.sleep(0.5)  # Wait 500ms for consistency
-            verify_conn = get_conn()
-            verification_cur = verify_conn.cursor()
-            verification_cur.execute(
-                "SELECT watched, loop_time FROM videos WHERE id = %s", (vid,)
-            )
-            verify_result = verification_cur.fetchone()
-            if verify_result:
-                print(
-                    f"[LOG_VIDEO]  VERIFIED: Video {vid} exists in DB with watched={verify_result[0]}, loop_time={verify_result[1]}"
-                )
-            else:
-                print(f"[LOG_VIDEO]  ERROR: Video {vid} NOT FOUND after commit!")
-            verification_cur.close()
-            verify_conn.close()
-        except Exception as ve:
-            print(f"[LOG_VIDEO]  Verification failed: {ve}")
-
-        video_entry = {
-            "videoId": video_id,
-            "duration": duration,
-            "watched": watched,
-            "loopTime": loop_time,
-            "status": status,
-            "keys": keys,
-            "speeds": speeds,
-            "soundMuted": sound_muted_status,
-        }
-        print(f"[LOG_VIDEO]  FUNCTION COMPLETING SUCCESSFULLY for video_id={vid}")
+        video_entry = _video_response_entry(event, speeds)
+        video_log.debug("Committed video_id=%s", vid)
         return jsonify({"success": True, "video": video_entry})
     except Exception as e:
-        print(f"[LOG_VIDEO]  EXCEPTION OCCURRED: {str(e)}")
-        print(f"[LOG_VIDEO] Exception type: {type(e).__name__}")
-        import traceback
-
-        traceback.print_exc()
+        video_log.exception("Failed to log video: %s", e)
         try:
             if "conn" in locals():
                 conn.rollback()
@@ -722,33 +2272,490 @@ def log_video():
         )
 
 
-# --- LOG INACTIVITY (push inactivity events into session) ---
-@app.route("/log_inactivity", methods=["POST"])
-def log_inactivity():
-    data = request.json
-    session_id = data.get("session_id")
-    if not session_id:
-        return jsonify({"success": False, "error": "Missing session_id"}), 400
+# --- LOG VIDEO BATCH (many heartbeats, possibly across sessions, one transaction) ---
+LOG_VIDEO_BATCH_MAX = int(os.getenv("LOG_VIDEO_BATCH_MAX", 500))
 
-    # Session ID is now a string, no need to convert to ObjectId
 
-    inactivity_entry = {
-        "starttime": data.get("starttime"),
-        "endtime": data.get("endtime"),
-        "duration": data.get("duration"),
-        "type": data.get("type"),
+def _merge_video_event(merged, event):
+    """
+    Merge one event into merged[(session_id, video_id)] using the same rules as
+    the videos upsert: GREATEST for watched/loop_time, last write wins for
+    duration/status/sound_muted. Keys and speeds are unioned in order.
+    Returns True if the event was coalesced into an existing row.
+    """
+    key = (event["session_id"], event["video_id"])
+    row = merged.get(key)
+    if row is None:
+        merged[key] = dict(
+            event, keys=list(event["keys"]), speeds=list(event["speeds"])
+        )
+        return False
+    row["duration"] = event["duration"]
+    row["watched"] = max(row["watched"], event["watched"])
+    row["loop_time"] = max(row["loop_time"], event["loop_time"])
+    row["status"] = event["status"]
+    row["sound_muted"] = event["sound_muted"]
+    row["keys"].extend(k for k in event["keys"] if k not in row["keys"])
+    row["speeds"].extend(sp for sp in event["speeds"] if sp not in row["speeds"])
+    return True
+
+
+def _merge_video_events(events):
+    """Collapse events per (session_id, video_id); merged rows in first-seen order."""
+    merged = {}
+    for event in events:
+        _merge_video_event(merged, event)
+    return list(merged.values())
+
+
+def _write_video_rows(cur, rows):
+    """
+    Apply merged video rows with set-based statements: one multi-row upsert into
+    videos, one sessions counter update, one insert each for video_keys and
+    video_speeds, then retroactive key assignment per keyed video.
+    Returns {(session_id, video_id): (videos.id, is_new_video)}.
+    """
+    if not rows:
+        return {}
+
+    cur.execute(
+        """
+        INSERT INTO videos (session_id, session_started_at, video_id, duration, watched, loop_time, status, sound_muted)
+        SELECT * FROM unnest(%s::varchar[], %s::timestamptz[], %s::varchar[], %s::numeric[], %s::int[], %s::int[], %s::varchar[], %s::varchar[])
+        ON CONFLICT (session_id, video_id, session_started_at)
+        DO UPDATE SET
+            duration = EXCLUDED.duration,
+            watched = GREATEST(videos.watched, EXCLUDED.watched),
+            loop_time = GREATEST(videos.loop_time, EXCLUDED.loop_time),
+            status = EXCLUDED.status,
+            sound_muted = EXCLUDED.sound_muted
+        RETURNING id, session_id, video_id, (created_at = NOW()) AS is_new_video
+        """,
+        (
+            [r["session_id"] for r in rows],
+            [r["session_started_at"] for r in rows],
+            [r["video_id"] for r in rows],
+            [r["duration"] for r in rows],
+            [r["watched"] for r in rows],
+            [r["loop_time"] for r in rows],
+            [r["status"] for r in rows],
+            [r["sound_muted"] for r in rows],
+        ),
+    )
+    written = {
+        (sid, video_id): (vid, is_new) for vid, sid, video_id, is_new in cur.fetchall()
     }
 
-    try:
-        conn = get_conn()
-        cur = conn.cursor()
-        # ensure session exists
-        cur.execute("SELECT id, starttime FROM sessions WHERE id = %s", (session_id,))
-        srow = cur.fetchone()
-        if not srow:
-            cur.close()
-            conn.close()
-            return jsonify({"success": False, "error": "Session not found"}), 404
+    # One increment per newly inserted video, grouped by session
+    new_per_session = {}
+    for (sid, _), (_, is_new) in written.items():
+        if is_new:
+            new_per_session[sid] = new_per_session.get(sid, 0) + 1
+    if new_per_session:
+        cur.execute(
+            """
+            UPDATE sessions s SET total_videos_watched = s.total_videos_watched + d.n
+            FROM unnest(%s::varchar[], %s::int[]) AS d(id, n)
+            WHERE s.id = d.id
+            """,
+            (list(new_per_session.keys()), list(new_per_session.values())),
+        )
+
+    # Keys (a video without keys gets a NULL key) and speeds (default 1.0)
+    key_vids, key_started, key_values = [], [], []
+    speed_vids, speed_started, speed_values = [], [], []
+    for r in rows:
+        vid = written[(r["session_id"], r["video_id"])][0]
+        for k in r["keys"] or [None]:
+            key_vids.append(vid)
+            key_started.append(r["session_started_at"])
+            key_values.append(k)
+        for speed_val in {_parse_speed(sp) for sp in r["speeds"] or [1.0]}:
+            speed_vids.append(vid)
+            speed_started.append(r["session_started_at"])
+            speed_values.append(speed_val)
+    _insert_video_keys(cur, key_vids, key_started, key_values)
+    _insert_video_speeds(cur, speed_vids, speed_started, speed_values)
+
+    # Keys seen in the batch are applied to every NULL-key video of the session,
+    # including keyless videos from the same batch
+    for r in rows:
+        if r["keys"]:
+            vid = written[(r["session_id"], r["video_id"])][0]
+            _assign_keys_retroactively(
+                cur, r["session_id"], r["session_started_at"], vid, r["keys"]
+            )
+
+    return written
+
+
+@app.route("/log_video/batch", methods=["POST"])
+def log_video_batch():
+    """
+    Apply many /log_video events in one transaction.
+    Body: {"videos": [<log_video payload>, ...], "session_id": <optional default>}
+    Returns one result per input item, in order.
+    """
+    data = request.json or {}
+    items = data.get("videos")
+    if not items or not isinstance(items, list):
+        return jsonify({"success": False, "error": "videos list required"}), 400
+    if len(items) > LOG_VIDEO_BATCH_MAX:
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": f"At most {LOG_VIDEO_BATCH_MAX} videos per batch",
+                }
+            ),
+            400,
+        )
+    default_session_id = data.get("session_id")
+    video_batch_log.debug("Received %s events", len(items))
+
+    results = [None] * len(items)
+    parsed = []  # (index, event)
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"index": i, "success": False, "error": "invalid item"}
+            continue
+        if default_session_id and not item.get("session_id"):
+            item = dict(item, session_id=default_session_id)
+        try:
+            event = _parse_video_event(item)
+        except (TypeError, ValueError):
+            results[i] = {
+                "index": i,
+                "videoId": item.get("videoId"),
+                "success": False,
+                "error": "invalid numeric field",
+            }
+            continue
+        if not event["session_id"] or not event["video_id"]:
+            results[i] = {
+                "index": i,
+                "videoId": event["video_id"],
+                "success": False,
+                "error": "missing session_id or videoId",
+            }
+            continue
+        parsed.append((i, event))
+
+    conn = None
+    try:
+        if parsed:
+            conn = get_conn()
+            conn.autocommit = False
+            cur = conn.cursor()
+
+            # Validate every referenced session, querying only for ids not
+            # already in session_cache (one query at most); the start times
+            # are the videos partition key
+            known_sessions = {}
+            unknown = []
+            for session_id in {e["session_id"] for _, e in parsed}:
+                hit, starttime = session_cache.get(session_id)
+                if hit:
+                    known_sessions[session_id] = starttime
+                else:
+                    unknown.append(session_id)
+            if unknown:
+                cur.execute(
+                    "SELECT id, starttime FROM sessions WHERE id = ANY(%s)",
+                    (unknown,),
+                )
+                for row in cur.fetchall():
+                    known_sessions[row[0]] = row[1]
+                    session_cache.add(row[0], row[1])
+            valid = []
+            for i, event in parsed:
+                if event["session_id"] in known_sessions:
+                    event["session_started_at"] = known_sessions[event["session_id"]]
+                    valid.append((i, event))
+                else:
+                    results[i] = {
+                        "index": i,
+                        "videoId": event["video_id"],
+                        "session_id": event["session_id"],
+                        "success": False,
+                        "error": "session not found",
+                    }
+
+            rows = _merge_video_events([e for _, e in valid])
+            written = _write_video_rows(cur, rows)
+            conn.commit()
+            cur.close()
+            conn.close()
+
+            seen = set()
+            for i, event in valid:
+                key = (event["session_id"], event["video_id"])
+                vid, is_new = written[key]
+                # Only the first event for a new video counts as the insert
+                is_new = is_new and key not in seen
+                seen.add(key)
+                results[i] = {
+                    "index": i,
+                    "videoId": event["video_id"],
+                    "session_id": event["session_id"],
+                    "success": True,
+                    "video_db_id": vid,
+                    "is_new": is_new,
+                }
+            for row in rows:
+                vid = written[(row["session_id"], row["video_id"])][0]
+                write_verifier.submit(
+                    vid, row["session_started_at"], row["watched"], row["loop_time"]
+                )
+
+        video_batch_log.info(
+            "Applied %s/%s events",
+            sum(1 for r in results if r["success"]),
+            len(items),
+        )
+        return jsonify({"success": True, "results": results})
+    except Exception as e:
+        video_batch_log.exception("Batch failed: %s", e)
+        try:
+            if conn is not None:
+                conn.rollback()
+                conn.close()
+        except Exception:
+            pass
+        return (
+            jsonify(
+                {"success": False, "error": "Failed to log videos", "detail": str(e)}
+            ),
+            500,
+        )
+
+
+# --- VIDEO WRITE-BEHIND BUFFER (opt-in coalescing of /log_video heartbeats) ---
+VIDEO_WRITE_BEHIND = os.getenv("VIDEO_WRITE_BEHIND", "0").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+# Flush every N milliseconds or as soon as M events are pending, whichever is first
+VIDEO_WRITE_BEHIND_FLUSH_MS = int(os.getenv("VIDEO_WRITE_BEHIND_FLUSH_MS", 500))
+VIDEO_WRITE_BEHIND_FLUSH_EVENTS = int(os.getenv("VIDEO_WRITE_BEHIND_FLUSH_EVENTS", 200))
+# Upper bound on buffered (session_id, video_id) rows; beyond it writes go direct
+VIDEO_WRITE_BEHIND_MAX_PENDING = int(os.getenv("VIDEO_WRITE_BEHIND_MAX_PENDING", 5000))
+
+
+class VideoWriteBuffer:
+    """
+    In-process write-behind buffer for video progress. Heartbeats for the same
+    (session_id, video_id) are merged while pending and flushed in bulk through
+    _write_video_rows by a background thread. Pending rows are flushed on
+    shutdown via atexit.
+    """
+
+    def __init__(self, enabled, flush_ms, flush_events, max_pending):
+        self.enabled = enabled
+        self.flush_interval = flush_ms / 1000.0
+        self.flush_events = max(1, flush_events)
+        self.max_pending = max(1, max_pending)
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._pending_events = 0
+        self._thread = None
+        self._stopping = False
+        self._stats = {
+            "events_submitted": 0,
+            "events_coalesced": 0,
+            "rejected_full": 0,
+            "flushes": 0,
+            "rows_flushed": 0,
+            "rows_failed": 0,
+            "flush_failures": 0,
+            "flush_latency_ms_total": 0.0,
+            "flush_latency_ms_max": 0.0,
+            "flush_latency_ms_last": 0.0,
+        }
+
+    def submit(self, event):
+        """Buffer an event. Returns False when disabled or full (write it directly)."""
+        if not self.enabled:
+            return False
+        with self._cond:
+            if self._stopping:
+                return False
+            key = (event["session_id"], event["video_id"])
+            if key not in self._pending and len(self._pending) >= self.max_pending:
+                self._stats["rejected_full"] += 1
+                self._cond.notify()
+                return False
+            if _merge_video_event(self._pending, event):
+                self._stats["events_coalesced"] += 1
+            self._stats["events_submitted"] += 1
+            self._pending_events += 1
+            # Threads do not survive fork, so (re)start lazily in each worker
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="video-write-behind", daemon=True
+                )
+                self._thread.start()
+            if self._pending_events >= self.flush_events:
+                self._cond.notify()
+        return True
+
+    def _take(self):
+        rows = list(self._pending.values())
+        self._pending = {}
+        self._pending_events = 0
+        return rows
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._pending_events < self.flush_events and not self._stopping:
+                    self._cond.wait(self.flush_interval)
+                if self._stopping:
+                    return
+                rows = self._take()
+            if rows:
+                self._flush(rows)
+
+    def _write(self, rows):
+        with db_connection() as conn:
+            conn.autocommit = False
+            cur = conn.cursor()
+            written = _write_video_rows(cur, rows)
+            conn.commit()
+            cur.close()
+        for row in rows:
+            vid = written[(row["session_id"], row["video_id"])][0]
+            write_verifier.submit(
+                vid, row["session_started_at"], row["watched"], row["loop_time"]
+            )
+
+    def _flush(self, rows):
+        started = time.monotonic()
+        failed = 0
+        try:
+            self._write(rows)
+        except Exception as e:
+            write_behind_log.warning("Bulk flush of %s rows failed: %s", len(rows), e)
+            # Isolate bad rows (e.g. a session deleted meanwhile) so the rest land
+            failed = 0
+            for row in rows:
+                try:
+                    self._write([row])
+                except Exception as row_err:
+                    failed += 1
+                    write_behind_log.error(
+                        "Dropping video %s for session %s: %s",
+                        row["video_id"],
+                        row["session_id"],
+                        row_err,
+                    )
+        elapsed_ms = (time.monotonic() - started) * 1000.0
+        with self._cond:
+            self._stats["flushes"] += 1
+            self._stats["rows_flushed"] += len(rows) - failed
+            self._stats["rows_failed"] += failed
+            if failed:
+                self._stats["flush_failures"] += 1
+            self._stats["flush_latency_ms_total"] += elapsed_ms
+            self._stats["flush_latency_ms_last"] = elapsed_ms
+            self._stats["flush_latency_ms_max"] = max(
+                self._stats["flush_latency_ms_max"], elapsed_ms
+            )
+
+    def flush(self):
+        """Synchronously write everything pending."""
+        with self._cond:
+            rows = self._take()
+        if rows:
+            self._flush(rows)
+
+    def close(self):
+        """Stop the background thread and flush what is left (runs at exit)."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["pending_rows"] = len(self._pending)
+            stats["pending_events"] = self._pending_events
+        stats["enabled"] = self.enabled
+        stats["coalescing_ratio"] = (
+            round(stats["events_submitted"] / stats["rows_flushed"], 3)
+            if stats["rows_flushed"]
+            else None
+        )
+        stats["flush_latency_ms_avg"] = (
+            round(stats["flush_latency_ms_total"] / stats["flushes"], 3)
+            if stats["flushes"]
+            else None
+        )
+        for key in (
+            "flush_latency_ms_total",
+            "flush_latency_ms_max",
+            "flush_latency_ms_last",
+        ):
+            stats[key] = round(stats[key], 3)
+        return stats
+
+
+video_write_buffer = VideoWriteBuffer(
+    VIDEO_WRITE_BEHIND,
+    VIDEO_WRITE_BEHIND_FLUSH_MS,
+    VIDEO_WRITE_BEHIND_FLUSH_EVENTS,
+    VIDEO_WRITE_BEHIND_MAX_PENDING,
+)
+atexit.register(video_write_buffer.close)
+
+
+# --- LOG INACTIVITY (push inactivity events into session) ---
+INACTIVITY_SPLIT_SECONDS = 180
+
+
+def _inactivity_entry(data):
+    return {
+        "starttime": data.get("starttime"),
+        "endtime": data.get("endtime"),
+        "duration": data.get("duration"),
+        "type": data.get("type"),
+    }
+
+
+def _inactivity_splits_session(inactivity_entry):
+    """Inactivity longer than INACTIVITY_SPLIT_SECONDS ends the session and starts a new one."""
+    try:
+        inactivity_duration = float(inactivity_entry.get("duration", 0) or 0)
+    except Exception:
+        inactivity_duration = 0
+    return inactivity_duration > INACTIVITY_SPLIT_SECONDS
+
+
+@app.route("/log_inactivity", methods=["POST"])
+def log_inactivity():
+    data = request.json
+    session_id = data.get("session_id")
+    if not session_id:
+        return jsonify({"success": False, "error": "Missing session_id"}), 400
+
+    # Session ID is now a string, no need to convert to ObjectId
+
+    inactivity_entry = _inactivity_entry(data)
+
+    try:
+        conn = get_conn()
+        cur = conn.cursor()
+        # ensure session exists
+        starttime = _session_starttime(cur, session_id)
+        if starttime is None:
+            cur.close()
+            conn.close()
+            return jsonify({"success": False, "error": "Session not found"}), 404
 
         # Insert inactivity
         cur.execute(
@@ -762,17 +2769,9 @@ def log_inactivity():
             ),
         )
 
-        # Check duration to decide split
-        try:
-            inactivity_duration = float(inactivity_entry.get("duration", 0) or 0)
-        except Exception:
-            inactivity_duration = 0
-
         new_session_id = None
-        if inactivity_duration > 180:
+        if _inactivity_splits_session(inactivity_entry):
             # End current session
-            cur.execute("SELECT starttime FROM sessions WHERE id = %s", (session_id,))
-            starttime = cur.fetchone()[0]
             endtime = datetime.now(timezone.utc)
             duration = None
             if starttime:
@@ -791,6 +2790,9 @@ def log_inactivity():
             )
 
         conn.commit()
+        if new_session_id:
+            session_cache.discard(session_id)
+            session_cache.add(new_session_id, endtime)
         cur.close()
         conn.close()
 
@@ -811,11 +2813,169 @@ def log_inactivity():
         )
 
 
+# --- ALLOWED QUEUE INDEX (cached lookup structure for queue name validation) ---
+# Seconds before the cached allowed_queues index is rebuilt from the database
+ALLOWED_QUEUES_TTL = float(os.getenv("ALLOWED_QUEUES_TTL", 300))
+
+
+class AllowedQueueIndex:
+    """
+    Precomputed lookup over allowed_queues rows (queue_name, business_type, queue_id):
+    - exact: lowercased name -> first (name, queue_id) in table order
+    - prefix: sorted lowercased names of non-COUNTRY rows, searched with bisect
+    """
+
+    def __init__(self, rows):
+        self.size = len(rows)
+        self.exact = {}
+        prefix_rows = []
+        for allowed_name, business_type, allowed_qid in rows:
+            lower = allowed_name.lower()
+            self.exact.setdefault(lower, (allowed_name, allowed_qid))
+            if business_type != "COUNTRY":
+                prefix_rows.append((lower, allowed_name, allowed_qid))
+        prefix_rows.sort(key=lambda r: r[0])
+        self.prefix_keys = [r[0] for r in prefix_rows]
+        self.prefix_rows = prefix_rows
+
+    def prefix_matches(self, prefix_lower, limit=2):
+        """Return up to `limit` rows whose lowercased name starts with prefix_lower."""
+        lo = bisect.bisect_left(self.prefix_keys, prefix_lower)
+        hi = bisect.bisect_left(self.prefix_keys, prefix_lower + "\U0010ffff", lo)
+        return self.prefix_rows[lo : min(hi, lo + limit)], hi - lo
+
+
+# Separators that mark a scraped name as a subqueue ("Brazil-Sub", "brazil_sub")
+_SUBQUEUE_NAME_RE = re.compile(r"[-_/]")
+
+
+def find_matching_queue(queue_name, index):
+    """
+    Find a matching queue name from the allowed list.
+    Returns (is_valid, normalized_name, queue_id):
+    - If exact match found: (True, queue_name)
+    - If SINGLE partial match found: (True, full_allowed_name) - normalize to full name
+    - If MULTIPLE partial matches found: (True, original_queue_name) - keep as-is
+    - If no match: (False, None)
+
+    Simple country names (without dashes) are kept as-is if they match.
+    """
+    if not queue_name:
+        return False, None, None
+
+    input_lower = queue_name.strip().lower()
+
+    # First, check for exact match (case-insensitive); this also covers country entries
+    exact = index.exact.get(input_lower)
+    if exact:
+        return True, exact[0], exact[1]
+
+    # For partial queue names, find all matching full names
+    # The input should be a prefix of the allowed name (country entries are skipped)
+    is_simple_name = not _SUBQUEUE_NAME_RE.search(queue_name)
+    if not is_simple_name:
+        matches, count = index.prefix_matches(input_lower)
+        if count == 1:
+            # Single match - normalize to the full name
+            queues_log.debug(
+                "Single match found: '%s' -> '%s'", queue_name, matches[0][1]
+            )
+            return True, matches[0][1], matches[0][2]
+        elif count > 1:
+            # Multiple matches - keep the original scraped value as-is
+            queues_log.debug(
+                "Multiple matches found for '%s': %s options - keeping as-is",
+                queue_name,
+                count,
+            )
+            return True, queue_name, None
+
+    return False, None, None
+
+
+_allowed_queue_index = None
+_allowed_queue_index_expires = 0.0
+_allowed_queue_index_lock = threading.Lock()
+
+
+def get_allowed_queue_index(cur=None):
+    """Return the cached AllowedQueueIndex, rebuilding it once the TTL has passed."""
+    global _allowed_queue_index, _allowed_queue_index_expires
+    if (
+        _allowed_queue_index is not None
+        and time.monotonic() < _allowed_queue_index_expires
+    ):
+        return _allowed_queue_index
+    with _allowed_queue_index_lock:
+        if (
+            _allowed_queue_index is None
+            or time.monotonic() >= _allowed_queue_index_expires
+        ):
+            sql = "SELECT queue_name, business_type, queue_id FROM allowed_queues ORDER BY id"
+            if cur is not None:
+                cur.execute(sql)
+                rows = cur.fetchall()
+            else:
+                with db_connection() as conn:
+                    own_cur = conn.cursor()
+                    own_cur.execute(sql)
+                    rows = own_cur.fetchall()
+                    own_cur.close()
+            _allowed_queue_index = AllowedQueueIndex(rows)
+            _allowed_queue_index_expires = time.monotonic() + ALLOWED_QUEUES_TTL
+            queues_log.info("Indexed %s allowed queues from database", len(rows))
+        return _allowed_queue_index
+
+
+def invalidate_allowed_queues():
+    """Force the next lookup to rebuild the allowed queue index."""
+    global _allowed_queue_index_expires
+    _allowed_queue_index_expires = 0.0
+
+
 # --- QUEUES API ---
+def _normalize_subqueue_counts(subqueue_counts, subqueues):
+    """
+    Normalize a POST /queues subqueue_counts payload (object, or list of
+    {name, count}) into (subqueue_counts, subqueues, sub_counts), where
+    sub_counts holds the whole-number counters keyed by subqueue name.
+    """
+    # Normalize subqueue_counts to JSON object
+    if isinstance(subqueue_counts, list):
+        obj = {}
+        for item in subqueue_counts:
+            try:
+                obj[item.get("name")] = int(item.get("count", 0) or 0)
+            except Exception:
+                pass
+        subqueue_counts = obj
+
+    # Ensure `subqueues` array reflects the keys present in subqueue_counts
+    try:
+        if isinstance(subqueue_counts, dict):
+            # preserve insertion order where possible
+            subqueues = list(subqueue_counts.keys())
+        else:
+            subqueues = subqueues if subqueues is not None else []
+    except Exception:
+        subqueues = subqueues if subqueues is not None else []
+
+    # Counters for queue_subqueue_counts (whole counts only, keyed by name)
+    sub_counts = {}
+    if isinstance(subqueue_counts, dict):
+        for sub, count in subqueue_counts.items():
+            try:
+                if sub is not None:
+                    sub_counts[str(sub)] = int(count or 0)
+            except Exception:
+                pass
+    return subqueue_counts, subqueues, sub_counts
+
+
 @app.route("/queues", methods=["POST"])
 def create_queue():
     data = request.json or {}
-    print("[QUEUES] Incoming payload:", data)
+    log_payload(queues_log, "Incoming payload:", data)
     # Require session_id to link queue to a session
     session_id = data.get("session_id")
     name = data.get("name")
@@ -831,80 +2991,21 @@ def create_queue():
     subqueue_count_new = data.get("subqueue_count_new")
 
     if not session_id or not name:
-        print("[QUEUES] Missing session_id or queue name")
+        queues_log.info("Missing session_id or queue name")
         return (
             jsonify({"success": False, "error": "Missing session_id or queue name"}),
             400,
         )
 
-    # Helper functions for queue validation
-    def find_matching_queue(queue_name, allowed_queues):
-        """
-        Find a matching queue name from the allowed list.
-        Returns (is_valid, normalized_name):
-        - If exact match found: (True, queue_name)
-        - If SINGLE partial match found: (True, full_allowed_name) - normalize to full name
-        - If MULTIPLE partial matches found: (True, original_queue_name) - keep as-is
-        - If no match: (False, None)
-
-        Simple country names (without dashes) are kept as-is if they match.
-        """
-        if not queue_name:
-            return False, None, None
-
-        input_lower = queue_name.strip().lower()
-
-        # First, check for exact match (case-insensitive)
-        for allowed_name, _, allowed_qid in allowed_queues:
-            if allowed_name.lower() == input_lower:
-                return True, allowed_name, allowed_qid
-
-        # Check if input is a simple country name (no special chars like - or /)
-        # If it matches a country entry, keep as-is
-        is_simple_name = not re.search(r"[-_/]", queue_name)
-        if is_simple_name:
-            for allowed_name, business_type, allowed_qid in allowed_queues:
-                if business_type == "COUNTRY" and allowed_name.lower() == input_lower:
-                    return True, allowed_name, allowed_qid
-
-        # For partial queue names, find all matching full names
-        # The input should be a prefix of the allowed name
-        if not is_simple_name:
-            matches = []
-            for allowed_name, business_type, allowed_qid in allowed_queues:
-                if business_type == "COUNTRY":
-                    continue  # Skip country entries for partial matching
-                allowed_lower = allowed_name.lower()
-                # Check if input is a prefix of allowed name (partial match)
-                if allowed_lower.startswith(input_lower):
-                    matches.append((allowed_name, allowed_qid))
-
-            if len(matches) == 1:
-                # Single match - normalize to the full name
-                print(
-                    f"[QUEUES] Single match found: '{queue_name}' -> '{matches[0][0]}'"
-                )
-                return True, matches[0][0], matches[0][1]
-            elif len(matches) > 1:
-                # Multiple matches - keep the original scraped value as-is
-                print(
-                    f"[QUEUES] Multiple matches found for '{queue_name}': {len(matches)} options - keeping as-is"
-                )
-                return True, queue_name, None
-
-        return False, None, None
-
     try:
         conn = get_conn()
         cur = conn.cursor()
 
-        # Fetch allowed queues from database
-        cur.execute("SELECT queue_name, business_type, queue_id FROM allowed_queues")
-        allowed_queues = [(row[0], row[1], row[2]) for row in cur.fetchall()]
-        print(f"[QUEUES] Loaded {len(allowed_queues)} allowed queues from database")
+        # Cached, pre-indexed allowed queues (refreshed every ALLOWED_QUEUES_TTL seconds)
+        allowed_queues = get_allowed_queue_index(cur)
 
         # If a subqueue-like name is provided (contains dash or special tokens) then a main_queue must be present
-        looks_like_subqueue = bool(name and re.search(r"[-_/]", name))
+        looks_like_subqueue = bool(name and _SUBQUEUE_NAME_RE.search(name))
 
         # Validate and normalize the queue name (if match found in DB, normalize; otherwise accept as-is)
         # Validate and normalize the queue name (if match found in DB, normalize; otherwise accept as-is)
@@ -914,12 +3015,14 @@ def create_queue():
             if is_valid and normalized_name:
                 matched_queue_id = qid
                 if normalized_name != name:
-                    print(f"[QUEUES] Normalizing name: '{name}' -> '{normalized_name}'")
+                    queues_log.debug(
+                        "Normalizing name: '%s' -> '%s'", name, normalized_name
+                    )
                     name = normalized_name
                 else:
-                    print(f"[QUEUES] Keeping name as-is: '{name}'")
+                    queues_log.debug("Keeping name as-is: '%s'", name)
             else:
-                print(f"[QUEUES] No match found, keeping name as-is: '{name}'")
+                queues_log.debug("No match found, keeping name as-is: '%s'", name)
 
         # Normalize main_queue if a match is found in DB (don't reject if not found)
         if main_queue:
@@ -928,23 +3031,24 @@ def create_queue():
                 main_queue, allowed_queues
             )
             if is_valid and normalized_main and normalized_main != main_queue:
-                print(
-                    f"[QUEUES] Normalizing main_queue: '{main_queue}' -> '{normalized_main}'"
+                queues_log.debug(
+                    "Normalizing main_queue: '%s' -> '%s'", main_queue, normalized_main
                 )
                 main_queue = normalized_main
             else:
-                print(f"[QUEUES] Keeping main_queue as-is: '{main_queue}'")
+                queues_log.debug("Keeping main_queue as-is: '%s'", main_queue)
 
         # Reject attempts to use a subqueue name as the main_queue (e.g., frontend fallback used subqueue of the same name)
         # BUT explicitly ALLOW this if the name matches a known queue in the database (matched_queue_id is not None)
         if name and main_queue and name == main_queue and looks_like_subqueue:
             if matched_queue_id:
-                print(
-                    f"[QUEUES] Allowed complex main_queue name because it is validated in DB: '{name}'"
+                queues_log.debug(
+                    "Allowed complex main_queue name because it is validated in DB: '%s'",
+                    name,
                 )
             else:
-                print(
-                    f"[QUEUES] Refusing to treat subqueue name as main_queue: name={name}"
+                queues_log.info(
+                    "Refusing to treat subqueue name as main_queue: name=%s", name
                 )
                 cur.close()
                 conn.close()
@@ -960,7 +3064,7 @@ def create_queue():
 
         # If the payload appears to be describing a subqueue (name contains -) ensure main_queue is provided
         if looks_like_subqueue and not main_queue:
-            print(f"[QUEUES] Subqueue payload missing main_queue: name={name}")
+            queues_log.info("Subqueue payload missing main_queue: name=%s", name)
             cur.close()
             conn.close()
             return (
@@ -974,9 +3078,8 @@ def create_queue():
             )
 
         # Ensure session exists
-        cur.execute("SELECT id FROM sessions WHERE id = %s", (session_id,))
-        if not cur.fetchone():
-            print(f"[QUEUES] Session not found for session_id={session_id}")
+        if _session_starttime(cur, session_id) is None:
+            queues_log.info("Session not found for session_id=%s", session_id)
             cur.close()
             conn.close()
             return jsonify({"success": False, "error": "Session not found"}), 404
@@ -984,171 +3087,134 @@ def create_queue():
         # update the main_queue row's subqueue_counts instead of creating a separate queue row for the subqueue.
         try:
             if main_queue and name and name != main_queue:
-                # Lock main_queue row for update (create it if missing)
-                cur.execute(
-                    "SELECT id, subqueues, subqueue_counts FROM queues WHERE session_id = %s AND name = %s FOR UPDATE",
-                    (session_id, main_queue),
-                )
-                mrow = cur.fetchone()
-                if mrow:
-                    main_id = mrow[0]
-                    existing_subqueues = mrow[1]
-                    existing_subcounts = mrow[2]
-
-                    print(
-                        f"[QUEUES] Read existing data: subqueues={existing_subqueues} (type={type(existing_subqueues).__name__}), subqueue_counts={existing_subcounts} (type={type(existing_subcounts).__name__})"
-                    )
-
-                    # Parse existing subqueues array - handle None, str, list, dict
-                    if existing_subqueues is None:
-                        existing_subqueues = []
-                    elif isinstance(existing_subqueues, str):
-                        try:
-                            existing_subqueues = json.loads(existing_subqueues)
-                        except Exception:
-                            existing_subqueues = []
-                    elif isinstance(existing_subqueues, list):
-                        pass  # Already a list, keep as is
-                    else:
-                        existing_subqueues = []
-
-                    # Parse existing subqueue_counts - handle None, str, dict
-                    if existing_subcounts is None:
-                        existing_subcounts = {}
-                    elif isinstance(existing_subcounts, str):
-                        try:
-                            existing_subcounts = json.loads(existing_subcounts)
-                        except Exception:
-                            existing_subcounts = {}
-                    elif isinstance(existing_subcounts, dict):
-                        pass  # Already a dict, keep as is
-                    else:
-                        existing_subcounts = {}
-
-                    print(
-                        f"[QUEUES] After parsing: subqueues={existing_subqueues}, subqueue_counts={existing_subcounts}"
-                    )
-                else:
-                    # Create a main queue row if it doesn't exist
-                    cur.execute(
-                        "INSERT INTO queues (name, session_id, main_queue, main_queue_count, subqueues, subqueue_counts, selected_subqueue, queue_count_old, queue_count_new, subqueue_count_old, subqueue_count_new) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id",
-                        (
-                            main_queue,
-                            session_id,
-                            main_queue,
-                            main_queue_count,
-                            json.dumps(subqueues),
-                            json.dumps({}),
-                            None,
-                            main_queue_count,
-                            None,
-                            None,
-                            None,
-                        ),
-                    )
-                    main_id = cur.fetchone()[0]
-                    existing_subqueues = []
-                    existing_subcounts = {}
-
                 # Determine subqueue count to write (prefer explicit subqueue_count_old, then queue_count_old)
                 try:
                     sub_old = int(subqueue_count_old or queue_count_old or 0)
                 except Exception:
                     sub_old = 0
 
-                # MERGE the new subqueue into existing data (don't overwrite)
-                # Add/update this subqueue's count in subqueue_counts (preserves existing)
-                existing_subcounts[name] = sub_old
-                print(
-                    f"[QUEUES] After adding {name}={sub_old}: subqueue_counts={existing_subcounts}"
-                )
-                # Add to subqueues array if not already present
-                if name not in existing_subqueues:
-                    existing_subqueues.append(name)
-
+                # Create the main queue row if missing (otherwise add the subqueue to
+                # its subqueues list) and set this subqueue's counter, in one statement
                 cur.execute(
-                    "UPDATE queues SET subqueues = %s, subqueue_counts = %s, selected_subqueue = %s, subqueue_count_old = %s, subqueue_count_new = %s, updated_at = NOW() WHERE id = %s",
-                    (
-                        json.dumps(existing_subqueues),
-                        json.dumps(existing_subcounts),
-                        name,
-                        sub_old,
-                        None,
-                        main_id,
+                    """
+                    WITH main AS (
+                        INSERT INTO queues (name, session_id, main_queue, main_queue_count, subqueues, subqueue_counts, selected_subqueue, queue_count_old, queue_count_new, subqueue_count_old, subqueue_count_new)
+                        VALUES (%(main_queue)s, %(session_id)s, %(main_queue)s, %(main_count)s, jsonb_build_array(%(name)s::text), '{}'::jsonb, %(name)s, %(main_count)s, NULL, %(sub_old)s, NULL)
+                        ON CONFLICT (session_id, name) DO UPDATE SET
+                            subqueues = CASE
+                                WHEN COALESCE(queues.subqueues, '[]'::jsonb) @> EXCLUDED.subqueues
+                                THEN queues.subqueues
+                                ELSE COALESCE(queues.subqueues, '[]'::jsonb) || EXCLUDED.subqueues
+                            END,
+                            selected_subqueue = EXCLUDED.selected_subqueue,
+                            subqueue_count_old = EXCLUDED.subqueue_count_old,
+                            subqueue_count_new = NULL,
+                            updated_at = NOW()
+                        RETURNING id
                     ),
+                    counters AS (
+                        UPDATE queue_counters qc SET
+                            selected_subqueue = %(name)s,
+                            subqueue_count_old = %(sub_old)s,
+                            subqueue_count_new = NULL,
+                            updated_at = NOW()
+                        FROM main WHERE qc.queue_id = main.id
+                    )
+                    INSERT INTO queue_subqueue_counts (queue_id, subqueue, count)
+                    SELECT id, %(name)s, %(sub_old)s FROM main
+                    ON CONFLICT (queue_id, subqueue) DO UPDATE SET
+                        count = EXCLUDED.count,
+                        updated_at = NOW()
+                    RETURNING queue_id
+                    """,
+                    {
+                        "main_queue": main_queue,
+                        "session_id": session_id,
+                        "main_count": main_queue_count,
+                        "name": name,
+                        "sub_old": sub_old,
+                    },
                 )
+                main_id = cur.fetchone()[0]
                 conn.commit()
                 cur.close()
                 conn.close()
-                print(
-                    f"[QUEUES] Updated main queue {main_queue} with subqueue {name} count={sub_old}"
+                queues_log.info(
+                    "Updated main queue %s with subqueue %s count=%s",
+                    main_queue,
+                    name,
+                    sub_old,
                 )
                 return jsonify(
                     {"success": True, "name": main_queue, "queue_id": main_id}
                 )
         except Exception as e:
-            print(f"[QUEUES] Exception handling subqueue-as-update: {e}")
-            import traceback
-
-            traceback.print_exc()
+            queues_log.exception("Exception handling subqueue-as-update: %s", e)
             # fall through to normal insert handling on unexpected errors
 
-        # Normalize subqueue_counts to JSON object
-        if isinstance(subqueue_counts, list):
-            obj = {}
-            for item in subqueue_counts:
-                try:
-                    obj[item.get("name")] = int(item.get("count", 0) or 0)
-                except Exception:
-                    pass
-            subqueue_counts = obj
-
-        # Ensure `subqueues` array reflects the keys present in subqueue_counts
-        try:
-            if isinstance(subqueue_counts, dict):
-                # preserve insertion order where possible
-                subqueues = list(subqueue_counts.keys())
-            else:
-                subqueues = subqueues if subqueues is not None else []
-        except Exception:
-            subqueues = subqueues if subqueues is not None else []
+        subqueue_counts, subqueues, sub_counts = _normalize_subqueue_counts(
+            subqueue_counts, subqueues
+        )
 
-        print(
-            f"[QUEUES] Inserting queue: name={name}, session_id={session_id}, main_queue={main_queue}, main_queue_count={main_queue_count}, subqueues={subqueues}, subqueue_counts={subqueue_counts}"
+        queues_log.debug(
+            "Inserting queue: name=%s, session_id=%s, main_queue=%s, main_queue_count=%s, subqueues=%s, subqueue_counts=%s",
+            name,
+            session_id,
+            main_queue,
+            main_queue_count,
+            _TruncatedPayload(subqueues),
+            _TruncatedPayload(subqueue_counts),
         )
         try:
             cur.execute(
                 """
-                INSERT INTO queues (name, session_id, main_queue, main_queue_count, subqueues, subqueue_counts, selected_subqueue, queue_count_old, queue_count_new, subqueue_count_old, subqueue_count_new, queue_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (session_id, name) DO UPDATE SET
-                    main_queue = COALESCE(EXCLUDED.main_queue, queues.main_queue),
-                    main_queue_count = GREATEST(queues.main_queue_count, EXCLUDED.main_queue_count),
-                    subqueues = CASE 
-                        WHEN EXCLUDED.subqueues IS NOT NULL AND EXCLUDED.subqueues != '[]'::jsonb 
-                        THEN (
-                            SELECT jsonb_agg(DISTINCT elem) 
-                            FROM (
-                                SELECT jsonb_array_elements(COALESCE(queues.subqueues, '[]'::jsonb)) AS elem
-                                UNION
-                                SELECT jsonb_array_elements(EXCLUDED.subqueues) AS elem
-                            ) combined
-                        )
-                        ELSE queues.subqueues 
-                    END,
-                    subqueue_counts = CASE 
-                        WHEN EXCLUDED.subqueue_counts IS NOT NULL AND EXCLUDED.subqueue_counts != '{}'::jsonb 
-                        THEN COALESCE(queues.subqueue_counts, '{}'::jsonb) || EXCLUDED.subqueue_counts
-                        ELSE queues.subqueue_counts 
-                    END,
-                    selected_subqueue = COALESCE(EXCLUDED.selected_subqueue, queues.selected_subqueue),
-                    queue_count_old = COALESCE(EXCLUDED.queue_count_old, queues.queue_count_old),
-                    queue_count_new = COALESCE(EXCLUDED.queue_count_new, queues.queue_count_new),
-                    subqueue_count_old = COALESCE(EXCLUDED.subqueue_count_old, queues.subqueue_count_old),
-                    subqueue_count_new = COALESCE(EXCLUDED.subqueue_count_new, queues.subqueue_count_new),
-                    queue_id = COALESCE(EXCLUDED.queue_id, queues.queue_id),
-                    updated_at = NOW()
-                RETURNING id
+                WITH q AS (
+                    INSERT INTO queues (name, session_id, main_queue, main_queue_count, subqueues, subqueue_counts, selected_subqueue, queue_count_old, queue_count_new, subqueue_count_old, subqueue_count_new, queue_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (session_id, name) DO UPDATE SET
+                        main_queue = COALESCE(EXCLUDED.main_queue, queues.main_queue),
+                        main_queue_count = GREATEST(queues.main_queue_count, EXCLUDED.main_queue_count),
+                        subqueues = CASE 
+                            WHEN EXCLUDED.subqueues IS NOT NULL AND EXCLUDED.subqueues != '[]'::jsonb 
+                            THEN (
+                                SELECT jsonb_agg(DISTINCT elem) 
+                                FROM (
+                                    SELECT jsonb_array_elements(COALESCE(queues.subqueues, '[]'::jsonb)) AS elem
+                                    UNION
+                                    SELECT jsonb_array_elements(EXCLUDED.subqueues) AS elem
+                                ) combined
+                            )
+                            ELSE queues.subqueues 
+                        END,
+                        selected_subqueue = COALESCE(EXCLUDED.selected_subqueue, queues.selected_subqueue),
+                        queue_count_old = COALESCE(EXCLUDED.queue_count_old, queues.queue_count_old),
+                        queue_count_new = COALESCE(EXCLUDED.queue_count_new, queues.queue_count_new),
+                        subqueue_count_old = COALESCE(EXCLUDED.subqueue_count_old, queues.subqueue_count_old),
+                        subqueue_count_new = COALESCE(EXCLUDED.subqueue_count_new, queues.subqueue_count_new),
+                        queue_id = COALESCE(EXCLUDED.queue_id, queues.queue_id),
+                        updated_at = NOW()
+                    RETURNING id
+                ),
+                counts AS (
+                    INSERT INTO queue_subqueue_counts (queue_id, subqueue, count)
+                    SELECT q.id, c.subqueue, c.count
+                    FROM q, unnest(%s::text[], %s::int[]) AS c(subqueue, count)
+                    ON CONFLICT (queue_id, subqueue) DO UPDATE SET
+                        count = EXCLUDED.count,
+                        updated_at = NOW()
+                ),
+                counters AS (
+                    UPDATE queue_counters qc SET
+                        main_queue_count = GREATEST(qc.main_queue_count, %s),
+                        selected_subqueue = COALESCE(%s, qc.selected_subqueue),
+                        queue_count_old = COALESCE(%s, qc.queue_count_old),
+                        queue_count_new = COALESCE(%s, qc.queue_count_new),
+                        subqueue_count_old = COALESCE(%s, qc.subqueue_count_old),
+                        subqueue_count_new = COALESCE(%s, qc.subqueue_count_new),
+                        updated_at = NOW()
+                    FROM q WHERE qc.queue_id = q.id
+                )
+                SELECT id FROM q
                 """,
                 (
                     name,
@@ -1156,32 +3222,34 @@ def create_queue():
                     main_queue,
                     main_queue_count,
                     json.dumps(subqueues),
-                    json.dumps(subqueue_counts),
+                    json.dumps({}),
                     selected_subqueue,
                     queue_count_old,
                     queue_count_new,
                     subqueue_count_old,
                     subqueue_count_new,
                     matched_queue_id,
+                    list(sub_counts),
+                    list(sub_counts.values()),
+                    main_queue_count,
+                    selected_subqueue,
+                    queue_count_old,
+                    queue_count_new,
+                    subqueue_count_old,
+                    subqueue_count_new,
                 ),
             )
             queue_id = cur.fetchone()[0]
             conn.commit()
-            print(f"[QUEUES] Queue inserted/updated: id={queue_id}")
+            queues_log.info("Queue inserted/updated: id=%s", queue_id)
             cur.close()
             conn.close()
             return jsonify({"success": True, "queue_id": queue_id, "name": name})
         except Exception as e:
-            print(f"[QUEUES] Exception during insert/update: {e}")
-            import traceback
-
-            traceback.print_exc()
+            queues_log.warning("Exception during insert/update: %s", e)
             raise
     except Exception as e:
-        print(f"[QUEUES] Outer exception: {e}")
-        import traceback
-
-        traceback.print_exc()
+        queues_log.exception("Failed to create queue: %s", e)
         return (
             jsonify(
                 {"success": False, "error": "Failed to create queue", "detail": str(e)}
@@ -1190,323 +3258,605 @@ def create_queue():
         )
 
 
-@app.route("/queues", methods=["GET"])
-def list_queues():
-    try:
-        print("[QUEUES][DEBUG] Incoming GET /queues request")
-        print(f"[QUEUES][DEBUG] Query params: {request.args}")
-        conn = get_conn()
-        cur = conn.cursor()
-        session_id = request.args.get("session_id")
-        if session_id:
-            print(f"[QUEUES][DEBUG] Filtering by session_id: {session_id}")
-            sql = "SELECT id, name, session_id, main_queue, main_queue_count, subqueues, subqueue_counts, selected_subqueue, queue_count_old, queue_count_new, subqueue_count_old, subqueue_count_new, active, created_at FROM queues WHERE session_id = %s ORDER BY id DESC"
-            print(f"[QUEUES][DEBUG] SQL: {sql}")
-            cur.execute(sql, (session_id,))
-        else:
-            sql = "SELECT id, name, session_id, main_queue, main_queue_count, subqueues, subqueue_counts, selected_subqueue, queue_count_old, queue_count_new, subqueue_count_old, subqueue_count_new, active, created_at FROM queues ORDER BY id DESC"
-            print(f"[QUEUES][DEBUG] SQL: {sql}")
-            cur.execute(sql)
-        rows = cur.fetchall()
-        print(f"[QUEUES][DEBUG] Rows fetched: {len(rows)}")
-        queues = []
-        for r in rows:
-            print(f"[QUEUES][DEBUG] Row: {r}")
-            # Fix: Only json.loads if value is a string
-            subqueues_val = r[5]
-            if isinstance(subqueues_val, str):
-                try:
-                    subqueues_val = json.loads(subqueues_val)
-                except Exception:
-                    subqueues_val = []
-            elif not isinstance(subqueues_val, list):
-                subqueues_val = []
-
-            subqueue_counts_val = r[6]
-            if isinstance(subqueue_counts_val, str):
-                try:
-                    subqueue_counts_val = json.loads(subqueue_counts_val)
-                except Exception:
-                    subqueue_counts_val = {}
-            elif not isinstance(subqueue_counts_val, dict):
-                subqueue_counts_val = {}
+# Page size for GET /queues without session_id (and the cap for any ?limit=)
+QUEUES_PAGE_SIZE = int(os.getenv("QUEUES_PAGE_SIZE", 500))
+QUEUES_MAX_PAGE_SIZE = int(os.getenv("QUEUES_MAX_PAGE_SIZE", 5000))
+# Rows fetched per round trip when streaming GET /queues
+QUEUES_STREAM_ITERSIZE = int(os.getenv("QUEUES_STREAM_ITERSIZE", 2000))
 
-            # Map indices carefully after extended SELECT
-            queues.append(
-                {
-                    "id": r[0],
-                    "name": r[1],
-                    "session_id": r[2],
-                    "main_queue": r[3],
-                    "main_queue_count": r[4],
-                    "subqueues": subqueues_val,
-                    "subqueue_counts": subqueue_counts_val,
-                    "selected_subqueue": r[7],
-                    "queue_count_old": r[8],
-                    "queue_count_new": r[9],
-                    "subqueue_count_old": r[10],
-                    "subqueue_count_new": r[11],
-                    "active": r[12],
-                    "created_at": r[13].isoformat() if r[13] else None,
-                }
-            )
-        cur.close()
-        conn.close()
-        print(f"[QUEUES][DEBUG] Returning {len(queues)} queues")
-        return jsonify({"success": True, "queues": queues})
-    except Exception as e:
-        import traceback
 
-        print(f"[QUEUES][ERROR] Exception: {e}")
-        traceback.print_exc()
-        return jsonify({"success": False, "error": str(e)}), 500
+def _json_list(value):
+    # Only json.loads if value is a string
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except Exception:
+            return []
+    return value if isinstance(value, list) else []
 
 
-# --- CARDS API ---
-def _adjust_queue_counts(cur, queue_id, metadata, delta=1):
-    """Adjust main_queue_count and subqueue_counts for a queue by delta (+1 or -1)."""
-    if queue_id is None:
-        return
+def _json_object(value):
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except Exception:
+            return {}
+    return value if isinstance(value, dict) else {}
 
-    # Lock queue row and read existing relevant fields (include name and main_queue)
-    cur.execute(
-        "SELECT name, main_queue, main_queue_count, subqueue_counts, selected_subqueue, queue_count_old, queue_count_new, subqueue_count_old, subqueue_count_new FROM queues WHERE id = %s FOR UPDATE",
-        (queue_id,),
-    )
-    row = cur.fetchone()
-    if not row:
-        return
 
-    queue_name = row[0]
-    main_queue_field = row[1]
-    main_count = row[2] or 0
-    sub_counts_json = row[3]
-    existing_selected = row[4]
-    existing_queue_count_old = row[5]
-    existing_queue_count_new = row[6]
-    existing_subqueue_count_old = row[7]
-    existing_subqueue_count_new = row[8]
-
-    print(
-        f"[_adjust_queue_counts] Read queue {queue_id}: sub_counts_json={sub_counts_json} (type={type(sub_counts_json).__name__})"
-    )
+def _isoformat(value):
+    return value.isoformat() if value else None
 
-    # Parse sub_counts - handle None, dict, str
-    if sub_counts_json is None:
-        sub_counts = {}
-    elif isinstance(sub_counts_json, dict):
-        sub_counts = sub_counts_json.copy()  # Make a copy to avoid mutating original
-    elif isinstance(sub_counts_json, str):
-        try:
-            sub_counts = json.loads(sub_counts_json)
-        except Exception:
-            sub_counts = {}
-    else:
-        sub_counts = {}
 
-    print(f"[_adjust_queue_counts] After parsing: sub_counts={sub_counts}")
+# Subqueue counters of a queues row, assembled into the {subqueue: count} object
+SUBQUEUE_COUNTS_SQL = (
+    "(SELECT COALESCE(jsonb_object_agg(c.subqueue, c.count), '{}'::jsonb)"
+    " FROM queue_subqueue_counts c WHERE c.queue_id = queues.id)"
+)
 
-    # preserve old values
-    # If frontend provided scraped counts and requested them to be used, honor them
-    use_scraped = False
+# Card-driven counters live in queue_counters once a queue has seen a card
+# move; queries select FROM queues with this join to read them
+QUEUE_COUNTERS_JOIN = " LEFT JOIN queue_counters qc ON qc.queue_id = queues.id"
+
+
+def _queue_counter_sql(column):
+    """Current value of a card-driven queue counter (needs QUEUE_COUNTERS_JOIN)."""
+    return f"CASE WHEN qc.queue_id IS NULL THEN queues.{column} ELSE qc.{column} END"
+
+
+# Response field -> (SQL expression, converter); order matches the response shape
+QUEUE_LIST_FIELDS = {
+    "id": ("queues.id", None),
+    "name": ("queues.name", None),
+    "session_id": ("queues.session_id", None),
+    "main_queue": ("queues.main_queue", None),
+    "main_queue_count": (_queue_counter_sql("main_queue_count"), None),
+    "subqueues": ("queues.subqueues", _json_list),
+    "subqueue_counts": (SUBQUEUE_COUNTS_SQL, _json_object),
+    "selected_subqueue": (_queue_counter_sql("selected_subqueue"), None),
+    "queue_count_old": (_queue_counter_sql("queue_count_old"), None),
+    "queue_count_new": (_queue_counter_sql("queue_count_new"), None),
+    "subqueue_count_old": (_queue_counter_sql("subqueue_count_old"), None),
+    "subqueue_count_new": (_queue_counter_sql("subqueue_count_new"), None),
+    "active": ("queues.active", None),
+    "created_at": ("queues.created_at", _isoformat),
+}
+
+
+def _parse_timestamp_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
     try:
-        if (
-            metadata
-            and isinstance(metadata, dict)
-            and metadata.get("use_scraped_counts")
-        ):
-            use_scraped = True
-    except Exception:
-        use_scraped = False
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"Invalid {name}: expected an ISO 8601 timestamp")
 
-    if (
-        use_scraped
-        and metadata.get("queue_count_old") is not None
-        and metadata.get("queue_count_new") is not None
-    ):
+
+def _build_queue_list_query(args, paged=True):
+    """
+    Translate GET /queues query params into (sql, params, fields, limit).
+    Raises ValueError with a client-facing message on bad input.
+
+    - session_id, active, created_after, created_before: filters
+    - cursor: return rows with id < cursor (keyset pagination, newest first)
+    - limit: page size; defaults to QUEUES_PAGE_SIZE unless filtering by session
+      or streaming (paged=False), where only an explicit limit applies
+    - fields: comma-separated projection (id is always included)
+    """
+    fields = list(QUEUE_LIST_FIELDS)
+    if args.get("fields"):
+        requested = [f.strip() for f in args["fields"].split(",") if f.strip()]
+        unknown = [f for f in requested if f not in QUEUE_LIST_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        fields = ["id"] + [f for f in requested if f != "id"]
+
+    where, params = [], []
+    session_id = args.get("session_id")
+    if session_id:
+        where.append("queues.session_id = %s")
+        params.append(session_id)
+    if args.get("active") is not None:
+        active = args["active"].lower()
+        if active not in ("true", "false", "1", "0"):
+            raise ValueError("Invalid active: expected true or false")
+        where.append("queues.active = %s")
+        params.append(active in ("true", "1"))
+    created_after = _parse_timestamp_arg(args, "created_after")
+    if created_after:
+        where.append("queues.created_at >= %s")
+        params.append(created_after)
+    created_before = _parse_timestamp_arg(args, "created_before")
+    if created_before:
+        where.append("queues.created_at < %s")
+        params.append(created_before)
+    if args.get("cursor"):
         try:
-            prev_main_count = int(metadata.get("queue_count_old") or 0)
-            main_count = int(metadata.get("queue_count_new") or prev_main_count)
-        except Exception:
-            prev_main_count = int(main_count or 0)
-            main_count = max(0, int(prev_main_count) + int(delta))
-    else:
-        prev_main_count = int(main_count or 0)
-        main_count = max(0, int(prev_main_count) + int(delta))
-
-    # If metadata contains explicit subqueue name, adjust that count
-    selected_subname = None
-    prev_sub_count = 0
-    if metadata and isinstance(metadata, dict):
-        selected_subname = (
-            metadata.get("subqueue") or metadata.get("sub_queue") or metadata.get("sub")
-        )
-        if selected_subname:
-            # If frontend provided scraped subqueue counts and requested them to be used, honor them
-            if (
-                use_scraped
-                and metadata.get("subqueue_count_old") is not None
-                and metadata.get("subqueue_count_new") is not None
-            ):
-                try:
-                    prev_sub_count = int(metadata.get("subqueue_count_old") or 0)
-                    current = int(metadata.get("subqueue_count_new") or prev_sub_count)
-                except Exception:
-                    try:
-                        current = int(sub_counts.get(selected_subname, 0) or 0)
-                    except Exception:
-                        current = 0
-                    prev_sub_count = current
-                    current = max(0, current + int(delta))
-                sub_counts[selected_subname] = current
-            else:
-                try:
-                    current = int(sub_counts.get(selected_subname, 0) or 0)
-                except Exception:
-                    current = 0
-                prev_sub_count = current
-                current = max(0, current + int(delta))
-                sub_counts[selected_subname] = current
-
-    # If no explicit subqueue in metadata, try to infer from the queue name (fallback IDs like 'brazil_subname')
-    if not selected_subname:
-        inferred = None
+            where.append("queues.id < %s")
+            params.append(int(args["cursor"]))
+        except ValueError:
+            raise ValueError("Invalid cursor")
+
+    limit = None
+    if args.get("limit"):
         try:
-            if main_queue_field and queue_name and isinstance(queue_name, str):
-                prefix = f"{main_queue_field}_"
-                if queue_name.startswith(prefix):
-                    inferred = queue_name[len(prefix) :]
-            if (
-                not inferred
-                and queue_name
-                and isinstance(queue_name, str)
-                and "_" in queue_name
-            ):
-                inferred = queue_name.split("_", 1)[1]
+            limit = int(args["limit"])
+        except ValueError:
+            raise ValueError("Invalid limit")
+        if limit < 1:
+            raise ValueError("Invalid limit")
+    elif paged and not session_id:
+        # Unfiltered listings are always paged
+        limit = QUEUES_PAGE_SIZE
+    if paged and limit is not None:
+        limit = min(limit, QUEUES_MAX_PAGE_SIZE)
+
+    sql = "SELECT " + ", ".join(QUEUE_LIST_FIELDS[f][0] for f in fields)
+    sql += " FROM queues" + QUEUE_COUNTERS_JOIN
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY queues.id DESC"
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql, params, fields, limit
+
+
+def _queue_row_to_dict(fields, row):
+    item = {}
+    for field, value in zip(fields, row):
+        convert = QUEUE_LIST_FIELDS[field][1]
+        item[field] = convert(value) if convert else value
+    return item
+
+
+def _stream_queues(sql, params, fields, ndjson):
+    """
+    Stream queue rows from a server-side (named) cursor, QUEUES_STREAM_ITERSIZE
+    rows per round trip, as a JSON document or NDJSON (one queue per line).
+    Memory stays flat and the first bytes go out before the query finishes.
+    """
+    # Checked out directly rather than via get_conn(): the request teardown runs
+    # before the body is streamed, so the response owns and returns the connection
+    pool = get_pool()
+    conn = PooledConnection(pool, pool.getconn())
+
+    def release():
+        # Runs when the body is exhausted and again when the response is closed;
+        # the latter also covers bodies that are never read (HEAD, client gone
+        # before the first chunk), where the generator never starts
+        if conn.closed:
+            return
+        try:
+            if not cur.closed:
+                cur.close()
         except Exception:
-            inferred = None
-
-        if inferred:
-            selected_subname = inferred
-            try:
-                current = int(sub_counts.get(selected_subname, 0) or 0)
-            except Exception:
-                current = 0
-            prev_sub_count = current
-            current = max(0, current + int(delta))
-            sub_counts[selected_subname] = current
-
-        # If still no subqueue determined but there is an existing selected_subqueue,
-        # update that subqueue's count (preserve selection name).
-        if not selected_subname and existing_selected:
-            try:
-                current = int(sub_counts.get(existing_selected, 0) or 0)
-            except Exception:
-                current = 0
-            prev_sub_count = current
-            current = max(0, current + int(delta))
-            sub_counts[existing_selected] = current
-            # Set selected_subname so downstream logic treats it as adjusted
-            selected_subname = existing_selected
+            pass
+        finally:
+            conn.close()
 
     try:
-        # Also maintain the `subqueues` array column (list of subqueue names) for easier display
-        subqueues_list = list(sub_counts.keys())
+        conn.autocommit = False  # named cursors live inside a transaction
+        cur = conn.cursor(name=f"queues_stream_{secrets.token_hex(4)}")
+        cur.itersize = QUEUES_STREAM_ITERSIZE
+        cur.execute(sql, params)
+    except Exception:
+        conn.close()
+        raise
 
-        # Determine queue_count_old to write (preserve existing if present)
-        queue_count_old_to_write = None
-        try:
-            if existing_queue_count_old is None:
-                queue_count_old_to_write = int(prev_main_count or 0)
-            else:
-                queue_count_old_to_write = existing_queue_count_old
-        except Exception:
-            queue_count_old_to_write = int(prev_main_count or 0)
+    def dumps(value):
+        return json.dumps(value, separators=(",", ":"), default=str)
 
-        # Determine subqueue_count_old to write
-        subqueue_count_old_to_write = None
+    def generate():
+        sent = 0
         try:
-            if selected_subname:
-                # If the selected subqueue changed compared to existing_selected, record the previous subqueue count
-                if (not existing_selected) or (existing_selected != selected_subname):
-                    subqueue_count_old_to_write = int(prev_sub_count or 0)
+            if not ndjson:
+                yield '{"queues":['
+            while True:
+                rows = cur.fetchmany(QUEUES_STREAM_ITERSIZE)
+                if not rows:
+                    break
+                items = [dumps(_queue_row_to_dict(fields, r)) for r in rows]
+                if ndjson:
+                    yield "\n".join(items) + "\n"
                 else:
-                    # preserve existing subqueue_count_old if present, otherwise set to prev_sub_count
-                    if existing_subqueue_count_old is None:
-                        subqueue_count_old_to_write = int(prev_sub_count or 0)
-                    else:
-                        subqueue_count_old_to_write = existing_subqueue_count_old
+                    yield ("," if sent else "") + ",".join(items)
+                sent += len(rows)
+            if not ndjson:
+                yield '],"success":true}'
+            queues_log.debug("Streamed %s queues", sent)
+        except Exception as e:
+            # Headers are already sent; report the failure in-band
+            queues_log.exception("Stream failed after %s rows: %s", sent, e)
+            error = {"success": False, "error": str(e)}
+            if ndjson:
+                yield dumps(error) + "\n"
             else:
-                # No explicit selected_subname determined: preserve existing value
-                subqueue_count_old_to_write = existing_subqueue_count_old
-        except Exception:
-            subqueue_count_old_to_write = int(prev_sub_count or 0)
-
-        # If no new selected_subname provided, preserve existing selected_subqueue
-        new_selected = selected_subname if selected_subname else existing_selected
-        # subqueue_count_new should reflect the new value for the selected subqueue if one was adjusted,
-        # otherwise preserve existing subqueue_count_new
-        new_subqueue_count_new = (
-            sub_counts.get(selected_subname)
-            if selected_subname
-            else existing_subqueue_count_new
+                yield '],"success":false,"error":' + dumps(str(e)) + "}"
+        finally:
+            release()
+
+    response = app.response_class(
+        generate(),
+        mimetype="application/x-ndjson" if ndjson else "application/json",
+    )
+    response.call_on_close(release)
+    return response
+
+
+@app.route("/queues", methods=["GET"])
+def list_queues():
+    """
+    List queues. ?format=ndjson or ?stream=1 switch to a streamed response for
+    large exports; otherwise results are paged with ?cursor=/&limit=.
+    """
+    ndjson = request.args.get("format") == "ndjson"
+    stream = ndjson or request.args.get("stream") in ("1", "true")
+    try:
+        sql, params, fields, limit = _build_queue_list_query(
+            request.args, paged=not stream
         )
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    if stream:
+        try:
+            return _stream_queues(sql, params, fields, ndjson)
+        except Exception as e:
+            queues_log.exception("Stream setup failed: %s", e)
+            return jsonify({"success": False, "error": str(e)}), 500
+
+    try:
+        queues_log.debug("GET /queues params: %s", request.args.to_dict())
+        conn = get_conn()
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        queues = [_queue_row_to_dict(fields, r) for r in cur.fetchall()]
+        cur.close()
+        conn.close()
+        # A full page means there may be more rows below the last id
+        next_cursor = queues[-1]["id"] if limit and len(queues) == limit else None
+        queues_log.debug("Returning %s queues", len(queues))
+        return jsonify({"success": True, "queues": queues, "next_cursor": next_cursor})
+    except Exception as e:
+        queues_log.exception("Failed to list queues: %s", e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+# --- CARDS API ---
+def _stored_card_metadata(value):
+    """
+    Decode cards.metadata as read back from the database: psycopg2 already
+    returns JSONB as a dict, older rows may hold a JSON string.
+    """
+    if isinstance(value, dict):
+        return value
+    try:
+        return json.loads(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _card_subqueue(metadata):
+    """Explicit subqueue name carried in a card's metadata, if any."""
+    if not metadata or not isinstance(metadata, dict):
+        return None
+    name = metadata.get("subqueue") or metadata.get("sub_queue") or metadata.get("sub")
+    return str(name) if name else None
+
+
+def _infer_subqueue(queue_name, main_queue):
+    """Subqueue implied by a fallback queue name like 'brazil_subname'."""
+    if not queue_name or not isinstance(queue_name, str):
+        return None
+    inferred = None
+    if main_queue:
+        prefix = f"{main_queue}_"
+        if queue_name.startswith(prefix):
+            inferred = queue_name[len(prefix) :]
+    if not inferred and "_" in queue_name:
+        inferred = queue_name.split("_", 1)[1]
+    return inferred or None
+
+
+def _scraped_pair(metadata, old_key, new_key):
+    """(old, new) counts scraped by the frontend, or None if absent/unusable."""
+    if metadata.get(old_key) is None or metadata.get(new_key) is None:
+        return None
+    try:
+        old = int(metadata.get(old_key) or 0)
+        return old, int(metadata.get(new_key) or old)
+    except Exception:
+        return None
+
+
+def _plan_count_adjustment(metadata, delta=1):
+    """
+    Decide how one card move (delta +1 or -1) changes its queue's counters,
+    from the card metadata alone. Returns a dict with the explicit subqueue
+    (or None) and, for the main and sub counter, either the scraped
+    (old, new) pair to write as-is or None to apply delta to the stored count.
+    """
+    plan = {"subqueue": _card_subqueue(metadata), "main": None, "sub": None}
+    # If frontend provided scraped counts and requested them to be used, honor them
+    if metadata and isinstance(metadata, dict) and metadata.get("use_scraped_counts"):
+        plan["main"] = _scraped_pair(metadata, "queue_count_old", "queue_count_new")
+        if plan["subqueue"]:
+            plan["sub"] = _scraped_pair(
+                metadata, "subqueue_count_old", "subqueue_count_new"
+            )
+    return plan
+
 
-        print(
-            f"[_adjust_queue_counts] WRITING to queue {queue_id}: sub_counts={sub_counts}"
+def _fold_card_moves(queue, moves):
+    """
+    Fold one queue's card moves ([(metadata, delta), ...], in order) into a
+    single counter update. `queue` is (name, main_queue, selected_subqueue).
+
+    Each counter becomes [base, delta, prev]: base is an absolute scraped
+    value (None to start from the stored count), delta the net change on
+    top of it and prev the scraped "old" value, if any. The subqueue falls
+    back from the metadata to the queue name, then to the selected subqueue.
+    """
+    name, main_queue, selected = queue
+    main = [None, 0, None]
+    subs = {}
+    subqueue = None
+    for metadata, delta in moves:
+        plan = _plan_count_adjustment(metadata, delta)
+        if plan["main"] is not None:
+            main = [plan["main"][1], 0, plan["main"][0]]
+        else:
+            main[1] += delta
+
+        sub = plan["subqueue"] or _infer_subqueue(name, main_queue) or selected
+        if not sub:
+            continue
+        counter = subs.setdefault(sub, [None, 0, None])
+        if plan["sub"] is not None:
+            counter[:] = [plan["sub"][1], 0, plan["sub"][0]]
+        else:
+            counter[1] += delta
+        selected = subqueue = sub
+    return {"main": main, "subs": subs, "subqueue": subqueue}
+
+
+def run_steps(cur, steps):
+    """
+    Run a statement generator on a psycopg2 cursor: steps yields
+    (sql, params), is sent back the fetched rows (None for statements that
+    return none) and returns the result. The card writes are written this
+    way so asgi_app can run the same statements on its async pool.
+    """
+    rows = None
+    while True:
+        try:
+            sql, params = steps.send(rows)
+        except StopIteration as done:
+            return done.value
+        cur.execute(sql, params)
+        rows = cur.fetchall() if cur.description else None
+
+
+def _card_moves_steps(moves_by_queue):
+    """
+    Apply card moves ({queue_id: [(metadata, delta), ...]}) to the queue
+    counters (statement generator, see run_steps). Subqueue counts live in
+    queue_subqueue_counts and the main count (with the old/new/selected
+    columns) in queue_counters, and every counter is bumped with an atomic
+    `count = count + delta`.
+
+    The queue rows are only read, never locked: GET/POST /queues and card
+    moves on other queues do not wait on card decisions. Card moves on the
+    same queue still queue up on its counter rows until they commit, so the
+    main counter is updated last, right before the caller commits; lock
+    order between counter rows is not fixed, and the rare deadlock is
+    retried by run_transaction.
+    """
+    if not moves_by_queue:
+        return
+    rows = yield (
+        "SELECT queues.id, queues.name, queues.main_queue, "
+        + _queue_counter_sql("selected_subqueue")
+        + " FROM queues"
+        + QUEUE_COUNTERS_JOIN
+        + " WHERE queues.id = ANY(%s)",
+        (sorted(moves_by_queue),),
+    )
+    updates = {
+        row[0]: _fold_card_moves(row[1:], moves_by_queue[row[0]]) for row in rows
+    }
+    if not updates:
+        return
+    ids = sorted(updates)
+
+    sub_counts = {}
+    subs = [
+        (qid, sub, counter)
+        for qid in ids
+        for sub, counter in sorted(updates[qid]["subs"].items())
+    ]
+    if subs:
+        # Create missing counters first so the UPDATE below sees every row
+        yield (
+            """
+            INSERT INTO queue_subqueue_counts (queue_id, subqueue)
+            SELECT * FROM unnest(%s::int[], %s::text[])
+            ON CONFLICT (queue_id, subqueue) DO NOTHING
+            """,
+            ([s[0] for s in subs], [s[1] for s in subs]),
         )
-        cur.execute(
-            "UPDATE queues SET main_queue_count = %s, subqueue_counts = %s, selected_subqueue = %s, queue_count_old = %s, queue_count_new = %s, subqueue_count_old = %s, subqueue_count_new = %s, updated_at = NOW() WHERE id = %s",
+        rows = yield (
+            """
+            UPDATE queue_subqueue_counts c SET
+                count = GREATEST(0, COALESCE(u.base, c.count) + u.delta),
+                updated_at = NOW()
+            FROM unnest(%s::int[], %s::text[], %s::int[], %s::int[])
+                AS u(queue_id, subqueue, base, delta)
+            WHERE c.queue_id = u.queue_id AND c.subqueue = u.subqueue
+            RETURNING c.queue_id, c.subqueue, c.count
+            """,
             (
-                main_count,
-                json.dumps(sub_counts),
-                new_selected,
-                queue_count_old_to_write,
-                main_count,
-                subqueue_count_old_to_write,
-                new_subqueue_count_new,
-                queue_id,
+                [s[0] for s in subs],
+                [s[1] for s in subs],
+                [s[2][0] for s in subs],
+                [s[2][1] for s in subs],
             ),
         )
-    except Exception as e:
-        print(f"[_adjust_queue_counts] Failed to update queue counts: {e}")
-        raise
+        sub_counts = {(r[0], r[1]): r[2] for r in rows}
+
+    rows = []
+    for qid in ids:
+        update = updates[qid]
+        subqueue = update["subqueue"]
+        sub_prev = sub_count = None
+        if subqueue is not None:
+            _, sub_delta, sub_prev = update["subs"][subqueue]
+            sub_count = sub_counts.get((qid, subqueue))
+            if sub_prev is None and sub_count is not None:
+                sub_prev = max(0, sub_count - sub_delta)
+        rows.append((qid, *update["main"], subqueue, sub_prev, sub_count))
+
+    # A queue's first card move seeds its counter row from the queue row
+    yield (
+        """
+        INSERT INTO queue_counters (queue_id, main_queue_count, selected_subqueue, queue_count_old, queue_count_new, subqueue_count_old, subqueue_count_new)
+        SELECT id, COALESCE(main_queue_count, 0), selected_subqueue, queue_count_old, queue_count_new, subqueue_count_old, subqueue_count_new
+        FROM queues WHERE id = ANY(%s)
+        ON CONFLICT (queue_id) DO NOTHING
+        """,
+        (ids,),
+    )
+    # Main counts are bumped in place; the old/new columns describe this change
+    yield (
+        """
+        UPDATE queue_counters c SET
+            main_queue_count = GREATEST(0, COALESCE(u.main_base, c.main_queue_count) + u.main_delta),
+            queue_count_new = GREATEST(0, COALESCE(u.main_base, c.main_queue_count) + u.main_delta),
+            queue_count_old = COALESCE(c.queue_count_old, u.main_prev, c.main_queue_count),
+            selected_subqueue = COALESCE(u.subqueue, c.selected_subqueue),
+            subqueue_count_old = CASE
+                WHEN u.subqueue IS NULL THEN c.subqueue_count_old
+                WHEN COALESCE(c.selected_subqueue, '') = '' OR c.selected_subqueue <> u.subqueue THEN u.sub_prev
+                ELSE COALESCE(c.subqueue_count_old, u.sub_prev)
+            END,
+            subqueue_count_new = CASE
+                WHEN u.subqueue IS NULL THEN c.subqueue_count_new
+                ELSE u.sub_count
+            END,
+            updated_at = NOW()
+        FROM unnest(%s::int[], %s::int[], %s::int[], %s::int[], %s::text[], %s::int[], %s::int[])
+            AS u(queue_id, main_base, main_delta, main_prev, subqueue, sub_prev, sub_count)
+        WHERE c.queue_id = u.queue_id
+        """,
+        tuple(list(col) for col in zip(*rows)),
+    )
+
+
+def _card_request_error(data):
+    """Client-facing error for an invalid POST /cards payload, or None."""
+    if (
+        not data.get("session_id")
+        or not data.get("card_id")
+        or not data.get("status")
+        or not data.get("queue_id")
+    ):
+        cards_log.info("Missing required fields")
+        return "session_id, card_id, status and queue_id are required"
+    if data.get("status") not in ("accept", "reject"):
+        cards_log.info("Invalid status value: %s", data.get("status"))
+        return "Invalid status value"
+    return None
+
+
+def _add_card_steps(session_id, started, card_id, status, queue_id, metadata):
+    """
+    Write one card and move its queue counts (statement generator, see
+    run_steps); returns the card's id. Runs in one transaction: card row
+    first, then the queue counters, retried on deadlock.
+    """
+    # check existing card (locked, so concurrent moves of one card queue up)
+    rows = yield (
+        "SELECT id, queue_id, metadata FROM cards WHERE session_id = %s AND card_id = %s AND session_started_at = %s FOR UPDATE",
+        (session_id, card_id, started),
+    )
+    metadata_json = json.dumps(metadata) if metadata is not None else None
+
+    if rows:
+        existing_id, old_queue_id, old_metadata = rows[0]
+        old_metadata = _stored_card_metadata(old_metadata)
+
+        rows = yield (
+            "UPDATE cards SET status = %s, queue_id = %s, metadata = %s, updated_at = NOW() WHERE id = %s AND session_started_at = %s RETURNING id",
+            (status, str(queue_id), metadata_json, existing_id, started),
+        )
+        # If queue changed, move the card's count to the new queue
+        # (cards.queue_id is text, so compare as strings)
+        if str(old_queue_id) != str(queue_id):
+            moves = {}
+            try:
+                moves.setdefault(int(old_queue_id), []).append((old_metadata, -1))
+            except (TypeError, ValueError):
+                pass
+            moves.setdefault(int(queue_id), []).append((metadata, 1))
+            yield from _card_moves_steps(moves)
+        return rows[0][0]
+
+    rows = yield (
+        "INSERT INTO cards (session_id, session_started_at, card_id, status, queue_id, metadata) VALUES (%s,%s,%s,%s,%s,%s) RETURNING id",
+        (session_id, started, card_id, status, str(queue_id), metadata_json),
+    )
+    # New card -> increment queue counts
+    try:
+        yield from _card_moves_steps({int(queue_id): [(metadata, 1)]})
+    except (TypeError, ValueError):
+        pass
+    return rows[0][0]
+
+
+# Counters returned with a card decision (fields of GET /queues)
+CARD_QUEUE_FIELDS = (
+    "id",
+    "name",
+    "main_queue_count",
+    "subqueue_counts",
+    "selected_subqueue",
+    "queue_count_old",
+    "queue_count_new",
+    "subqueue_count_old",
+    "subqueue_count_new",
+)
+CARD_QUEUE_SQL = (
+    "SELECT "
+    + ", ".join(QUEUE_LIST_FIELDS[f][0] for f in CARD_QUEUE_FIELDS)
+    + " FROM queues"
+    + QUEUE_COUNTERS_JOIN
+    + " WHERE queues.id = %s"
+)
 
 
 @app.route("/cards", methods=["POST"])
 def add_card():
     data = request.json or {}
-    print("[CARDS] Incoming payload:", data)
+    log_payload(cards_log, "Incoming payload:", data)
+    error = _card_request_error(data)
+    if error:
+        return jsonify({"success": False, "error": error}), 400
     session_id = data.get("session_id")
     card_id = data.get("card_id")
     status = data.get("status")
     queue_id = data.get("queue_id")
     metadata = data.get("metadata")
 
-    if not session_id or not card_id or not status or not queue_id:
-        print("[CARDS] Missing required fields")
-        return (
-            jsonify(
-                {
-                    "success": False,
-                    "error": "session_id, card_id, status and queue_id are required",
-                }
-            ),
-            400,
-        )
-
-    if status not in ("accept", "reject"):
-        print(f"[CARDS] Invalid status value: {status}")
-        return jsonify({"success": False, "error": "Invalid status value"}), 400
-
     try:
         conn = get_conn()
         cur = conn.cursor()
 
-        # ensure session exists
-        cur.execute("SELECT id FROM sessions WHERE id = %s", (session_id,))
-        if not cur.fetchone():
-            print(f"[CARDS] Session not found for session_id={session_id}")
+        # ensure session exists; its start time is the cards partition key
+        started = _session_starttime(cur, session_id)
+        if started is None:
+            cards_log.info("Session not found for session_id=%s", session_id)
             cur.close()
             conn.close()
             return jsonify({"success": False, "error": "Session not found"}), 404
@@ -1517,8 +3867,8 @@ def add_card():
             (queue_id, session_id),
         )
         if not cur.fetchone():
-            print(
-                f"[CARDS] Queue not found for queue_id={queue_id} session_id={session_id}"
+            cards_log.info(
+                "Queue not found for queue_id=%s session_id=%s", queue_id, session_id
             )
             cur.close()
             conn.close()
@@ -1529,90 +3879,31 @@ def add_card():
                 404,
             )
 
-        # check existing card
-        cur.execute(
-            "SELECT id, queue_id, metadata FROM cards WHERE session_id = %s AND card_id = %s",
-            (session_id, card_id),
-        )
-        existing = cur.fetchone()
-
-        if existing:
-            existing_id = existing[0]
-            old_queue_id = existing[1]
-            old_metadata_json = existing[2]
-            old_metadata = None
-            try:
-                old_metadata = (
-                    json.loads(old_metadata_json) if old_metadata_json else None
-                )
-            except Exception:
-                old_metadata = None
-
-            cur.execute(
-                "UPDATE cards SET status = %s, queue_id = %s, metadata = %s, updated_at = NOW() WHERE id = %s RETURNING id",
-                (
-                    status,
-                    queue_id,
-                    json.dumps(metadata) if metadata is not None else None,
-                    existing_id,
-                ),
-            )
-            card_db_id = cur.fetchone()[0]
-
-            # If queue changed, adjust counts
-            if old_queue_id != queue_id:
-                _adjust_queue_counts(cur, old_queue_id, old_metadata, delta=-1)
-                _adjust_queue_counts(cur, queue_id, metadata, delta=1)
-
-        else:
-            cur.execute(
-                "INSERT INTO cards (session_id, card_id, status, queue_id, metadata) VALUES (%s,%s,%s,%s,%s) RETURNING id",
-                (
-                    session_id,
-                    card_id,
-                    status,
-                    queue_id,
-                    json.dumps(metadata) if metadata is not None else None,
+        card_db_id = run_transaction(
+            conn,
+            lambda cur: run_steps(
+                cur,
+                _add_card_steps(
+                    session_id, started, card_id, status, queue_id, metadata
                 ),
-            )
-            card_db_id = cur.fetchone()[0]
-            # New card -> increment queue counts
-            _adjust_queue_counts(cur, queue_id, metadata, delta=1)
-
-        conn.commit()
-        print(f"[CARDS] Card inserted/updated: id={card_db_id}")
+            ),
+            "add_card",
+        )
+        cards_log.info("Card inserted/updated: id=%s", card_db_id)
         # Fetch updated queue counts to return to caller
         try:
-            cur.execute(
-                "SELECT id, name, main_queue_count, subqueue_counts, selected_subqueue, queue_count_old, queue_count_new, subqueue_count_old, subqueue_count_new FROM queues WHERE id = %s",
-                (queue_id,),
-            )
+            cur.execute(CARD_QUEUE_SQL, (queue_id,))
             qrow = cur.fetchone()
-            queue_info = None
-            if qrow:
-                queue_info = {
-                    "id": qrow[0],
-                    "name": qrow[1],
-                    "main_queue_count": qrow[2],
-                    "subqueue_counts": json.loads(qrow[3]) if qrow[3] else {},
-                    "selected_subqueue": qrow[4],
-                    "queue_count_old": qrow[5],
-                    "queue_count_new": qrow[6],
-                    "subqueue_count_old": qrow[7],
-                    "subqueue_count_new": qrow[8],
-                }
+            queue_info = _queue_row_to_dict(CARD_QUEUE_FIELDS, qrow) if qrow else None
         except Exception as e:
-            print(f"[CARDS] Failed to fetch queue info: {e}")
+            cards_log.warning("Failed to fetch queue info: %s", e)
             queue_info = None
 
         cur.close()
         conn.close()
         return jsonify({"success": True, "card_id": card_db_id, "queue": queue_info})
     except Exception as e:
-        print(f"[CARDS] Exception: {e}")
-        import traceback
-
-        traceback.print_exc()
+        cards_log.exception("Failed to add card: %s", e)
         return (
             jsonify(
                 {"success": False, "error": "Failed to add card", "detail": str(e)}
@@ -1621,114 +3912,214 @@ def add_card():
         )
 
 
+def _parse_bulk_cards(cards):
+    """
+    Validate each card of a POST /cards/bulk payload. Returns (results,
+    pending): results holds the per-card errors (None for cards still to
+    write) and pending the cards to write, as
+    (index, session_id, card_id, status, queue_id, metadata).
+    """
+    results = [None] * len(cards)
+    pending = []
+    for i, c in enumerate(cards):
+        c = c if isinstance(c, dict) else {}
+        session_id = c.get("session_id")
+        card_id = c.get("card_id")
+        status = c.get("status")
+        queue_id = c.get("queue_id")
+        metadata = c.get("metadata")
+
+        if not session_id or not card_id or not status or not queue_id:
+            results[i] = {
+                "card_id": card_id,
+                "success": False,
+                "error": "missing fields",
+            }
+            continue
+        if status not in ("accept", "reject"):
+            results[i] = {
+                "card_id": card_id,
+                "success": False,
+                "error": "invalid status",
+            }
+            continue
+        try:
+            queue_id = int(queue_id)
+        except (TypeError, ValueError):
+            results[i] = {
+                "card_id": card_id,
+                "success": False,
+                "error": "queue not found for session",
+            }
+            continue
+        pending.append((i, session_id, str(card_id), status, queue_id, metadata))
+    return results, pending
+
+
+def _bulk_cards_steps(cards, pending, results):
+    """
+    Write the pending cards of a bulk request (statement generator, see
+    run_steps) and fill in results. Everything runs in one transaction that
+    is retried from the start on deadlock; locks are taken cards first (in
+    key order), then queue counters, the same order add_card uses.
+    """
+    # ensure sessions and queues exist (one query for all pairs)
+    pairs = sorted({(p[1], p[4]) for p in pending})
+    rows = yield (
+        """
+        SELECT p.session_id, p.queue_id, s.starttime, q.id IS NOT NULL
+        FROM unnest(%s::varchar[], %s::int[]) AS p(session_id, queue_id)
+        LEFT JOIN sessions s ON s.id = p.session_id
+        LEFT JOIN queues q ON q.id = p.queue_id AND q.session_id = p.session_id
+        """,
+        ([p[0] for p in pairs], [p[1] for p in pairs]),
+    )
+    checks = {}
+    started = {}  # session_id -> starttime (the cards partition key)
+    for session_id, queue_id, starttime, queue_ok in rows:
+        checks[(session_id, queue_id)] = (starttime is not None, queue_ok)
+        if starttime is not None:
+            started[session_id] = starttime
+            session_cache.add(session_id, starttime)
+    valid = []
+    for p in pending:
+        session_ok, queue_ok = checks[(p[1], p[4])]
+        if not session_ok:
+            results[p[0]] = {
+                "card_id": cards[p[0]]["card_id"],
+                "success": False,
+                "error": "session not found",
+            }
+        elif not queue_ok:
+            results[p[0]] = {
+                "card_id": cards[p[0]]["card_id"],
+                "success": False,
+                "error": "queue not found for session",
+            }
+        else:
+            valid.append(p)
+
+    # check existing cards (one query)
+    keys = sorted({(p[1], p[2]) for p in valid})
+    rows = yield (
+        """
+        SELECT c.session_id, c.card_id, c.queue_id, c.metadata
+        FROM cards c
+        JOIN unnest(%s::varchar[], %s::varchar[], %s::timestamptz[]) AS k(session_id, card_id, started)
+          ON c.session_id = k.session_id AND c.card_id = k.card_id
+         AND c.session_started_at = k.started
+        ORDER BY c.session_id, c.card_id
+        FOR UPDATE OF c
+        """,
+        (
+            [k[0] for k in keys],
+            [k[1] for k in keys],
+            [started[k[0]] for k in keys],
+        ),
+    )
+    # (queue_id, metadata) each card is currently counted under
+    current = {(r[0], r[1]): (r[2], _stored_card_metadata(r[3])) for r in rows}
+
+    # Replay the cards in order to get each card's final state and the
+    # sequence of count adjustments per queue
+    final = {}
+    adjustments = {}  # queue_id -> [(metadata, delta), ...]
+    for _, session_id, card_id, status, queue_id, metadata in valid:
+        key = (session_id, card_id)
+        if key in current:
+            old_queue_id, old_metadata = current[key]
+            # If queue changed, move the card's count to the new queue,
+            # decrementing the subqueue it was counted under (its stored
+            # metadata, or its previous occurrence in this batch), as
+            # add_card does
+            if str(old_queue_id) != str(queue_id):
+                try:
+                    adjustments.setdefault(int(old_queue_id), []).append(
+                        (old_metadata, -1)
+                    )
+                except (TypeError, ValueError):
+                    pass
+                adjustments.setdefault(queue_id, []).append((metadata, 1))
+        else:
+            # New card -> increment queue counts
+            adjustments.setdefault(queue_id, []).append((metadata, 1))
+        current[key] = (queue_id, metadata)
+        final[key] = (status, str(queue_id), metadata)
+
+    # upsert all cards in one statement
+    final_keys = sorted(final)
+    rows = yield (
+        """
+        INSERT INTO cards (session_id, session_started_at, card_id, status, queue_id, metadata)
+        SELECT * FROM unnest(%s::varchar[], %s::timestamptz[], %s::varchar[], %s::varchar[], %s::varchar[], %s::jsonb[])
+        ON CONFLICT (session_id, card_id, session_started_at) DO UPDATE SET
+            status = EXCLUDED.status,
+            queue_id = EXCLUDED.queue_id,
+            metadata = EXCLUDED.metadata,
+            updated_at = NOW()
+        RETURNING session_id, card_id, id
+        """,
+        (
+            [k[0] for k in final_keys],
+            [started[k[0]] for k in final_keys],
+            [k[1] for k in final_keys],
+            [final[k][0] for k in final_keys],
+            [final[k][1] for k in final_keys],
+            [
+                json.dumps(final[k][2]) if final[k][2] is not None else None
+                for k in final_keys
+            ],
+        ),
+    )
+    card_db_ids = {(r[0], r[1]): r[2] for r in rows}
+
+    # Fold every adjustment per queue and apply them with a fixed
+    # number of atomic counter statements
+    yield from _card_moves_steps(adjustments)
+
+    for i, session_id, card_id, _, _, _ in valid:
+        results[i] = {
+            "card_id": cards[i]["card_id"],
+            "success": True,
+            "card_db_id": card_db_ids[(session_id, card_id)],
+        }
+
+
 @app.route("/cards/bulk", methods=["POST"])
 def add_cards_bulk():
+    """
+    Insert/update many cards in one transaction with set-based statements:
+    one query validates every (session, queue) pair, one reads existing cards,
+    one upserts all cards, and queue counts are folded per queue in Python and
+    applied with atomic counter updates (see _card_moves_steps). Results stay
+    per card.
+    """
     data = request.json or {}
     cards = data.get("cards")
     if not cards or not isinstance(cards, list):
         return jsonify({"success": False, "error": "cards list required"}), 400
 
-    results = []
+    results, pending = _parse_bulk_cards(cards)
+    conn = None
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        for c in cards:
-            session_id = c.get("session_id")
-            card_id = c.get("card_id")
-            status = c.get("status")
-            queue_id = c.get("queue_id")
-            metadata = c.get("metadata")
-
-            if not session_id or not card_id or not status or not queue_id:
-                results.append(
-                    {"card_id": card_id, "success": False, "error": "missing fields"}
-                )
-                continue
-
-            try:
-                # ensure session and queue exist
-                cur.execute("SELECT id FROM sessions WHERE id = %s", (session_id,))
-                if not cur.fetchone():
-                    results.append(
-                        {
-                            "card_id": card_id,
-                            "success": False,
-                            "error": "session not found",
-                        }
-                    )
-                    continue
-                cur.execute(
-                    "SELECT id FROM queues WHERE id = %s AND session_id = %s",
-                    (queue_id, session_id),
-                )
-                if not cur.fetchone():
-                    results.append(
-                        {
-                            "card_id": card_id,
-                            "success": False,
-                            "error": "queue not found for session",
-                        }
-                    )
-                    continue
-
-                # check existing
-                cur.execute(
-                    "SELECT id, queue_id, metadata FROM cards WHERE session_id = %s AND card_id = %s",
-                    (session_id, card_id),
-                )
-                existing = cur.fetchone()
-                if existing:
-                    eid = existing[0]
-                    old_queue_id = existing[1]
-                    old_metadata_json = existing[2]
-                    old_metadata = None
-                    try:
-                        old_metadata = (
-                            json.loads(old_metadata_json) if old_metadata_json else None
-                        )
-                    except Exception:
-                        old_metadata = None
-
-                    cur.execute(
-                        "UPDATE cards SET status = %s, queue_id = %s, metadata = %s, updated_at = NOW() WHERE id = %s RETURNING id",
-                        (
-                            status,
-                            queue_id,
-                            json.dumps(metadata) if metadata is not None else None,
-                            eid,
-                        ),
-                    )
-                    cid = cur.fetchone()[0]
-                    if old_queue_id != queue_id:
-                        _adjust_queue_counts(cur, old_queue_id, old_metadata, delta=-1)
-                        _adjust_queue_counts(cur, queue_id, metadata, delta=1)
-                    results.append(
-                        {"card_id": card_id, "success": True, "card_db_id": cid}
-                    )
-                else:
-                    cur.execute(
-                        "INSERT INTO cards (session_id, card_id, status, queue_id, metadata) VALUES (%s,%s,%s,%s,%s) RETURNING id",
-                        (
-                            session_id,
-                            card_id,
-                            status,
-                            queue_id,
-                            json.dumps(metadata) if metadata is not None else None,
-                        ),
-                    )
-                    cid = cur.fetchone()[0]
-                    _adjust_queue_counts(cur, queue_id, metadata, delta=1)
-                    results.append(
-                        {"card_id": card_id, "success": True, "card_db_id": cid}
-                    )
-            except Exception as e:
-                results.append({"card_id": card_id, "success": False, "error": str(e)})
+        if pending:
+            conn = get_conn()
+            run_transaction(
+                conn,
+                lambda cur: run_steps(cur, _bulk_cards_steps(cards, pending, results)),
+                "cards_bulk",
+            )
+            conn.close()
 
-        conn.commit()
-        cur.close()
-        conn.close()
         return jsonify({"success": True, "results": results})
     except Exception as e:
+        cards_bulk_log.exception("Bulk insert failed: %s", e)
+        try:
+            if conn is not None:
+                conn.rollback()
+                conn.close()
+        except Exception:
+            pass
         return (
             jsonify(
                 {"success": False, "error": "Bulk insert failed", "detail": str(e)}
@@ -1737,8 +4128,118 @@ def add_cards_bulk():
         )
 
 
+# --- DAILY ACTIVITY (reads the user_daily_activity rollup kept by triggers) ---
+ACTIVITY_DEFAULT_DAYS = int(os.getenv("ACTIVITY_DEFAULT_DAYS", 30))
+ACTIVITY_MAX_DAYS = int(os.getenv("ACTIVITY_MAX_DAYS", 366))
+ACTIVITY_FIELDS = (
+    "videos_watched",
+    "watched_seconds",
+    "loop_time",
+    "inactivity_seconds",
+    "session_count",
+    "session_seconds",
+    "cards_accepted",
+    "cards_rejected",
+)
+
+
+def _parse_day_arg(args, name, default):
+    value = args.get(name)
+    if not value:
+        return default
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid {name}: expected a YYYY-MM-DD date")
+
+
+def _activity_range(args):
+    """
+    Parse ?from=&to= (inclusive UTC days). Defaults to the last
+    ACTIVITY_DEFAULT_DAYS days; raises ValueError with a client-facing message.
+    """
+    to_day = _parse_day_arg(args, "to", datetime.now(timezone.utc).date())
+    from_day = _parse_day_arg(
+        args, "from", to_day - timedelta(days=ACTIVITY_DEFAULT_DAYS - 1)
+    )
+    if from_day > to_day:
+        raise ValueError("Invalid range: from is after to")
+    if (to_day - from_day).days >= ACTIVITY_MAX_DAYS:
+        raise ValueError(f"Invalid range: at most {ACTIVITY_MAX_DAYS} days")
+    return from_day, to_day
+
+
+@app.route("/activity/daily", methods=["GET"])
+def daily_activity():
+    """
+    Per-user daily totals from the user_daily_activity rollup: one row per
+    (user, day) with activity, ordered by user then day. ?user_id= narrows to
+    one user; days are the UTC day each session started.
+    """
+    try:
+        from_day, to_day = _activity_range(request.args)
+        user_id = request.args.get("user_id")
+        if user_id is not None:
+            try:
+                user_id = int(user_id)
+            except ValueError:
+                raise ValueError("Invalid user_id")
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    where, params = ["day BETWEEN %s AND %s"], [from_day, to_day]
+    if user_id is not None:
+        where.append("user_id = %s")
+        params.append(user_id)
+    try:
+        conn = get_conn()
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT user_id, day, {', '.join(ACTIVITY_FIELDS)} FROM user_daily_activity "
+            f"WHERE {' AND '.join(where)} ORDER BY user_id, day",
+            params,
+        )
+        days = [
+            dict(
+                {"user_id": row[0], "day": row[1].isoformat()},
+                **{
+                    # NUMERIC columns come back as Decimal
+                    name: float(value) if isinstance(value, Decimal) else value
+                    for name, value in zip(ACTIVITY_FIELDS, row[2:])
+                },
+            )
+            for row in cur.fetchall()
+        ]
+        cur.close()
+        conn.close()
+        return jsonify(
+            {
+                "success": True,
+                "from": from_day.isoformat(),
+                "to": to_day.isoformat(),
+                "days": days,
+            }
+        )
+    except Exception as e:
+        activity_log.exception("Failed to read daily activity: %s", e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+def warm_caches():
+    """Build lookup caches up front so the first requests don't pay for them."""
+    try:
+        get_allowed_queue_index()
+        reference_cache.get("usertypes", _load_usertypes)
+        reference_cache.get("whitelisted_urls", _load_whitelisted_urls)
+        reference_cache.get("allowed_queues", _load_allowed_queues)
+    except Exception as e:
+        startup_log.warning("Failed to warm caches: %s", e)
+
+
+# Development server (single process); see serve.py for pre-forked workers
 if __name__ == "__main__":
     import os
 
+    warm_caches()
     port = int(os.getenv("PORT", 8080))
     app.run(host="0.0.0.0", port=port)
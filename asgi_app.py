@@ -0,0 +1,621 @@
+"""
+ASGI entry point. The high-volume extension routes (auto_session, end_session,
+log_video, log_inactivity, cards, cards/bulk and GET /queues) are served
+natively on Starlette with a psycopg 3 AsyncConnectionPool, so an in-flight
+heartbeat holds a coroutine rather than a thread. Every other route (POST
+/queues, register, reference data, /stats, /metrics, ...) is forwarded to the
+Flask app in app.py through a WSGI bridge, unchanged.
+
+Request parsing, caches, SQL and response bodies are shared with app.py, so
+both entry points keep the same JSON contracts.
+
+    pip install -r requirements-async.txt
+    uvicorn asgi_app:asgi --host 0.0.0.0 --port 8080 --workers 4
+"""
+
+import asyncio
+import contextvars
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+import psycopg
+from a2wsgi import WSGIMiddleware
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+
+import app as backend
+
+ASYNC_DB_POOL_MIN_SIZE = int(
+    os.getenv("ASYNC_DB_POOL_MIN_SIZE", backend.DB_POOL_MIN_SIZE)
+)
+ASYNC_DB_POOL_MAX_SIZE = int(os.getenv("ASYNC_DB_POOL_MAX_SIZE", 20))
+# Threads serving the routes forwarded to Flask
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", 10))
+
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type,Authorization",
+    "Access-Control-Allow-Methods": "GET,PUT,POST,DELETE,OPTIONS",
+    "Access-Control-Allow-Private-Network": "true",
+}
+
+
+# --- ASYNC CONNECTION POOL ---
+_request_db = contextvars.ContextVar("request_db", default=None)
+
+
+class InstrumentedAsyncCursor(psycopg.AsyncCursor):
+    """Counts statements and their time against the current request (see app.py)."""
+
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            db = _request_db.get()
+            if db is not None:
+                db[0] += 1
+                db[1] += elapsed
+            else:
+                backend.request_metrics.record_background_query(elapsed)
+
+
+# Autocommit, like the psycopg2 pool: each statement stands alone, so a failed
+# optional insert (keys, speeds) does not undo the video row
+pool = AsyncConnectionPool(
+    backend.DATABASE_URL,
+    min_size=ASYNC_DB_POOL_MIN_SIZE,
+    max_size=ASYNC_DB_POOL_MAX_SIZE,
+    timeout=backend.DB_POOL_TIMEOUT,
+    max_lifetime=backend.DB_POOL_MAX_LIFETIME,
+    kwargs={"autocommit": True, "cursor_factory": InstrumentedAsyncCursor},
+    check=AsyncConnectionPool.check_connection,
+    open=False,
+)
+
+
+class _LeaderCancelled(Exception):
+    """Set on a flight whose leading call was cancelled; waiters retry."""
+
+
+class AsyncSingleFlight:
+    """asyncio counterpart of app.SingleFlight (one event loop per process)."""
+
+    def __init__(self):
+        self._calls = {}  # key -> Future
+
+    async def do(self, key, fn):
+        """Return (fn's result, shared) where shared is True for waiters."""
+        while True:
+            call = self._calls.get(key)
+            if call is None:
+                break
+            try:
+                return await asyncio.shield(call), True
+            except _LeaderCancelled:
+                continue  # the leader's request went away; lead or join again
+        call = asyncio.get_running_loop().create_future()
+        self._calls[key] = call
+        try:
+            result = await fn()
+            call.set_result(result)
+            return result, False
+        except Exception as e:
+            call.set_exception(e)
+            call.exception()  # waiters re-raise it; don't warn if there are none
+            raise
+        finally:
+            # CancelledError is a BaseException and skips the handler above;
+            # resolve the future anyway so waiters never hang on it
+            if not call.done():
+                call.set_exception(_LeaderCancelled())
+                call.exception()
+            del self._calls[key]
+
+
+auto_session_flights = AsyncSingleFlight()
+
+
+async def _session_starttime(cur, session_id):
+    """Async counterpart of app._session_starttime (shares its session_cache)."""
+    hit, starttime = backend.session_cache.get(session_id)
+    if hit:
+        return starttime
+    await cur.execute("SELECT starttime FROM sessions WHERE id = %s", (session_id,))
+    row = await cur.fetchone()
+    if not row:
+        return None
+    backend.session_cache.add(session_id, row[0])
+    return row[0]
+
+
+async def _run_steps(cur, steps):
+    """Async counterpart of app.run_steps."""
+    rows = None
+    while True:
+        try:
+            sql, params = steps.send(rows)
+        except StopIteration as done:
+            return done.value
+        await cur.execute(sql, params)
+        rows = await cur.fetchall() if cur.description else None
+
+
+async def _run_transaction(conn, make_steps, label):
+    """
+    Async counterpart of app.run_transaction: runs the statements of
+    make_steps() in one transaction on conn, retried from the start (with a
+    fresh generator) on deadlock or serialization failure.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        backend.transaction_retries.count(label, "transactions")
+        try:
+            async with conn.transaction():
+                return await _run_steps(conn.cursor(), make_steps())
+        except psycopg.Error as e:
+            delay = backend.transaction_retry_delay(label, e.sqlstate, attempt)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+
+
+# --- RESPONSES AND ROUTING ---
+def _json(body, status=200):
+    """JSON response encoded exactly like Flask's jsonify."""
+    return Response(
+        backend.app.json.dumps(body, separators=(",", ":")) + "\n",
+        status_code=status,
+        media_type="application/json",
+        headers=CORS_HEADERS,
+    )
+
+
+async def _json_body(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+routes = []
+
+
+def _metered(path, handler):
+    """Wrap a handler so it is recorded in app.request_metrics like Flask's hooks."""
+
+    async def endpoint(request):
+        if not backend.METRICS_ENABLED:
+            return await handler(request)
+        key = (path, request.method)
+        db = [0, 0.0]
+        token = _request_db.set(db)
+        backend.request_metrics.start(key)
+        start = time.perf_counter()
+        status = "500"
+        try:
+            response = await handler(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            _request_db.reset(token)
+            backend.request_metrics.finish(
+                key, status, time.perf_counter() - start, db[0], db[1]
+            )
+
+    return endpoint
+
+
+def route(path, methods):
+    """Register a native route."""
+
+    def decorator(handler):
+        routes.append(Route(path, _metered(path, handler), methods=methods))
+        return handler
+
+    return decorator
+
+
+# --- AUTO SESSION ---
+async def _start_session_for_ip(ip_address):
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            backend.AUTO_SESSION_SQL, backend._auto_session_params(ip_address)
+        )
+        row = await cur.fetchone()
+    return backend._remember_auto_session(ip_address, row)
+
+
+@route("/auto_session", methods=["POST"])
+async def auto_session(request):
+    try:
+        ip_address = backend._client_ip(
+            request.headers.get("X-Forwarded-For"),
+            request.client.host if request.client else None,
+        )
+        session = backend.recent_sessions.get(ip_address)
+        if session is not None:
+            backend.recent_sessions.count("reused_recent")
+            reused = True
+        else:
+            session, shared = await auto_session_flights.do(
+                ip_address, lambda: _start_session_for_ip(ip_address)
+            )
+            reused = backend._count_auto_session(session, shared)
+        return _json(backend._auto_session_response(session, reused, ip_address))
+    except Exception as e:
+        backend.auto_session_log.exception("Auto session failed: %s", e)
+        return _json(
+            {"success": False, "error": "Auto session failed", "detail": str(e)}, 500
+        )
+
+
+# --- END SESSION ---
+@route("/end_session", methods=["POST"])
+async def end_session(request):
+    data = await _json_body(request)
+    session_id = data.get("session_id") if data else None
+    if not session_id:
+        return _json({"success": False, "error": "Missing session_id"}, 400)
+
+    try:
+        async with pool.connection() as conn:
+            cur = await conn.execute(
+                "SELECT user_id, starttime, total_videos_watched FROM sessions WHERE id = %s",
+                (session_id,),
+            )
+            row = await cur.fetchone()
+            if not row:
+                return _json({"success": False, "error": "Session not found"}, 404)
+
+            user_id, starttime, total_videos = row
+            endtime = datetime.now(timezone.utc)
+            duration = None
+            if starttime:
+                duration = (endtime - starttime).total_seconds()
+
+            await cur.execute(
+                "UPDATE sessions SET endtime = %s, duration = %s WHERE id = %s",
+                (endtime, duration, session_id),
+            )
+            backend.session_cache.discard(session_id)
+            if user_id:
+                await cur.execute(
+                    "INSERT INTO useractivities (userid, activitytype, timestamp, created_at, updated_at) VALUES (%s, %s, %s, %s, %s)",
+                    (user_id, "session_end", endtime, endtime, endtime),
+                )
+
+        return _json(
+            {
+                "success": True,
+                "endtime": endtime.isoformat(),
+                "duration": duration,
+                "total_videos_watched": total_videos,
+            }
+        )
+    except Exception as e:
+        return _json(
+            {"success": False, "error": "End session failed", "detail": str(e)}, 500
+        )
+
+
+# --- LOG VIDEO ---
+@route("/log_video", methods=["POST"])
+async def log_video(request):
+    data = await _json_body(request)
+    if data is None:
+        return _json({"success": False, "error": "Invalid JSON body"}, 400)
+    backend.log_payload(backend.video_log, "Incoming data:", data)
+    session_id = data.get("session_id")
+    if not session_id:
+        return _json({"success": False, "error": "Missing session_id"}, 400)
+
+    try:
+        event = backend._parse_video_event(data)
+        keys = event["keys"]
+        speeds = event["speeds"]
+        speed_values = sorted({backend._parse_speed(sp) for sp in speeds or [1.0]})
+
+        async with pool.connection() as conn:
+            cur = conn.cursor()
+            started = await _session_starttime(cur, session_id)
+            if started is None:
+                return _json({"success": False, "error": "Session not found"}, 404)
+            event["session_started_at"] = started
+
+            if backend.video_write_buffer.submit(event):
+                video_entry = backend._video_response_entry(event, speeds or [1.0])
+                return _json({"success": True, "video": video_entry, "buffered": True})
+
+            await cur.execute(
+                backend.VIDEO_UPSERT_SQL, backend._video_upsert_params(event)
+            )
+            vid, is_new_video = await cur.fetchone()
+            if is_new_video:
+                await cur.execute(
+                    "UPDATE sessions SET total_videos_watched = total_videos_watched + 1 WHERE id = %s",
+                    (session_id,),
+                )
+
+            try:
+                await cur.execute(
+                    backend.VIDEO_KEYS_INSERT_SQL,
+                    backend._video_keys_params(
+                        [vid] * max(len(keys), 1),
+                        [started] * max(len(keys), 1),
+                        keys or [None],
+                    ),
+                )
+            except Exception as e:
+                backend.video_log.warning("Key insert failed: %s", e)
+            if keys:
+                try:
+                    await cur.execute(
+                        backend.RETROACTIVE_KEYS_SQL,
+                        backend._retroactive_keys_params(
+                            session_id, started, vid, keys
+                        ),
+                    )
+                except Exception as e:
+                    backend.video_log.warning(
+                        "Retroactive key assignment failed: %s", e
+                    )
+            try:
+                await cur.execute(
+                    backend.VIDEO_SPEEDS_INSERT_SQL,
+                    backend._video_speeds_params(
+                        [vid] * len(speed_values),
+                        [started] * len(speed_values),
+                        speed_values,
+                    ),
+                )
+            except Exception as e:
+                backend.video_log.warning("Speed insert failed: %s", e)
+
+        backend.write_verifier.submit(
+            vid, started, event["watched"], event["loop_time"]
+        )
+        video_entry = backend._video_response_entry(event, speeds or [1.0])
+        return _json({"success": True, "video": video_entry})
+    except Exception as e:
+        backend.video_log.exception("Failed to log video: %s", e)
+        return _json(
+            {"success": False, "error": "Failed to log video", "detail": str(e)}, 500
+        )
+
+
+# --- LOG INACTIVITY ---
+@route("/log_inactivity", methods=["POST"])
+async def log_inactivity(request):
+    data = await _json_body(request)
+    session_id = data.get("session_id") if data else None
+    if not session_id:
+        return _json({"success": False, "error": "Missing session_id"}, 400)
+
+    inactivity_entry = backend._inactivity_entry(data)
+    try:
+        async with pool.connection() as conn:
+            cur = conn.cursor()
+            starttime = await _session_starttime(cur, session_id)
+            if starttime is None:
+                return _json({"success": False, "error": "Session not found"}, 404)
+
+            await cur.execute(
+                "INSERT INTO inactivity (session_id, starttime, endtime, duration, type) VALUES (%s,%s,%s,%s,%s)",
+                (
+                    session_id,
+                    inactivity_entry.get("starttime"),
+                    inactivity_entry.get("endtime"),
+                    inactivity_entry.get("duration"),
+                    inactivity_entry.get("type"),
+                ),
+            )
+
+            new_session_id = None
+            if backend._inactivity_splits_session(inactivity_entry):
+                endtime = datetime.now(timezone.utc)
+                duration = (endtime - starttime).total_seconds() if starttime else None
+                await cur.execute(
+                    "UPDATE sessions SET endtime = %s, duration = %s WHERE id = %s",
+                    (endtime, duration, session_id),
+                )
+                new_session_id = backend.generate_session_id()
+                await cur.execute(
+                    "INSERT INTO sessions (id, user_id, starttime) SELECT %s, user_id, %s FROM sessions WHERE id = %s",
+                    (new_session_id, endtime, session_id),
+                )
+
+        if new_session_id:
+            backend.session_cache.discard(session_id)
+            backend.session_cache.add(new_session_id, endtime)
+        resp = {"success": True, "inactivity": inactivity_entry}
+        if new_session_id:
+            resp.update({"action": "session_split", "new_session_id": new_session_id})
+        return _json(resp)
+    except Exception as e:
+        return _json(
+            {
+                "success": False,
+                "error": "Failed to log inactivity",
+                "detail": str(e),
+            },
+            500,
+        )
+
+
+# --- CARDS ---
+@route("/cards", methods=["POST"])
+async def add_card(request):
+    data = await _json_body(request) or {}
+    backend.log_payload(backend.cards_log, "Incoming payload:", data)
+    error = backend._card_request_error(data)
+    if error:
+        return _json({"success": False, "error": error}, 400)
+    session_id = data.get("session_id")
+    card_id = data.get("card_id")
+    status = data.get("status")
+    queue_id = data.get("queue_id")
+    metadata = data.get("metadata")
+
+    try:
+        async with pool.connection() as conn:
+            cur = conn.cursor()
+            # ensure session exists; its start time is the cards partition key
+            started = await _session_starttime(cur, session_id)
+            if started is None:
+                backend.cards_log.info(
+                    "Session not found for session_id=%s", session_id
+                )
+                return _json({"success": False, "error": "Session not found"}, 404)
+
+            # ensure queue exists and belongs to session
+            await cur.execute(
+                "SELECT id FROM queues WHERE id = %s AND session_id = %s",
+                (queue_id, session_id),
+            )
+            if not await cur.fetchone():
+                backend.cards_log.info(
+                    "Queue not found for queue_id=%s session_id=%s",
+                    queue_id,
+                    session_id,
+                )
+                return _json(
+                    {"success": False, "error": "Queue not found for this session"},
+                    404,
+                )
+
+            card_db_id = await _run_transaction(
+                conn,
+                lambda: backend._add_card_steps(
+                    session_id, started, card_id, status, queue_id, metadata
+                ),
+                "add_card",
+            )
+            backend.cards_log.info("Card inserted/updated: id=%s", card_db_id)
+            # Fetch updated queue counts to return to caller
+            try:
+                await cur.execute(backend.CARD_QUEUE_SQL, (queue_id,))
+                qrow = await cur.fetchone()
+                queue_info = (
+                    backend._queue_row_to_dict(backend.CARD_QUEUE_FIELDS, qrow)
+                    if qrow
+                    else None
+                )
+            except Exception as e:
+                backend.cards_log.warning("Failed to fetch queue info: %s", e)
+                queue_info = None
+
+        return _json({"success": True, "card_id": card_db_id, "queue": queue_info})
+    except Exception as e:
+        backend.cards_log.exception("Failed to add card: %s", e)
+        return _json(
+            {"success": False, "error": "Failed to add card", "detail": str(e)}, 500
+        )
+
+
+@route("/cards/bulk", methods=["POST"])
+async def add_cards_bulk(request):
+    data = await _json_body(request) or {}
+    cards = data.get("cards")
+    if not cards or not isinstance(cards, list):
+        return _json({"success": False, "error": "cards list required"}, 400)
+
+    results, pending = backend._parse_bulk_cards(cards)
+    try:
+        if pending:
+            async with pool.connection() as conn:
+                await _run_transaction(
+                    conn,
+                    lambda: backend._bulk_cards_steps(cards, pending, results),
+                    "cards_bulk",
+                )
+        return _json({"success": True, "results": results})
+    except Exception as e:
+        backend.cards_bulk_log.exception("Bulk insert failed: %s", e)
+        return _json(
+            {"success": False, "error": "Bulk insert failed", "detail": str(e)}, 500
+        )
+
+
+# --- QUEUES (listing; streamed exports and writes go to Flask) ---
+flask_app = WSGIMiddleware(backend.app, workers=WSGI_THREADS)
+
+
+async def list_queues(request):
+    try:
+        sql, params, fields, limit = backend._build_queue_list_query(
+            request.query_params
+        )
+    except ValueError as e:
+        return _json({"success": False, "error": str(e)}, 400)
+
+    try:
+        async with pool.connection() as conn:
+            cur = await conn.execute(sql, params)
+            rows = await cur.fetchall()
+        queues = [backend._queue_row_to_dict(fields, r) for r in rows]
+        # A full page means there may be more rows below the last id
+        next_cursor = queues[-1]["id"] if limit and len(queues) == limit else None
+        return _json({"success": True, "queues": queues, "next_cursor": next_cursor})
+    except Exception as e:
+        backend.queues_log.exception("Failed to list queues: %s", e)
+        return _json({"success": False, "error": str(e)}, 500)
+
+
+class ListQueues:
+    """
+    GET /queues as a raw ASGI app: paged listings are answered natively,
+    ?stream=1 / ?format=ndjson exports go to Flask's server-side cursor.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        args = request.query_params
+        if args.get("format") == "ndjson" or args.get("stream") in ("1", "true"):
+            return await flask_app(scope, receive, send)
+        response = await self.endpoint(request)
+        await response(scope, receive, send)
+
+
+routes.append(
+    Route("/queues", ListQueues(_metered("/queues", list_queues)), methods=["GET"])
+)
+
+
+# --- APPLICATION ---
+async def preflight(request):
+    return _json({"status": "ok"})
+
+
+@asynccontextmanager
+async def lifespan(_):
+    await pool.open()
+    # Reference data is loaded through the psycopg2 pool; keep it off the loop
+    await asyncio.to_thread(backend.warm_caches)
+    try:
+        yield
+    finally:
+        await pool.close()
+
+
+asgi = Starlette(
+    routes=routes
+    + [
+        Route("/{path:path}", preflight, methods=["OPTIONS"]),
+        # Everything else is served by the Flask app, unchanged
+        Mount("", app=flask_app),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,495 @@
+"""
+Endpoint load test: replays a weighted mix of extension traffic against the
+Flask app and reports throughput, p50/p95/p99 latency and DB queries per
+request for each endpoint.
+
+By default the app is served in-process (threaded werkzeug server) against a
+local Postgres given by --dsn or DATABASE_URL; --init-schema reloads
+schema.sql first (this DROPS all tables). Results are written as JSON to
+benchmarks/results/ and can be compared with an earlier run:
+
+    python benchmarks/load_test.py --dsn postgresql://postgres@localhost/bench \\
+        --init-schema --concurrency 16 --duration 30
+    python benchmarks/load_test.py --duration 30 --compare benchmarks/results/<old>.json
+
+--url targets an already running server instead; queries-per-request then
+only reflects the worker process that answered /metrics.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+
+DEFAULT_MIX = (
+    "log_video=50,log_inactivity=8,cards=15,cards_bulk=3,"
+    "queues_get=10,queues_post=5,auto_session=5,end_session=1"
+)
+LOCAL_HOSTS = ("", "localhost", "127.0.0.1", "::1")
+
+_METRIC_RE = re.compile(r"^(\w+)\{([^}]*)\} (\S+)$")
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+# --- SETUP (local database and in-process server) ---
+def is_local_dsn(dsn):
+    import psycopg2.extensions
+
+    host = psycopg2.extensions.parse_dsn(dsn).get("host") or ""
+    # Unix socket directories are local by definition
+    return host.startswith("/") or all(
+        h.strip() in LOCAL_HOSTS for h in host.split(",")
+    )
+
+
+def init_schema(dsn):
+    import psycopg2
+
+    with open(os.path.join(REPO_ROOT, "schema.sql")) as f:
+        schema = f.read()
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        conn.cursor().execute(schema)
+    finally:
+        conn.close()
+
+
+def start_server(dsn):
+    """Import app.py against dsn and serve it on an ephemeral local port."""
+    os.environ["DATABASE_URL"] = dsn
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, REPO_ROOT)
+    import app as backend
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    backend.warm_caches()
+    server = make_server(
+        "127.0.0.1", 0, backend.app, threaded=True, request_handler=KeepAliveHandler
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+# --- TRAFFIC (simulated extension clients) ---
+class Client:
+    """One browser extension: its IP, current session, queues and cards."""
+
+    def __init__(self, index):
+        self.ip = f"10.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255}"
+        self.session_id = None
+        self.queue_ids = []
+        self.video = 0
+        self.watched = 0
+
+
+class Worker(threading.Thread):
+    def __init__(self, base_url, clients, ops, weights, deadline, max_requests, seed):
+        super().__init__(daemon=True)
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.clients = clients
+        self.ops = ops
+        self.weights = weights
+        self.deadline = deadline
+        self.max_requests = max_requests
+        self.rng = random.Random(seed)
+        self.conn = None
+        self.latencies = {}  # endpoint -> [seconds]
+        self.errors = {}  # endpoint -> count
+        self.error_samples = {}  # endpoint -> first error response
+
+    def request(self, method, path, body=None, ip=None, endpoint=None):
+        headers = {"Content-Type": "application/json"}
+        if ip:
+            headers["X-Forwarded-For"] = ip
+        payload = json.dumps(body).encode() if body is not None else None
+        endpoint = endpoint or f"{method} {path.split('?')[0]}"
+        start = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            self.conn.request(method, path, body=payload, headers=headers)
+            response = self.conn.getresponse()
+            raw = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.conn = None
+            raw, status = b"", 599
+        self.latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+        if status >= 400:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            self.error_samples.setdefault(
+                endpoint, f"{status} {raw[:300].decode('utf-8', 'replace')}"
+            )
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    def ensure_session(self, client):
+        if client.session_id is None:
+            self.auto_session(client)
+        return client.session_id
+
+    # One method per operation in the traffic mix
+    def auto_session(self, client):
+        data = self.request("POST", "/auto_session", {}, ip=client.ip)
+        if data and data.get("session_id"):
+            client.session_id = data["session_id"]
+
+    def end_session(self, client):
+        if client.session_id:
+            self.request("POST", "/end_session", {"session_id": client.session_id})
+            client.session_id = None
+            client.queue_ids = []
+
+    def log_video(self, client):
+        sid = self.ensure_session(client)
+        # Heartbeats mostly extend the current video, sometimes move on
+        if client.video == 0 or self.rng.random() < 0.1:
+            client.video += 1
+            client.watched = 0
+        client.watched += self.rng.randint(3, 10)
+        self.request(
+            "POST",
+            "/log_video",
+            {
+                "session_id": sid,
+                "videoId": f"video-{client.video}",
+                "duration": 60,
+                "watched": client.watched,
+                "keys": [f"k{self.rng.randint(1, 5)}"],
+                "speeds": [self.rng.choice(["1x", "1.5x", "2x"])],
+                "status": "watching",
+                "soundMuted": self.rng.random() < 0.2,
+            },
+        )
+
+    def log_inactivity(self, client):
+        sid = self.ensure_session(client)
+        self.request(
+            "POST",
+            "/log_inactivity",
+            {"session_id": sid, "duration": self.rng.randint(5, 120), "type": "idle"},
+        )
+
+    def queues_get(self, client):
+        if self.rng.random() < 0.5 and client.session_id:
+            path = "/queues?session_id=" + urllib.parse.quote(client.session_id)
+        else:
+            path = "/queues"
+        self.request("GET", path, endpoint="GET /queues")
+
+    def queues_post(self, client):
+        sid = self.ensure_session(client)
+        name = f"Queue{self.rng.randint(1, 20)}"
+        body = {"session_id": sid, "name": name}
+        if self.rng.random() < 0.3:
+            body = {
+                "session_id": sid,
+                "name": f"{name}-sub{self.rng.randint(1, 3)}",
+                "main_queue": name,
+                "subqueue_count_old": self.rng.randint(0, 50),
+            }
+        data = self.request("POST", "/queues", body)
+        if data and data.get("queue_id") and data["queue_id"] not in client.queue_ids:
+            client.queue_ids.append(data["queue_id"])
+
+    def _card(self, client):
+        return {
+            "session_id": client.session_id,
+            # A small id space per client so cards get re-posted and move queues
+            "card_id": f"{client.ip}-card-{self.rng.randint(1, 30)}",
+            "status": self.rng.choice(["accept", "reject"]),
+            "queue_id": self.rng.choice(client.queue_ids),
+            "metadata": {"scraped": self.rng.random() < 0.5},
+        }
+
+    def cards(self, client):
+        self.ensure_session(client)
+        if not client.queue_ids:
+            return self.queues_post(client)
+        self.request("POST", "/cards", self._card(client))
+
+    def cards_bulk(self, client):
+        self.ensure_session(client)
+        if not client.queue_ids:
+            return self.queues_post(client)
+        cards = [self._card(client) for _ in range(self.rng.randint(5, 20))]
+        self.request("POST", "/cards/bulk", {"cards": cards})
+
+    def run(self):
+        done = 0
+        while time.monotonic() < self.deadline and (
+            not self.max_requests or done < self.max_requests
+        ):
+            op = self.rng.choices(self.ops, self.weights)[0]
+            getattr(self, op)(self.rng.choice(self.clients))
+            done += 1
+        if self.conn is not None:
+            self.conn.close()
+
+
+# --- REPORTING ---
+def parse_mix(spec):
+    ops, weights = [], []
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if not hasattr(Worker, name) or name.startswith("_") or name == "run":
+            raise SystemExit(f"Unknown operation in --mix: {name}")
+        ops.append(name)
+        weights.append(float(weight or 1))
+    return ops, weights
+
+
+def scrape_metrics(base_url):
+    """{(route, method): [requests, db_queries]} from /metrics, or None."""
+    parsed = urllib.parse.urlsplit(base_url)
+    try:
+        conn = http.client.HTTPConnection(
+            parsed.hostname, parsed.port or 80, timeout=30
+        )
+        conn.request("GET", "/metrics")
+        response = conn.getresponse()
+        body = response.read().decode()
+        conn.close()
+    except (OSError, http.client.HTTPException):
+        return None
+    if response.status != 200:
+        return None
+    counts = {}
+    for line in body.splitlines():
+        match = _METRIC_RE.match(line)
+        if not match or match.group(1) not in (
+            "http_requests_total",
+            "db_queries_total",
+        ):
+            continue
+        labels = dict(_LABEL_RE.findall(match.group(2)))
+        key = (labels.get("route"), labels.get("method"))
+        slot = 0 if match.group(1) == "http_requests_total" else 1
+        counts.setdefault(key, [0.0, 0.0])[slot] += float(match.group(3))
+    return counts
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(
+        0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1)
+    )
+    return sorted_values[rank]
+
+
+def summarize(workers, elapsed, before, after):
+    latencies, errors, samples = {}, {}, {}
+    for worker in workers:
+        for endpoint, sample in worker.error_samples.items():
+            samples.setdefault(endpoint, sample)
+        for endpoint, values in worker.latencies.items():
+            latencies.setdefault(endpoint, []).extend(values)
+        for endpoint, n in worker.errors.items():
+            errors[endpoint] = errors.get(endpoint, 0) + n
+
+    endpoints = {}
+    for endpoint, values in sorted(latencies.items()):
+        values.sort()
+        method, path = endpoint.split(" ", 1)
+        qpr = None
+        if before is not None and after is not None:
+            old = before.get((path, method), [0.0, 0.0])
+            new = after.get((path, method), [0.0, 0.0])
+            if new[0] > old[0]:
+                qpr = round((new[1] - old[1]) / (new[0] - old[0]), 2)
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "errors": errors.get(endpoint, 0),
+            "throughput_rps": round(len(values) / elapsed, 2),
+            "mean_ms": round(sum(values) / len(values) * 1000, 3),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+            "queries_per_request": qpr,
+        }
+        if endpoint in samples:
+            endpoints[endpoint]["error_sample"] = samples[endpoint]
+    total = sum(e["requests"] for e in endpoints.values())
+    return {
+        "requests": total,
+        "errors": sum(errors.values()),
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else None,
+    }, endpoints
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "-C", REPO_ROOT, "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_report(result, baseline=None):
+    columns = ("requests", "errors", "throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+    columns += ("queries_per_request",)
+    header = f"{'endpoint':<22}" + "".join(f"{c:>21}" for c in columns)
+    print(header)
+    print("-" * len(header))
+    for endpoint, stats in result["endpoints"].items():
+        old = (baseline or {}).get("endpoints", {}).get(endpoint, {})
+        cells = []
+        for column in columns:
+            value = stats.get(column)
+            cell = "-" if value is None else f"{value:g}"
+            if (
+                old.get(column)
+                and value is not None
+                and column not in ("requests", "errors")
+            ):
+                cell += f" ({(value - old[column]) / old[column] * 100:+.1f}%)"
+            cells.append(f"{cell:>21}")
+        print(f"{endpoint:<22}" + "".join(cells))
+    totals = result["totals"]
+    line = (
+        f"total: {totals['requests']} requests, {totals['errors']} errors, "
+        f"{totals['throughput_rps']} req/s over {totals['duration_s']}s"
+    )
+    if baseline:
+        old = baseline["totals"]["throughput_rps"]
+        line += f" (baseline {baseline['label']}: {old} req/s)"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--dsn", default=os.getenv("DATABASE_URL"))
+    parser.add_argument(
+        "--init-schema",
+        action="store_true",
+        help="drop and recreate all tables from schema.sql before the run",
+    )
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument(
+        "--requests", type=int, default=0, help="per-worker request cap (0 = none)"
+    )
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default=None)
+    parser.add_argument("--output", default=None, help="result file (JSON)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    ops, weights = parse_mix(args.mix)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    server = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        if not args.dsn:
+            raise SystemExit("Set --dsn or DATABASE_URL to a local Postgres")
+        if not is_local_dsn(args.dsn):
+            raise SystemExit("Refusing to load-test a non-local database")
+        if args.init_schema:
+            init_schema(args.dsn)
+        server, base_url = start_server(args.dsn)
+
+    clients = [Client(i + 1) for i in range(args.clients)]
+
+    def run_phase(seconds, max_requests, seed):
+        deadline = time.monotonic() + seconds
+        workers = [
+            Worker(
+                base_url,
+                # Each worker owns a disjoint slice of the clients
+                clients[i :: args.concurrency] or clients,
+                ops,
+                weights,
+                deadline,
+                max_requests,
+                seed + i,
+            )
+            for i in range(args.concurrency)
+        ]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return workers, time.perf_counter() - start
+
+    try:
+        if args.warmup > 0:
+            run_phase(args.warmup, 0, args.seed + 10000)
+        before = scrape_metrics(base_url)
+        workers, elapsed = run_phase(args.duration, args.requests, args.seed)
+        after = scrape_metrics(base_url)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    totals, endpoints = summarize(workers, elapsed, before, after)
+    label = args.label or git_revision()
+    result = {
+        "label": label,
+        "git_revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "concurrency": args.concurrency,
+            "clients": args.clients,
+            "duration": args.duration,
+            "requests": args.requests,
+            "mix": args.mix,
+            "seed": args.seed,
+            "target": args.url or "in-process",
+        },
+        "totals": totals,
+        "endpoints": endpoints,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        output = os.path.join(RESULTS_DIR, f"load-{label}-{stamp}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print_report(result, baseline)
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
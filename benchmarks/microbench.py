@@ -0,0 +1,188 @@
+"""
+Microbenchmarks for the pure-Python helpers that run on every request:
+allowed-queue matching, card count folding, subqueue_counts normalization,
+video payload/speed parsing and username/password validation.
+
+No database is needed. Each case reports the best per-call time over several
+timeit repeats. Save a run and gate later ones against it:
+
+    python benchmarks/microbench.py --save benchmarks/results/micro-base.json
+    python benchmarks/microbench.py --baseline benchmarks/results/micro-base.json \\
+        --threshold 0.25
+
+The second form exits non-zero if any case is more than 25% slower.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py only connects on first use; keep its logging out of the timings
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, REPO_ROOT)
+import app  # noqa: E402
+
+
+# --- INPUTS (realistic sizes, fixed seed) ---
+def allowed_queue_rows(n, seed=1):
+    """n allowed_queues rows: ~1/10 countries, the rest country-prefixed queues."""
+    rng = random.Random(seed)
+    countries = [f"Country{i}" for i in range(max(1, n // 10))]
+    rows = [(c, "COUNTRY", None) for c in countries]
+    while len(rows) < n:
+        country = rng.choice(countries)
+        rows.append(
+            (
+                f"{country}-{rng.choice(['Ads', 'Video', 'Live'])}-{len(rows)}",
+                "QUEUE",
+                len(rows),
+            )
+        )
+    return rows
+
+
+def card_moves(n, subqueues, seed=2):
+    """n (metadata, delta) moves with sizeable metadata dicts."""
+    rng = random.Random(seed)
+    moves = []
+    for i in range(n):
+        metadata = {f"field_{k}": {"nested": [k, str(k)]} for k in range(20)}
+        metadata["subqueue"] = f"sub-{rng.randrange(subqueues)}"
+        if i % 5 == 0:
+            metadata.update(
+                use_scraped_counts=True,
+                queue_count_old=rng.randint(0, 500),
+                queue_count_new=rng.randint(0, 500),
+                subqueue_count_old=rng.randint(0, 50),
+                subqueue_count_new=rng.randint(0, 50),
+            )
+        moves.append((metadata, rng.choice((1, -1))))
+    return moves
+
+
+def build_cases():
+    rows = allowed_queue_rows(5000)
+    index = app.AllowedQueueIndex(rows)
+    exact_name = rows[len(rows) // 2][0].upper()
+    single_prefix = rows[-1][0][:-1] if len(rows[-1][0]) > 1 else rows[-1][0]
+    multi_prefix = "country1-"
+
+    moves = card_moves(200, subqueues=50)
+    queue = ("Country1", None, None)
+    scraped_metadata = moves[0][0]
+
+    counts_dict = {f"sub-{i}": i for i in range(500)}
+    counts_list = [{"name": f"sub-{i}", "count": str(i)} for i in range(500)]
+
+    video_payload = {
+        "session_id": "s" * 43,
+        "videoId": "video-1",
+        "duration": "60.5",
+        "watched": "42",
+        "loopTime": 3,
+        "keys": [f"k{i}" for i in range(20)],
+        "speeds": ["1x", "1.5X", 2, "bad", None] * 10,
+        "soundMuted": True,
+    }
+
+    def parse_video():
+        event = app._parse_video_event(video_payload)
+        return [app._parse_speed(s) for s in event["speeds"]]
+
+    return {
+        "allowed_queue_index_build_5k": lambda: app.AllowedQueueIndex(rows),
+        "find_matching_queue_exact": lambda: app.find_matching_queue(exact_name, index),
+        "find_matching_queue_prefix": lambda: app.find_matching_queue(
+            single_prefix, index
+        ),
+        "find_matching_queue_multi_prefix": lambda: app.find_matching_queue(
+            multi_prefix, index
+        ),
+        "find_matching_queue_miss": lambda: app.find_matching_queue(
+            "Nowhere-Queue", index
+        ),
+        "plan_count_adjustment_scraped": lambda: app._plan_count_adjustment(
+            scraped_metadata, 1
+        ),
+        "fold_card_moves_200x50": lambda: app._fold_card_moves(queue, moves),
+        "normalize_subqueue_counts_dict_500": lambda: app._normalize_subqueue_counts(
+            counts_dict, None
+        ),
+        "normalize_subqueue_counts_list_500": lambda: app._normalize_subqueue_counts(
+            counts_list, None
+        ),
+        "parse_video_event_50_speeds": parse_video,
+        "validate_username_valid": lambda: app.validate_username("agent_007x"),
+        "validate_username_invalid": lambda: app.validate_username("agent007 x"),
+        "validate_password_valid": lambda: app.validate_password("Secr3t!pass"),
+        "validate_password_invalid": lambda: app.validate_password("secretpass1"),
+    }
+
+
+# --- RUNNER ---
+def run_case(fn, repeat, min_time):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    # autorange targets 0.2s; scale up to min_time per repeat
+    number = max(1, int(number * max(1.0, min_time / 0.2)))
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e6  # microseconds per call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--filter", default="", help="only run cases containing this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--save", help="write results (JSON) to this file")
+    parser.add_argument("--baseline", help="earlier results (JSON) to compare to")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="allowed slowdown vs --baseline before failing (0.25 = 25%%)",
+    )
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["cases"]
+
+    results = {}
+    regressions = []
+    for name, fn in build_cases().items():
+        if args.filter not in name:
+            continue
+        us = run_case(fn, args.repeat, args.min_time)
+        results[name] = round(us, 4)
+        line = f"{name:<40} {us:>12.3f} us"
+        old = baseline.get(name)
+        if old:
+            change = (us - old) / old
+            line += f"   {change * 100:+7.1f}% vs baseline"
+            if change > args.threshold:
+                regressions.append(name)
+                line += "   REGRESSION"
+        print(line)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({"python": sys.version.split()[0], "cases": results}, f, indent=2)
+        print(f"results written to {args.save}")
+
+    if regressions:
+        print(
+            f"{len(regressions)} case(s) slower than baseline: {', '.join(regressions)}"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Partition maintenance for the monthly-partitioned event tables (videos,
+video_keys, video_speeds, cards, inactivity, useractivities; see schema.sql).
+
+Creates the partitions for the coming months and, when a retention period is
+set, detaches and drops partitions older than it. Run it daily from cron or
+any scheduler; it is idempotent:
+
+    DATABASE_URL=... python maintain_partitions.py
+    python maintain_partitions.py --months-ahead 6 --retention-months 13
+
+Every table's partition creation, and every partition's detach and drop,
+runs in its own short transaction, so the ACCESS EXCLUSIVE locks they take
+are released right away instead of being held on all six tables until the
+run ends. Detach and drop share one transaction so a failed drop leaves the
+partition attached, to be retried, rather than detached and forgotten. lock_timeout stops a step from queueing writers behind a
+long-running transaction; a failed step is reported (exit status 1) and
+retried next run. (DETACH ... CONCURRENTLY is not an option: it is refused on tables
+with a default partition.)
+
+Rows that fall outside every monthly partition land in <table>_default, so
+inserts keep working even if maintenance has not run for a while.
+"""
+
+import argparse
+import os
+import sys
+
+import psycopg2
+from psycopg2 import sql
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+# Months of partitions to keep ready beyond the current one
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))
+# Whole months kept before the current one; 0/unset = keep everything
+PARTITION_RETENTION_MONTHS = int(os.getenv("PARTITION_RETENTION_MONTHS", 0))
+# Longest a step waits for its table lock before giving up until the next run
+PARTITION_LOCK_TIMEOUT_MS = int(os.getenv("PARTITION_LOCK_TIMEOUT_MS", 5000))
+
+
+def create_partitions(cur, table, months_ahead):
+    cur.execute("SELECT create_monthly_partitions(%s, %s)", (table, months_ahead))
+    return cur.fetchone()[0]
+
+
+def drop_partitions(cur, table, keep_months):
+    """Detach and drop each expired partition, one transaction per partition."""
+    conn = cur.connection
+    cur.execute("SELECT expired_partitions(%s, %s)", (table, keep_months))
+    expired = [row[0] for row in cur.fetchall()]
+    dropped = 0
+    conn.autocommit = False
+    try:
+        for part in expired:
+            try:
+                cur.execute(
+                    sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                        sql.Identifier(table), sql.Identifier(part)
+                    )
+                )
+                cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(part)))
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+            dropped += 1
+    finally:
+        conn.autocommit = True
+    return dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD)
+    parser.add_argument(
+        "--retention-months",
+        type=int,
+        default=PARTITION_RETENTION_MONTHS,
+        help="drop partitions older than this many months (0 = keep all)",
+    )
+    args = parser.parse_args()
+
+    if not DATABASE_URL:
+        sys.exit("DATABASE_URL is not set")
+
+    conn = psycopg2.connect(DATABASE_URL)
+    conn.autocommit = True
+    failures = 0
+    try:
+        cur = conn.cursor()
+        cur.execute("SET lock_timeout = %s", (PARTITION_LOCK_TIMEOUT_MS,))
+        cur.execute("SELECT unnest(partitioned_tables())")
+        tables = [row[0] for row in cur.fetchall()]
+        for table in tables:
+            created = dropped = 0
+            try:
+                created = create_partitions(cur, table, args.months_ahead)
+                if args.retention_months:
+                    dropped = drop_partitions(cur, table, args.retention_months)
+            except psycopg2.Error as e:
+                # Lock timeouts, or a videos partition still referenced because
+                # its video_keys partition was skipped: retried next run
+                failures += 1
+                print(f"{table:<16} skipped: {str(e).strip()}")
+            print(f"{table:<16} created={created} dropped={dropped}")
+        for notice in conn.notices:
+            print(notice.strip())
+        cur.close()
+    finally:
+        conn.close()
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
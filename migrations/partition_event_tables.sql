@@ -0,0 +1,313 @@
+-- Migrate an existing database to the monthly-partitioned event tables
+-- (videos, video_keys, video_speeds, cards, inactivity, useractivities)
+-- without losing data; schema.sql recreates every table, so it can only set
+-- up a fresh database.
+--
+--     psql "$DATABASE_URL" -v ON_ERROR_STOP=1 -f migrations/partition_event_tables.sql
+--
+-- Everything runs in one transaction: the old tables are renamed to
+-- <table>_legacy (with their indexes), the partitioned tables are created
+-- under the original names with partitions covering the existing data, rows
+-- are copied with session_started_at filled from sessions.starttime, and the
+-- id sequences move to the new tables so ids carry on. The tables are locked
+-- for the whole copy, so run it with the app stopped. Once the new tables
+-- check out, drop the old ones:
+--
+--     DROP TABLE video_keys_legacy, video_speeds_legacy, videos_legacy,
+--         cards_legacy, inactivity_legacy, useractivities_legacy;
+
+BEGIN;
+
+-- ============================================
+-- SET ASIDE THE OLD TABLES
+-- ============================================
+DO $$
+DECLARE
+    t TEXT;
+    idx TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['video_keys', 'video_speeds', 'videos', 'cards', 'inactivity', 'useractivities'] LOOP
+        IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = t::regclass) THEN
+            RAISE EXCEPTION '% is already partitioned', t;
+        END IF;
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', t, t || '_legacy');
+        -- Index names are schema-wide; free them for the new tables
+        FOR idx IN
+            SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE i.indrelid = (t || '_legacy')::regclass
+        LOOP
+            EXECUTE format('ALTER INDEX %I RENAME TO %I', idx, idx || '_legacy');
+        END LOOP;
+    END LOOP;
+END;
+$$;
+
+-- ============================================
+-- PARTITIONED TABLES (as in schema.sql; ids keep the existing sequences)
+-- ============================================
+CREATE TABLE useractivities (
+    id INTEGER NOT NULL DEFAULT nextval('useractivities_id_seq'),
+    userid INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    activitytype VARCHAR(255) NOT NULL,
+    timestamp TIMESTAMPTZ NOT NULL,
+    metadata JSON,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    deleted_at TIMESTAMPTZ,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE videos (
+    id INTEGER NOT NULL DEFAULT nextval('videos_id_seq'),
+    session_id VARCHAR NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    session_started_at TIMESTAMPTZ NOT NULL,
+    video_id VARCHAR NOT NULL,
+    duration NUMERIC,
+    watched INTEGER,
+    loop_time INTEGER,
+    status VARCHAR,
+    sound_muted VARCHAR,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, session_started_at),
+    UNIQUE (session_id, video_id, session_started_at)
+) PARTITION BY RANGE (session_started_at);
+
+CREATE TABLE video_keys (
+    id INTEGER NOT NULL DEFAULT nextval('video_keys_id_seq'),
+    video_id INTEGER NOT NULL,
+    session_started_at TIMESTAMPTZ NOT NULL,
+    key_value VARCHAR,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, session_started_at),
+    UNIQUE (video_id, key_value, session_started_at),
+    FOREIGN KEY (video_id, session_started_at) REFERENCES videos (id, session_started_at) ON DELETE CASCADE
+) PARTITION BY RANGE (session_started_at);
+
+CREATE TABLE video_speeds (
+    id INTEGER NOT NULL DEFAULT nextval('video_speeds_id_seq'),
+    video_id INTEGER NOT NULL,
+    session_started_at TIMESTAMPTZ NOT NULL,
+    speed_value NUMERIC,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, session_started_at),
+    UNIQUE (video_id, speed_value, session_started_at),
+    FOREIGN KEY (video_id, session_started_at) REFERENCES videos (id, session_started_at) ON DELETE CASCADE
+) PARTITION BY RANGE (session_started_at);
+
+CREATE TABLE inactivity (
+    id INTEGER NOT NULL DEFAULT nextval('inactivity_id_seq'),
+    session_id VARCHAR NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    starttime TIMESTAMPTZ,
+    endtime TIMESTAMPTZ,
+    duration NUMERIC,
+    type VARCHAR,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE cards (
+    id INTEGER NOT NULL DEFAULT nextval('cards_id_seq'),
+    session_id VARCHAR NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    session_started_at TIMESTAMPTZ NOT NULL,
+    card_id VARCHAR NOT NULL,
+    status VARCHAR(10) NOT NULL CHECK (status IN ('accept','reject')),
+    queue_id VARCHAR NOT NULL,
+    metadata JSONB,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, session_started_at),
+    UNIQUE (session_id, card_id, session_started_at)
+) PARTITION BY RANGE (session_started_at);
+
+ALTER SEQUENCE useractivities_id_seq OWNED BY useractivities.id;
+ALTER SEQUENCE videos_id_seq OWNED BY videos.id;
+ALTER SEQUENCE video_keys_id_seq OWNED BY video_keys.id;
+ALTER SEQUENCE video_speeds_id_seq OWNED BY video_speeds.id;
+ALTER SEQUENCE inactivity_id_seq OWNED BY inactivity.id;
+ALTER SEQUENCE cards_id_seq OWNED BY cards.id;
+
+CREATE INDEX IF NOT EXISTS idx_cards_queue_id ON cards (queue_id);
+CREATE INDEX IF NOT EXISTS idx_cards_session_id ON cards (session_id);
+CREATE INDEX IF NOT EXISTS idx_video_keys_null_key ON video_keys (video_id) WHERE key_value IS NULL;
+
+-- ============================================
+-- PARTITION MAINTENANCE FUNCTIONS (as in schema.sql)
+-- ============================================
+-- Create the default partition and the monthly partitions from months_back
+-- before to months_ahead after the current month. A month whose rows already
+-- sit in the default partition is skipped (with a notice) rather than moved.
+CREATE OR REPLACE FUNCTION create_monthly_partitions(
+    parent TEXT, months_ahead INT DEFAULT 3, months_back INT DEFAULT 1
+) RETURNS INT LANGUAGE plpgsql AS $$
+DECLARE
+    this_month TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC');
+    month_start TIMESTAMP := this_month - make_interval(months => months_back);
+    lower_bound TIMESTAMPTZ;
+    upper_bound TIMESTAMPTZ;
+    part TEXT;
+    key_column TEXT;
+    in_default BOOLEAN;
+    created INT := 0;
+BEGIN
+    SELECT a.attname INTO key_column
+    FROM pg_partitioned_table pt
+    JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+    WHERE pt.partrelid = parent::regclass;
+
+    IF to_regclass(parent || '_default') IS NULL THEN
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', parent || '_default', parent);
+    END IF;
+
+    WHILE month_start <= this_month + make_interval(months => months_ahead) LOOP
+        part := parent || '_p' || to_char(month_start, 'YYYYMM');
+        lower_bound := month_start AT TIME ZONE 'UTC';
+        upper_bound := (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC';
+        IF to_regclass(part) IS NULL THEN
+            EXECUTE format(
+                'SELECT EXISTS (SELECT 1 FROM %I WHERE %I >= %L AND %I < %L)',
+                parent || '_default', key_column, lower_bound, key_column, upper_bound
+            ) INTO in_default;
+            IF in_default THEN
+                RAISE NOTICE 'skipping %: matching rows are in %_default', part, parent;
+            ELSE
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                    part, parent, lower_bound, upper_bound
+                );
+                created := created + 1;
+            END IF;
+        END IF;
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$;
+
+-- Detach and drop the monthly partitions that ended more than keep_months
+-- months before the current month: an instant catalog change instead of a
+-- large DELETE.
+CREATE OR REPLACE FUNCTION expired_partitions(parent TEXT, keep_months INT)
+RETURNS SETOF TEXT LANGUAGE sql STABLE AS $$
+    SELECT c.relname::TEXT
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = parent::regclass
+      AND c.relname ~ ('^' || parent || '_p[0-9]{6}$')
+      AND to_timestamp(right(c.relname, 6), 'YYYYMM')::TIMESTAMP + INTERVAL '1 month'
+          <= date_trunc('month', NOW() AT TIME ZONE 'UTC') - make_interval(months => keep_months)
+    ORDER BY c.relname
+$$;
+
+CREATE OR REPLACE FUNCTION drop_old_partitions(parent TEXT, keep_months INT)
+RETURNS INT LANGUAGE plpgsql AS $$
+DECLARE
+    part TEXT;
+    dropped INT := 0;
+BEGIN
+    FOR part IN SELECT expired_partitions(parent, keep_months) LOOP
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, part);
+        EXECUTE format('DROP TABLE %I', part);
+        dropped := dropped + 1;
+    END LOOP;
+    RETURN dropped;
+END;
+$$;
+
+-- The partitioned tables in maintenance order: video_keys/video_speeds come
+-- before videos so their partitions are dropped before the videos partition
+-- they reference.
+CREATE OR REPLACE FUNCTION partitioned_tables()
+RETURNS TEXT[] LANGUAGE sql IMMUTABLE AS $$
+    SELECT ARRAY['video_keys', 'video_speeds', 'videos', 'cards', 'inactivity', 'useractivities']
+$$;
+
+-- Maintain every partitioned table; keep_months NULL disables retention.
+-- This is a single transaction that keeps each table's ACCESS EXCLUSIVE
+-- locks until the last table is done, so it is only meant for schema setup;
+-- on a live database maintain_partitions.py runs each table and partition
+-- in its own transaction.
+CREATE OR REPLACE FUNCTION maintain_partitions(months_ahead INT DEFAULT 3, keep_months INT DEFAULT NULL)
+RETURNS TABLE (table_name TEXT, created INT, dropped INT) LANGUAGE plpgsql AS $$
+BEGIN
+    FOREACH table_name IN ARRAY partitioned_tables() LOOP
+        created := create_monthly_partitions(table_name, months_ahead);
+        dropped := CASE WHEN keep_months IS NULL THEN 0 ELSE drop_old_partitions(table_name, keep_months) END;
+        RETURN NEXT;
+    END LOOP;
+END;
+$$;
+
+-- Monthly partitions from the oldest existing row's month through three
+-- months ahead (created before the copy, so nothing lands in _default)
+DO $$
+DECLARE
+    this_month TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC');
+    oldest_session TIMESTAMPTZ := (SELECT MIN(starttime) FROM sessions);
+    oldest TIMESTAMPTZ;
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY partitioned_tables() LOOP
+        IF t IN ('inactivity', 'useractivities') THEN
+            EXECUTE format('SELECT MIN(created_at) FROM %I', t || '_legacy') INTO oldest;
+        ELSE
+            oldest := oldest_session;
+        END IF;
+        PERFORM create_monthly_partitions(
+            t, 3,
+            GREATEST(1, COALESCE(
+                (EXTRACT(YEAR FROM AGE(this_month, date_trunc('month', oldest AT TIME ZONE 'UTC'))) * 12
+                 + EXTRACT(MONTH FROM AGE(this_month, date_trunc('month', oldest AT TIME ZONE 'UTC'))))::INT,
+                1
+            ))
+        );
+    END LOOP;
+END;
+$$;
+
+-- ============================================
+-- COPY (session_started_at from the owning session)
+-- ============================================
+INSERT INTO useractivities (id, userid, activitytype, timestamp, metadata, created_at, updated_at, deleted_at)
+SELECT id, userid, activitytype, timestamp, metadata, created_at, updated_at, deleted_at
+FROM useractivities_legacy;
+
+INSERT INTO inactivity (id, session_id, starttime, endtime, duration, type, created_at)
+SELECT id, session_id, starttime, endtime, duration, type, created_at
+FROM inactivity_legacy;
+
+INSERT INTO videos (id, session_id, session_started_at, video_id, duration, watched, loop_time, status, sound_muted, created_at)
+SELECT v.id, v.session_id, s.starttime, v.video_id, v.duration, v.watched, v.loop_time, v.status, v.sound_muted, v.created_at
+FROM videos_legacy v JOIN sessions s ON s.id = v.session_id;
+
+INSERT INTO video_keys (id, video_id, session_started_at, key_value, created_at)
+SELECT k.id, k.video_id, v.session_started_at, k.key_value, k.created_at
+FROM video_keys_legacy k JOIN videos v ON v.id = k.video_id;
+
+INSERT INTO video_speeds (id, video_id, session_started_at, speed_value, created_at)
+SELECT sp.id, sp.video_id, v.session_started_at, sp.speed_value, sp.created_at
+FROM video_speeds_legacy sp JOIN videos v ON v.id = sp.video_id;
+
+INSERT INTO cards (id, session_id, session_started_at, card_id, status, queue_id, metadata, created_at, updated_at)
+SELECT c.id, c.session_id, s.starttime, c.card_id, c.status, c.queue_id, c.metadata, c.created_at, c.updated_at
+FROM cards_legacy c JOIN sessions s ON s.id = c.session_id;
+
+-- Every row must have made it across (the legacy foreign keys guarantee the joins)
+DO $$
+DECLARE
+    t TEXT;
+    old_count BIGINT;
+    new_count BIGINT;
+BEGIN
+    FOREACH t IN ARRAY partitioned_tables() LOOP
+        EXECUTE format('SELECT COUNT(*) FROM %I', t || '_legacy') INTO old_count;
+        EXECUTE format('SELECT COUNT(*) FROM %I', t) INTO new_count;
+        IF old_count <> new_count THEN
+            RAISE EXCEPTION '%: copied % of % rows', t, new_count, old_count;
+        END IF;
+    END LOOP;
+END;
+$$;
+
+ANALYZE useractivities, inactivity, videos, video_keys, video_speeds, cards;
+
+COMMIT;
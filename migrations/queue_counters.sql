@@ -0,0 +1,20 @@
+-- Add the card-driven queue_counters table to an existing database. No
+-- backfill is needed: a queue's counter row is seeded from its queues row on
+-- the queue's first card move. Safe to re-run.
+--
+--     psql "$DATABASE_URL" -f migrations/queue_counters.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS queue_counters (
+    queue_id INTEGER PRIMARY KEY REFERENCES queues(id) ON DELETE CASCADE,
+    main_queue_count INTEGER NOT NULL DEFAULT 0,
+    selected_subqueue TEXT,
+    queue_count_old INTEGER,
+    queue_count_new INTEGER,
+    subqueue_count_old INTEGER,
+    subqueue_count_new INTEGER,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+COMMIT;
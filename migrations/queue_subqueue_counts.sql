@@ -0,0 +1,24 @@
+-- Migrate an existing database to per-subqueue counter rows without dropping
+-- anything (schema.sql recreates every table, so it can only set up a fresh
+-- database). Safe to re-run: existing counter rows are left untouched.
+--
+--     psql "$DATABASE_URL" -f migrations/queue_subqueue_counts.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS queue_subqueue_counts (
+    queue_id INTEGER NOT NULL REFERENCES queues(id) ON DELETE CASCADE,
+    subqueue TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (queue_id, subqueue)
+);
+
+-- Backfill from the legacy queues.subqueue_counts JSONB (integer values only)
+INSERT INTO queue_subqueue_counts (queue_id, subqueue, count)
+SELECT q.id, e.key, e.value::int
+FROM queues q, jsonb_each_text(COALESCE(q.subqueue_counts, '{}'::jsonb)) AS e
+WHERE jsonb_typeof(q.subqueue_counts) = 'object' AND e.value ~ '^-?[0-9]+$'
+ON CONFLICT (queue_id, subqueue) DO NOTHING;
+
+COMMIT;
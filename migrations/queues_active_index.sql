@@ -0,0 +1,8 @@
+-- Add the partial index GET /queues' keyset pagination (ORDER BY id DESC)
+-- uses for ?active=true listings. Builds without blocking writes, so run it
+-- outside a transaction block (psql -f runs each statement on its own).
+-- Safe to re-run.
+--
+--     psql "$DATABASE_URL" -f migrations/queues_active_index.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_queues_active_id ON queues (id DESC) WHERE active;
@@ -8,6 +8,7 @@ DROP TABLE IF EXISTS app_config CASCADE;
 DROP TABLE IF EXISTS whitelisted_urls CASCADE;
 DROP TABLE IF EXISTS allowed_queues CASCADE;
 DROP TABLE IF EXISTS dashboard_users CASCADE;
+DROP TABLE IF EXISTS user_daily_activity CASCADE;
 
 -- Drop base tables (from user's old scheme)
 DROP TABLE IF EXISTS useractivities CASCADE; 
@@ -16,6 +17,8 @@ DROP TABLE IF EXISTS video_keys CASCADE;
 DROP TABLE IF EXISTS video_speeds CASCADE;
 DROP TABLE IF EXISTS videos CASCADE;
 DROP TABLE IF EXISTS cards CASCADE;
+DROP TABLE IF EXISTS queue_subqueue_counts CASCADE;
+DROP TABLE IF EXISTS queue_counters CASCADE;
 DROP TABLE IF EXISTS queues CASCADE;
 DROP TABLE IF EXISTS sessions CASCADE;
 DROP TABLE IF EXISTS users CASCADE;
@@ -94,22 +97,33 @@ CREATE TABLE IF NOT EXISTS sessions (
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
 
+-- High-volume event tables are range-partitioned by month (see PARTITIONING
+-- below). useractivities and inactivity are partitioned by created_at. videos,
+-- video_keys, video_speeds and cards are partitioned by session_started_at (a
+-- copy of sessions.starttime): it is fixed for a session, so a session's rows
+-- share one partition and the upsert targets ((session_id, video_id),
+-- (video_id, key_value), ...) stay unique once the partition key is added.
+-- Existing databases are moved to this layout (keeping their rows) with
+-- migrations/partition_event_tables.sql.
+
 -- User activities table
 CREATE TABLE IF NOT EXISTS useractivities (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     userid INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
     activitytype VARCHAR(255) NOT NULL,
     timestamp TIMESTAMPTZ NOT NULL,
     metadata JSON,
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    deleted_at TIMESTAMPTZ
-);
+    deleted_at TIMESTAMPTZ,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
 
 -- Videos table
 CREATE TABLE IF NOT EXISTS videos (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     session_id VARCHAR NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    session_started_at TIMESTAMPTZ NOT NULL,
     video_id VARCHAR NOT NULL,
     duration NUMERIC,
     watched INTEGER,
@@ -117,37 +131,45 @@ CREATE TABLE IF NOT EXISTS videos (
     status VARCHAR,
     sound_muted VARCHAR,
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    UNIQUE (session_id, video_id)
-);
+    PRIMARY KEY (id, session_started_at),
+    UNIQUE (session_id, video_id, session_started_at)
+) PARTITION BY RANGE (session_started_at);
 
 -- Video keys table
 CREATE TABLE IF NOT EXISTS video_keys (
-    id SERIAL PRIMARY KEY,
-    video_id INTEGER NOT NULL REFERENCES videos(id) ON DELETE CASCADE,
+    id SERIAL,
+    video_id INTEGER NOT NULL,
+    session_started_at TIMESTAMPTZ NOT NULL,
     key_value VARCHAR,
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    UNIQUE (video_id, key_value)
-);
+    PRIMARY KEY (id, session_started_at),
+    UNIQUE (video_id, key_value, session_started_at),
+    FOREIGN KEY (video_id, session_started_at) REFERENCES videos (id, session_started_at) ON DELETE CASCADE
+) PARTITION BY RANGE (session_started_at);
 
 -- Video speeds table
 CREATE TABLE IF NOT EXISTS video_speeds (
-    id SERIAL PRIMARY KEY,
-    video_id INTEGER NOT NULL REFERENCES videos(id) ON DELETE CASCADE,
+    id SERIAL,
+    video_id INTEGER NOT NULL,
+    session_started_at TIMESTAMPTZ NOT NULL,
     speed_value NUMERIC,
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    UNIQUE (video_id, speed_value)
-);
+    PRIMARY KEY (id, session_started_at),
+    UNIQUE (video_id, speed_value, session_started_at),
+    FOREIGN KEY (video_id, session_started_at) REFERENCES videos (id, session_started_at) ON DELETE CASCADE
+) PARTITION BY RANGE (session_started_at);
 
 -- Inactivity table
 CREATE TABLE IF NOT EXISTS inactivity (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     session_id VARCHAR NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
     starttime TIMESTAMPTZ,
     endtime TIMESTAMPTZ,
     duration NUMERIC,
     type VARCHAR,
-    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-);
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
 
 -- Queues table
 CREATE TABLE IF NOT EXISTS queues (
@@ -171,18 +193,48 @@ CREATE TABLE IF NOT EXISTS queues (
     CONSTRAINT queues_session_id_name_key UNIQUE (session_id, name)
 );
 
+-- Per-subqueue counters (one row per queue/subqueue, updated with count = count + delta).
+-- Supersedes queues.subqueue_counts, which is no longer written; GET /queues builds
+-- the subqueue_counts object from this table. Existing databases are migrated
+-- (and backfilled) with migrations/queue_subqueue_counts.sql.
+CREATE TABLE IF NOT EXISTS queue_subqueue_counts (
+    queue_id INTEGER NOT NULL REFERENCES queues(id) ON DELETE CASCADE,
+    subqueue TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (queue_id, subqueue)
+);
+
+-- Card-driven queue counters (one row per queue, seeded from its queues row on the
+-- queue's first card move). Card decisions bump main_queue_count here with
+-- count = count + delta and only read queues, so they never lock the queue row;
+-- GET /queues reads these columns from here once the row exists, and POST /queues
+-- merges into both. Existing databases: migrations/queue_counters.sql.
+CREATE TABLE IF NOT EXISTS queue_counters (
+    queue_id INTEGER PRIMARY KEY REFERENCES queues(id) ON DELETE CASCADE,
+    main_queue_count INTEGER NOT NULL DEFAULT 0,
+    selected_subqueue TEXT,
+    queue_count_old INTEGER,
+    queue_count_new INTEGER,
+    subqueue_count_old INTEGER,
+    subqueue_count_new INTEGER,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
 -- Session cards
 CREATE TABLE IF NOT EXISTS cards (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     session_id VARCHAR NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    session_started_at TIMESTAMPTZ NOT NULL,
     card_id VARCHAR NOT NULL,
     status VARCHAR(10) NOT NULL CHECK (status IN ('accept','reject')),
     queue_id VARCHAR NOT NULL,
     metadata JSONB,
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    UNIQUE (session_id, card_id)
-);
+    PRIMARY KEY (id, session_started_at),
+    UNIQUE (session_id, card_id, session_started_at)
+) PARTITION BY RANGE (session_started_at);
 
 -- ============================================
 -- STEALTH MODULE TABLES
@@ -317,7 +369,19 @@ CREATE TABLE IF NOT EXISTS allowed_queues (
 -- Indexes from base tables
 CREATE INDEX IF NOT EXISTS idx_cards_queue_id ON cards (queue_id);
 CREATE INDEX IF NOT EXISTS idx_cards_session_id ON cards (session_id);
-CREATE INDEX IF NOT EXISTS idx_queues_session_id ON queues (session_id);
+-- GET /queues keyset pagination (ORDER BY id DESC, id < cursor): per session and
+-- for ?active=true listings; unfiltered pages walk the primary key backwards.
+-- (created_at, id) only narrows created_after/created_before ranges (the rows
+-- are then sorted by id). Existing databases: migrations/queues_active_index.sql.
+CREATE INDEX IF NOT EXISTS idx_queues_session_id_id ON queues (session_id, id DESC);
+CREATE INDEX IF NOT EXISTS idx_queues_active_id ON queues (id DESC) WHERE active;
+CREATE INDEX IF NOT EXISTS idx_queues_created_at_id ON queues (created_at, id);
+-- Partial index for retroactive key assignment (videos still waiting for a key)
+CREATE INDEX IF NOT EXISTS idx_video_keys_null_key ON video_keys (video_id) WHERE key_value IS NULL;
+-- auto_session lookups by client IP (recent session, device mapping, latest stealth session)
+CREATE INDEX IF NOT EXISTS idx_sessions_ip_address_starttime ON sessions (ip_address, starttime DESC);
+CREATE INDEX IF NOT EXISTS idx_user_device_mappings_ip_address ON user_device_mappings (ip_address);
+CREATE INDEX IF NOT EXISTS idx_stealth_sessions_ip_address_last_updated ON stealth_sessions (ip_address, last_updated DESC);
 
 -- Indexes for stealth tables
 CREATE INDEX IF NOT EXISTS idx_user_shifts_user_id ON user_shifts (user_id);
@@ -338,6 +402,333 @@ CREATE INDEX IF NOT EXISTS idx_session_visits_usage_breakdown_id ON session_visi
 CREATE INDEX IF NOT EXISTS idx_allowed_queues_queue_name ON allowed_queues (queue_name);
 CREATE INDEX IF NOT EXISTS idx_allowed_queues_queue_id ON allowed_queues (queue_id);
 
+-- ============================================
+-- PARTITIONING (monthly partitions, created ahead and dropped by age)
+-- ============================================
+-- Partitions are named <table>_pYYYYMM and cover one UTC calendar month;
+-- <table>_default catches rows outside every existing month, so inserts never
+-- fail if maintenance falls behind. Run maintain_partitions.py daily (cron).
+
+-- Create the default partition and the monthly partitions from months_back
+-- before to months_ahead after the current month. A month whose rows already
+-- sit in the default partition is skipped (with a notice) rather than moved.
+CREATE OR REPLACE FUNCTION create_monthly_partitions(
+    parent TEXT, months_ahead INT DEFAULT 3, months_back INT DEFAULT 1
+) RETURNS INT LANGUAGE plpgsql AS $$
+DECLARE
+    this_month TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC');
+    month_start TIMESTAMP := this_month - make_interval(months => months_back);
+    lower_bound TIMESTAMPTZ;
+    upper_bound TIMESTAMPTZ;
+    part TEXT;
+    key_column TEXT;
+    in_default BOOLEAN;
+    created INT := 0;
+BEGIN
+    SELECT a.attname INTO key_column
+    FROM pg_partitioned_table pt
+    JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+    WHERE pt.partrelid = parent::regclass;
+
+    IF to_regclass(parent || '_default') IS NULL THEN
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', parent || '_default', parent);
+    END IF;
+
+    WHILE month_start <= this_month + make_interval(months => months_ahead) LOOP
+        part := parent || '_p' || to_char(month_start, 'YYYYMM');
+        lower_bound := month_start AT TIME ZONE 'UTC';
+        upper_bound := (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC';
+        IF to_regclass(part) IS NULL THEN
+            EXECUTE format(
+                'SELECT EXISTS (SELECT 1 FROM %I WHERE %I >= %L AND %I < %L)',
+                parent || '_default', key_column, lower_bound, key_column, upper_bound
+            ) INTO in_default;
+            IF in_default THEN
+                RAISE NOTICE 'skipping %: matching rows are in %_default', part, parent;
+            ELSE
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                    part, parent, lower_bound, upper_bound
+                );
+                created := created + 1;
+            END IF;
+        END IF;
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$;
+
+-- Detach and drop the monthly partitions that ended more than keep_months
+-- months before the current month: an instant catalog change instead of a
+-- large DELETE.
+CREATE OR REPLACE FUNCTION expired_partitions(parent TEXT, keep_months INT)
+RETURNS SETOF TEXT LANGUAGE sql STABLE AS $$
+    SELECT c.relname::TEXT
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = parent::regclass
+      AND c.relname ~ ('^' || parent || '_p[0-9]{6}$')
+      AND to_timestamp(right(c.relname, 6), 'YYYYMM')::TIMESTAMP + INTERVAL '1 month'
+          <= date_trunc('month', NOW() AT TIME ZONE 'UTC') - make_interval(months => keep_months)
+    ORDER BY c.relname
+$$;
+
+CREATE OR REPLACE FUNCTION drop_old_partitions(parent TEXT, keep_months INT)
+RETURNS INT LANGUAGE plpgsql AS $$
+DECLARE
+    part TEXT;
+    dropped INT := 0;
+BEGIN
+    FOR part IN SELECT expired_partitions(parent, keep_months) LOOP
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, part);
+        EXECUTE format('DROP TABLE %I', part);
+        dropped := dropped + 1;
+    END LOOP;
+    RETURN dropped;
+END;
+$$;
+
+-- The partitioned tables in maintenance order: video_keys/video_speeds come
+-- before videos so their partitions are dropped before the videos partition
+-- they reference.
+CREATE OR REPLACE FUNCTION partitioned_tables()
+RETURNS TEXT[] LANGUAGE sql IMMUTABLE AS $$
+    SELECT ARRAY['video_keys', 'video_speeds', 'videos', 'cards', 'inactivity', 'useractivities']
+$$;
+
+-- Maintain every partitioned table; keep_months NULL disables retention.
+-- This is a single transaction that keeps each table's ACCESS EXCLUSIVE
+-- locks until the last table is done, so it is only meant for schema setup;
+-- on a live database maintain_partitions.py runs each table and partition
+-- in its own transaction.
+CREATE OR REPLACE FUNCTION maintain_partitions(months_ahead INT DEFAULT 3, keep_months INT DEFAULT NULL)
+RETURNS TABLE (table_name TEXT, created INT, dropped INT) LANGUAGE plpgsql AS $$
+BEGIN
+    FOREACH table_name IN ARRAY partitioned_tables() LOOP
+        created := create_monthly_partitions(table_name, months_ahead);
+        dropped := CASE WHEN keep_months IS NULL THEN 0 ELSE drop_old_partitions(table_name, keep_months) END;
+        RETURN NEXT;
+    END LOOP;
+END;
+$$;
+
+SELECT * FROM maintain_partitions();
+
+-- ============================================
+-- DAILY ACTIVITY ROLLUP (per user and day, maintained by triggers)
+-- ============================================
+-- Rows are keyed by the UTC day the session started, so a session's videos,
+-- inactivity and cards all count toward one day. Only sessions with a user_id
+-- are rolled up. The triggers add deltas, so rollups outlive the raw event
+-- partitions dropped by retention; rebuild_user_daily_activity() recomputes
+-- a day range from the raw tables (backfill or repair).
+CREATE TABLE IF NOT EXISTS user_daily_activity (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    videos_watched INTEGER NOT NULL DEFAULT 0,
+    watched_seconds BIGINT NOT NULL DEFAULT 0,
+    loop_time BIGINT NOT NULL DEFAULT 0,
+    inactivity_seconds NUMERIC NOT NULL DEFAULT 0,
+    session_count INTEGER NOT NULL DEFAULT 0,
+    session_seconds NUMERIC NOT NULL DEFAULT 0,
+    cards_accepted INTEGER NOT NULL DEFAULT 0,
+    cards_rejected INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (user_id, day)
+);
+
+-- One delta row; named arguments let each trigger set only its own counters
+CREATE OR REPLACE FUNCTION daily_activity_delta(
+    user_id INT, started TIMESTAMPTZ,
+    videos_watched INT DEFAULT 0, watched_seconds BIGINT DEFAULT 0,
+    loop_time BIGINT DEFAULT 0, inactivity_seconds NUMERIC DEFAULT 0,
+    session_count INT DEFAULT 0, session_seconds NUMERIC DEFAULT 0,
+    cards_accepted INT DEFAULT 0, cards_rejected INT DEFAULT 0
+) RETURNS user_daily_activity LANGUAGE sql IMMUTABLE AS $$
+    SELECT user_id, (started AT TIME ZONE 'UTC')::DATE, videos_watched, watched_seconds,
+           loop_time, inactivity_seconds, session_count, session_seconds,
+           cards_accepted, cards_rejected, NULL::TIMESTAMPTZ
+$$;
+
+-- Fold deltas per (user, day) and add them in key order, one upsert per
+-- statement, so concurrent writers lock rollup rows in the same order
+CREATE OR REPLACE FUNCTION add_daily_activity(deltas user_daily_activity[])
+RETURNS VOID LANGUAGE sql AS $$
+    INSERT INTO user_daily_activity AS a (
+        user_id, day, videos_watched, watched_seconds, loop_time, inactivity_seconds,
+        session_count, session_seconds, cards_accepted, cards_rejected
+    )
+    SELECT d.user_id, d.day, SUM(d.videos_watched), SUM(d.watched_seconds),
+           SUM(d.loop_time), SUM(d.inactivity_seconds), SUM(d.session_count),
+           SUM(d.session_seconds), SUM(d.cards_accepted), SUM(d.cards_rejected)
+    FROM unnest(deltas) d
+    WHERE d.user_id IS NOT NULL
+    GROUP BY d.user_id, d.day
+    ORDER BY d.user_id, d.day
+    ON CONFLICT (user_id, day) DO UPDATE SET
+        videos_watched = a.videos_watched + EXCLUDED.videos_watched,
+        watched_seconds = a.watched_seconds + EXCLUDED.watched_seconds,
+        loop_time = a.loop_time + EXCLUDED.loop_time,
+        inactivity_seconds = a.inactivity_seconds + EXCLUDED.inactivity_seconds,
+        session_count = a.session_count + EXCLUDED.session_count,
+        session_seconds = a.session_seconds + EXCLUDED.session_seconds,
+        cards_accepted = a.cards_accepted + EXCLUDED.cards_accepted,
+        cards_rejected = a.cards_rejected + EXCLUDED.cards_rejected,
+        updated_at = NOW()
+$$;
+
+-- videos: a new row counts as a watched video; upserts add the growth of
+-- watched/loop_time (both only ever increase, see the videos upsert)
+CREATE OR REPLACE FUNCTION rollup_videos() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM add_daily_activity(ARRAY(
+            SELECT daily_activity_delta(
+                s.user_id, n.session_started_at, videos_watched => 1,
+                watched_seconds => COALESCE(n.watched, 0), loop_time => COALESCE(n.loop_time, 0)
+            )
+            FROM new_rows n JOIN sessions s ON s.id = n.session_id
+        ));
+    ELSE
+        PERFORM add_daily_activity(ARRAY(
+            SELECT daily_activity_delta(
+                s.user_id, n.session_started_at,
+                watched_seconds => COALESCE(n.watched, 0) - COALESCE(o.watched, 0),
+                loop_time => COALESCE(n.loop_time, 0) - COALESCE(o.loop_time, 0)
+            )
+            FROM new_rows n
+            JOIN old_rows o ON o.id = n.id AND o.session_started_at = n.session_started_at
+            JOIN sessions s ON s.id = n.session_id
+            WHERE n.watched IS DISTINCT FROM o.watched OR n.loop_time IS DISTINCT FROM o.loop_time
+        ));
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION rollup_inactivity() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM add_daily_activity(ARRAY(
+        SELECT daily_activity_delta(
+            s.user_id, s.starttime, inactivity_seconds => COALESCE(n.duration, 0)
+        )
+        FROM new_rows n JOIN sessions s ON s.id = n.session_id
+    ));
+    RETURN NULL;
+END;
+$$;
+
+-- cards: count by current status; a status change moves the card between
+-- the accepted and rejected counters
+CREATE OR REPLACE FUNCTION rollup_cards() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM add_daily_activity(ARRAY(
+            SELECT daily_activity_delta(
+                s.user_id, n.session_started_at,
+                cards_accepted => (n.status = 'accept')::INT,
+                cards_rejected => (n.status = 'reject')::INT
+            )
+            FROM new_rows n JOIN sessions s ON s.id = n.session_id
+        ));
+    ELSE
+        PERFORM add_daily_activity(ARRAY(
+            SELECT daily_activity_delta(
+                s.user_id, n.session_started_at,
+                cards_accepted => (n.status = 'accept')::INT - (o.status = 'accept')::INT,
+                cards_rejected => (n.status = 'reject')::INT - (o.status = 'reject')::INT
+            )
+            FROM new_rows n
+            JOIN old_rows o ON o.id = n.id AND o.session_started_at = n.session_started_at
+            JOIN sessions s ON s.id = n.session_id
+            WHERE n.status <> o.status
+        ));
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- sessions: counted when created, their duration added when ended (row
+-- triggers: sessions are written one at a time, and the WHEN clauses keep
+-- the frequent total_videos_watched updates from firing anything)
+CREATE OR REPLACE FUNCTION rollup_sessions() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM add_daily_activity(ARRAY[daily_activity_delta(NEW.user_id, NEW.starttime, session_count => 1)]);
+    ELSE
+        PERFORM add_daily_activity(ARRAY[daily_activity_delta(
+            NEW.user_id, NEW.starttime,
+            session_seconds => COALESCE(NEW.duration, 0) - COALESCE(OLD.duration, 0)
+        )]);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- Statement-level triggers with transition tables: one rollup upsert per
+-- multi-row write (log_video/batch, write-behind flushes, cards/bulk)
+CREATE TRIGGER videos_rollup_insert AFTER INSERT ON videos
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_videos();
+CREATE TRIGGER videos_rollup_update AFTER UPDATE ON videos
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_videos();
+CREATE TRIGGER inactivity_rollup_insert AFTER INSERT ON inactivity
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_inactivity();
+CREATE TRIGGER cards_rollup_insert AFTER INSERT ON cards
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_cards();
+CREATE TRIGGER cards_rollup_update AFTER UPDATE ON cards
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_cards();
+CREATE TRIGGER sessions_rollup_insert AFTER INSERT ON sessions
+    FOR EACH ROW WHEN (NEW.user_id IS NOT NULL) EXECUTE FUNCTION rollup_sessions();
+CREATE TRIGGER sessions_rollup_end AFTER UPDATE OF duration ON sessions
+    FOR EACH ROW WHEN (NEW.user_id IS NOT NULL AND NEW.duration IS DISTINCT FROM OLD.duration)
+    EXECUTE FUNCTION rollup_sessions();
+
+-- Recompute [from_day, to_day] from the raw tables. Takes a lock on the
+-- rollup so triggers from concurrent writes wait for the rebuild.
+CREATE OR REPLACE FUNCTION rebuild_user_daily_activity(from_day DATE, to_day DATE)
+RETURNS INT LANGUAGE plpgsql AS $$
+DECLARE
+    lower_bound TIMESTAMPTZ := from_day::TIMESTAMP AT TIME ZONE 'UTC';
+    upper_bound TIMESTAMPTZ := (to_day + 1)::TIMESTAMP AT TIME ZONE 'UTC';
+    rebuilt INT;
+BEGIN
+    LOCK TABLE user_daily_activity IN EXCLUSIVE MODE;
+    DELETE FROM user_daily_activity WHERE day BETWEEN from_day AND to_day;
+    PERFORM add_daily_activity(ARRAY(
+        SELECT daily_activity_delta(
+            s.user_id, s.starttime, session_count => 1,
+            session_seconds => COALESCE(s.duration, 0)
+        )
+        FROM sessions s
+        WHERE s.starttime >= lower_bound AND s.starttime < upper_bound
+        UNION ALL
+        SELECT daily_activity_delta(
+            s.user_id, v.session_started_at, videos_watched => 1,
+            watched_seconds => COALESCE(v.watched, 0), loop_time => COALESCE(v.loop_time, 0)
+        )
+        FROM videos v JOIN sessions s ON s.id = v.session_id
+        WHERE v.session_started_at >= lower_bound AND v.session_started_at < upper_bound
+        UNION ALL
+        SELECT daily_activity_delta(
+            s.user_id, s.starttime, inactivity_seconds => COALESCE(i.duration, 0)
+        )
+        FROM inactivity i JOIN sessions s ON s.id = i.session_id
+        WHERE s.starttime >= lower_bound AND s.starttime < upper_bound
+        UNION ALL
+        SELECT daily_activity_delta(
+            s.user_id, c.session_started_at,
+            cards_accepted => (c.status = 'accept')::INT,
+            cards_rejected => (c.status = 'reject')::INT
+        )
+        FROM cards c JOIN sessions s ON s.id = c.session_id
+        WHERE c.session_started_at >= lower_bound AND c.session_started_at < upper_bound
+    ));
+    SELECT COUNT(*) INTO rebuilt FROM user_daily_activity WHERE day BETWEEN from_day AND to_day;
+    RETURN rebuilt;
+END;
+$$;
+
 -- ============================================
 -- DEFAULT DATA
 -- ============================================ 
@@ -0,0 +1,212 @@
+"""
+Production entry point: runs app.py (or asgi_app.py with --worker-class
+uvicorn) under gunicorn with pre-forked worker processes.
+
+    python serve.py                                  # sync workers, 2 x CPUs + 1
+    python serve.py --worker-class gthread --threads 8
+    python serve.py --worker-class gevent --worker-connections 1000
+    python serve.py --worker-class uvicorn --workers 4
+
+gevent and uvicorn workers need optional packages (requirements-gevent.txt,
+requirements-async.txt); serve.py refuses to start without them.
+
+Each worker builds its own DB pool and reference-data caches once it has
+initialized (for gevent, after monkey-patching); nothing database-related is
+opened in the master, so --preload is safe except with gevent, where it is
+turned off.
+Send SIGHUP to the master for a graceful reload (new workers start, old ones
+finish their in-flight requests); --reload restarts on code changes (dev).
+Every option can also be set through the environment (SERVE_<OPTION>).
+"""
+
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+WORKER_CLASSES = {
+    "sync": "sync",
+    "gthread": "gthread",
+    "gevent": "gevent",
+    "uvicorn": "uvicorn.workers.UvicornWorker",
+}
+# Optional packages a worker class needs -> requirements file that installs them
+WORKER_REQUIREMENTS = {
+    "gevent": (("gevent", "psycogreen"), "requirements-gevent.txt"),
+    "uvicorn": (
+        ("uvicorn", "starlette", "psycopg_pool", "a2wsgi"),
+        "requirements-async.txt",
+    ),
+}
+
+# Set by main() in the master; workers inherit it across fork and log it
+# (the master must not import app: gevent has to patch threading first)
+_preload_ignored = False
+
+
+def _env(name, default):
+    return os.getenv(f"SERVE_{name.upper()}", default)
+
+
+def missing_requirements(worker_class):
+    """Optional packages worker_class needs that are not installed."""
+    packages, _ = WORKER_REQUIREMENTS.get(worker_class, ((), None))
+    return [p for p in packages if importlib.util.find_spec(p) is None]
+
+
+def default_workers(worker_class):
+    cores = multiprocessing.cpu_count()
+    # Threaded/async workers each hold many requests; sync ones hold one
+    return cores * 2 + 1 if worker_class == "sync" else cores
+
+
+# --- WORKER HOOKS ---
+def post_worker_init(worker):
+    # Runs after init_process() has set the worker up (gevent's patch_all()
+    # included), so app's pool Condition and cache locks are created
+    # cooperative; importing app any earlier (post_fork) would make them real
+    # OS locks that block the whole gevent hub
+    if worker.cfg.worker_class_str == "gevent":
+        from psycogreen.gevent import patch_psycopg
+
+        # Must run before the worker's first connection
+        patch_psycopg()
+    import app
+
+    log = app.get_logger("serve")
+    if _preload_ignored:
+        # A preloaded app would create its locks before gevent patches threading
+        log.warning("--preload is ignored with --worker-class gevent")
+    if worker.cfg.threads > app.DB_POOL_MAX_SIZE:
+        log.warning(
+            "%s threads per worker but DB_POOL_MAX_SIZE=%s; requests will queue for connections",
+            worker.cfg.threads,
+            app.DB_POOL_MAX_SIZE,
+        )
+    # Fresh per-worker pool (connections never cross fork) and warm caches
+    app.get_pool()
+    app.warm_caches()
+
+
+def worker_exit(server, worker):
+    import app
+
+    pool = app._pool
+    if pool is not None and pool.pid == os.getpid():
+        pool.closeall()
+
+
+class Server(BaseApplication):
+    def __init__(self, options, asgi=False):
+        self.options = options
+        self.asgi = asgi
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+        self.cfg.set("post_worker_init", post_worker_init)
+        self.cfg.set("worker_exit", worker_exit)
+
+    def load(self):
+        if self.asgi:
+            from asgi_app import asgi
+
+            return asgi
+        from app import app
+
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--bind", default=_env("bind", f"0.0.0.0:{os.getenv('PORT', 8080)}")
+    )
+    parser.add_argument(
+        "--worker-class",
+        choices=sorted(WORKER_CLASSES),
+        default=_env("worker_class", "gthread"),
+    )
+    parser.add_argument("--workers", type=int, default=_env("workers", None))
+    parser.add_argument(
+        "--threads", type=int, default=int(_env("threads", 4)), help="gthread only"
+    )
+    parser.add_argument(
+        "--worker-connections",
+        type=int,
+        default=int(_env("worker_connections", 1000)),
+        help="gevent only",
+    )
+    parser.add_argument("--timeout", type=int, default=int(_env("timeout", 30)))
+    parser.add_argument(
+        "--graceful-timeout", type=int, default=int(_env("graceful_timeout", 30))
+    )
+    parser.add_argument("--keepalive", type=int, default=int(_env("keepalive", 5)))
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=int(_env("max_requests", 0)),
+        help="recycle a worker after this many requests (0 = never)",
+    )
+    parser.add_argument(
+        "--max-requests-jitter", type=int, default=int(_env("max_requests_jitter", 0))
+    )
+    parser.add_argument(
+        "--preload",
+        action="store_true",
+        default=_env("preload", "0").lower() in ("1", "true", "yes"),
+        help="import the app in the master before forking",
+    )
+    parser.add_argument(
+        "--reload",
+        action="store_true",
+        default=_env("reload", "0").lower() in ("1", "true", "yes"),
+        help="restart workers when code changes (development)",
+    )
+    parser.add_argument(
+        "--access-log",
+        default=_env("access_log", None),
+        help="access log file ('-' for stdout)",
+    )
+    args = parser.parse_args()
+
+    missing = missing_requirements(args.worker_class)
+    if missing:
+        sys.exit(
+            f"--worker-class {args.worker_class} needs {', '.join(missing)}: "
+            f"pip install -r {WORKER_REQUIREMENTS[args.worker_class][1]}"
+        )
+
+    global _preload_ignored
+    if args.preload and args.worker_class == "gevent":
+        _preload_ignored = True
+        args.preload = False
+
+    workers = int(args.workers or default_workers(args.worker_class))
+    threads = args.threads if args.worker_class == "gthread" else 1
+
+    options = {
+        "bind": args.bind,
+        "workers": workers,
+        "worker_class": WORKER_CLASSES[args.worker_class],
+        "threads": threads,
+        "worker_connections": args.worker_connections,
+        "timeout": args.timeout,
+        "graceful_timeout": args.graceful_timeout,
+        "keepalive": args.keepalive,
+        "max_requests": args.max_requests,
+        "max_requests_jitter": args.max_requests_jitter,
+        "preload_app": args.preload,
+        "reload": args.reload,
+        "accesslog": args.access_log,
+    }
+    Server(options, asgi=args.worker_class == "uvicorn").run()
+
+
+if __name__ == "__main__":
+    main()